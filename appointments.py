@@ -0,0 +1,175 @@
+# The office's appointment calendar: which time slots are booked, so two patients can't get the same one.
+# Every day that has a booking gets a bitmap with one bit per slot, so checking a slot, reserving it and
+# releasing it take the same (constant) time no matter how many bookings there are.
+import datetime
+import threading
+
+
+# describe(when): Says a datetime the way the chatbot would, for example "Friday, October 16 at 9:30 AM".
+# Input: A datetime.datetime.
+# Returns: A string.
+def describe(when):
+    hour = when.hour % 12
+    if hour == 0:
+        hour = 12
+    return "%s, %s %d at %d:%02d %s" % (when.strftime("%A"), when.strftime("%B"), when.day, hour, when.minute,
+                                        "AM" if when.hour < 12 else "PM")
+
+
+# AppointmentCalendar: The booked slots of the office.  Appointments start on slot boundaries during opening
+# hours on the days the office is open.  Reserving and releasing are atomic, so any number of sessions (and
+# threads) can share one calendar.
+class AppointmentCalendar:
+    def __init__(self, slot_minutes=30, opening=datetime.time(9, 0), closing=datetime.time(17, 0),
+                 open_days=(0, 1, 2, 3, 4)):
+        self.slot_minutes = slot_minutes
+        self.opening_minute = opening.hour * 60 + opening.minute
+        self.slots_per_day = (closing.hour * 60 + closing.minute - self.opening_minute) // slot_minutes
+        self.open_days = frozenset(open_days)
+        # date -> bitmap of booked slots (bit n is the n-th slot of the day)
+        self.days = {}
+        # (date, slot) -> who holds it
+        self.owners = {}
+        self.lock = threading.Lock()
+
+    # slot_of(when): Finds the slot an appointment time falls in.
+    # Input: A datetime.datetime.
+    # Returns: A (date, slot number) pair, or None if the office isn't open then.
+    def slot_of(self, when):
+        if when.weekday() not in self.open_days:
+            return None
+        slot = (when.hour * 60 + when.minute - self.opening_minute) // self.slot_minutes
+        if slot < 0 or slot >= self.slots_per_day:
+            return None
+        return when.date(), slot
+
+    # start_of(date, slot): The time a slot starts.
+    # Input: The date and the slot number.
+    # Returns: A datetime.datetime.
+    def start_of(self, date, slot):
+        minutes = self.opening_minute + slot * self.slot_minutes
+        return datetime.datetime.combine(date, datetime.time(minutes // 60, minutes % 60))
+
+    # is_free(when): Checks whether an appointment can be made at a time.
+    # Input: A datetime.datetime.
+    # Returns: True if the office is open then and the slot isn't booked.
+    def is_free(self, when):
+        found = self.slot_of(when)
+        if found is None:
+            return False
+        date, slot = found
+        return not self.days.get(date, 0) >> slot & 1
+
+    # reserve(when, owner): Books the slot a time falls in, if it is still free.
+    # Input: A datetime.datetime, and who the slot is for.
+    # Returns: True if the slot was booked, False if it was already taken or the office isn't open then.
+    def reserve(self, when, owner):
+        found = self.slot_of(when)
+        if found is None:
+            return False
+        with self.lock:
+            return self.take(found[0], found[1], owner)
+
+    # take(date, slot, owner): Books a slot.  The lock has to be held.
+    # Input: The date, the slot number, and who the slot is for.
+    # Returns: True if the slot was booked, False if it was already taken.
+    def take(self, date, slot, owner):
+        booked = self.days.get(date, 0)
+        if booked >> slot & 1:
+            return False
+        self.days[date] = booked | 1 << slot
+        self.owners[(date, slot)] = owner
+        return True
+
+    # release(when, owner): Frees up the slot a time falls in.
+    # Input: A datetime.datetime, and optionally who the slot should belong to (it isn't released otherwise).
+    # Returns: True if the slot was freed.
+    def release(self, when, owner=None):
+        found = self.slot_of(when)
+        if found is None:
+            return False
+        with self.lock:
+            if found not in self.owners or (owner is not None and self.owners[found] != owner):
+                return False
+            date, slot = found
+            del self.owners[found]
+            booked = self.days[date] & ~(1 << slot)
+            if booked:
+                self.days[date] = booked
+            else:
+                del self.days[date]
+            return True
+
+    # nearest_free(when, not_before, horizon_days): Finds the free slot closest to a time.
+    # Input: A datetime.datetime, optionally the earliest time that can be offered, and how many days either
+    #        way to look.
+    # Returns: The start of the nearest free slot (the slot of when itself if it's free), or None if there is
+    #          nothing free within the horizon.
+    def nearest_free(self, when, not_before=None, horizon_days=14):
+        found = self.nearest(when, not_before, horizon_days)
+        if found is None:
+            return None
+        return self.start_of(found[0], found[1])
+
+    # reserve_nearest(when, owner, not_before, horizon_days): Finds the free slot closest to a time and books it,
+    #                                                         in one step, so nobody can take it in between.
+    # Input: The same as nearest_free, plus who the slot is for.
+    # Returns: The start of the slot that was booked, or None if there was nothing free.
+    def reserve_nearest(self, when, owner, not_before=None, horizon_days=14):
+        with self.lock:
+            found = self.nearest(when, not_before, horizon_days)
+            if found is None:
+                return None
+            self.take(found[0], found[1], owner)
+        return self.start_of(found[0], found[1])
+
+    # nearest(when, not_before, horizon_days): Searches the days around a time for the closest free slot.  The
+    #                                          lock has to be held (or the answer may be out of date).
+    # Input: The same as nearest_free.
+    # Returns: A (date, slot number) pair, or None.
+    def nearest(self, when, not_before, horizon_days):
+        slot_seconds = self.slot_minutes * 60
+        # distances are measured from the start of the slot the time falls in, so that slot itself is closest
+        anchor = when - datetime.timedelta(minutes=(when.hour * 60 + when.minute - self.opening_minute)
+                                           % self.slot_minutes, seconds=when.second, microseconds=when.microsecond)
+        every_slot = (1 << self.slots_per_day) - 1
+        best = None
+        for offset in sorted(range(-horizon_days, horizon_days + 1), key=abs):
+            # the days are searched from the closest out, so once a whole day lies further away than the best
+            # slot so far, nothing after it can be closer
+            if best is not None and abs(offset) - 1 > best[0] / 86400:
+                break
+            date = when.date() + datetime.timedelta(days=offset)
+            if date.weekday() not in self.open_days:
+                continue
+            free = ~self.days.get(date, 0) & every_slot
+            if not_before is not None:
+                if date < not_before.date():
+                    continue
+                elif date == not_before.date():
+                    # leave out the slots that start before not_before
+                    passed = -(-(not_before - self.start_of(date, 0)).total_seconds() // slot_seconds)
+                    free &= ~((1 << int(min(max(passed, 0), self.slots_per_day))) - 1)
+            if not free:
+                continue
+            # the closest free slots at or after, and at or before, the anchor's position in this day
+            position = int((anchor - self.start_of(date, 0)).total_seconds() // slot_seconds)
+            candidates = []
+            if position < self.slots_per_day:
+                after = free >> max(position, 0)
+                if after:
+                    candidates.append(max(position, 0) + (after & -after).bit_length() - 1)
+            if position >= 0:
+                before = free & ((1 << min(position + 1, self.slots_per_day)) - 1)
+                if before:
+                    candidates.append(before.bit_length() - 1)
+            for slot in candidates:
+                distance = abs((self.start_of(date, slot) - anchor).total_seconds())
+                if best is None or (distance, date, slot) < best:
+                    best = (distance, date, slot)
+        if best is None:
+            return None
+        return best[1], best[2]
+
+    def __len__(self):
+        return len(self.owners)
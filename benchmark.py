@@ -0,0 +1,726 @@
+# Benchmarks for the chatbot's pipeline stages.
+# Usage: python benchmark.py [benchmark ...] [--number N] [--seed N] [--json results.json]
+import argparse
+import concurrent.futures
+import copy
+import datetime
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+import appointments
+import chatbot
+import journal
+import legacy
+import selfcheck
+import timeparse
+
+
+# bench_times(args): Compares the original date and time extraction with the single-pass resolver, which on
+#                    top of finding the text also works out the datetime it means.
+# Input: The command line arguments (--number is how many rounds over the date/time corpus to run).
+# Returns: Nothing, the results are printed.
+def bench_times(args):
+    corpus = selfcheck.date_time_corpus
+    now = selfcheck.date_time_now
+    before = time_function(legacy.date_and_time, corpus, args.number)
+    after = time_function(lambda utterance: timeparse.resolve(utterance, now), corpus, args.number)
+    print("%-18s %12s %12s" % ("date/time", "extract (us)", "resolve (us)"))
+    print("%-18s %12.2f %12.2f" % ("per input", before, after))
+
+
+# time_per_call(function, cases, number): Measures the average cost of calling function on each case.
+# Input: A function taking (dst, state, slots), a list of (state, slots) cases, and how many rounds to run.
+# Returns: The average time per call, in microseconds.
+def time_per_call(function, cases, number):
+    random.seed(0)
+    trackers = [chatbot.new_dst() for k in range(len(cases))]
+    start = time.perf_counter()
+    for k in range(number):
+        for dst, (state, slots) in zip(trackers, cases):
+            function(dst, state, slots)
+    elapsed = time.perf_counter() - start
+    return elapsed / (number * len(cases)) * 1e6
+
+
+# time_function(function, inputs, number): Measures the average cost of calling function on each input.
+# Input: A function of one argument, a list of inputs, and how many rounds to run.
+# Returns: The average time per call, in microseconds.
+def time_function(function, inputs, number):
+    start = time.perf_counter()
+    for k in range(number):
+        for value in inputs:
+            function(value)
+    elapsed = time.perf_counter() - start
+    return elapsed / (number * len(inputs)) * 1e6
+
+
+# bench_nlg(args): Compares the per-turn rendering cost of the original nlg with the precompiled one.
+# Input: The command line arguments (--number is how many rounds over the nlg cases to run).
+# Returns: Nothing, the results are printed.
+def bench_nlg(args):
+    number = args.number
+    cases = selfcheck.nlg_cases()
+    groups = [("plain", [c for c in cases if not c[1]]),
+              ("confirm", [c for c in cases if c[0] == "confirm"]),
+              ("book_appointment", [c for c in cases if c[0] == "book_appointment"])]
+    print("%-18s %12s %12s %8s" % ("nlg", "before (us)", "after (us)", "speedup"))
+    for name, group in groups:
+        before = time_per_call(legacy.nlg, group, number)
+        after = time_per_call(chatbot.nlg, group, number)
+        print("%-18s %12.2f %12.2f %7.1fx" % (name, before, after, before / after))
+
+
+# bench_intents(args): Compares the original yes/no and greeting patterns with the single-pass intent matcher.
+# Input: The command line arguments (--number is how many rounds over the yes/no corpus to run).
+# Returns: Nothing, the results are printed.
+def bench_intents(args):
+    number = args.number
+    corpus = selfcheck.yes_no_corpus
+    print("%-18s %12s %12s %8s" % ("intents", "before (us)", "after (us)", "speedup"))
+    for name, before_function, after_function in [("answer", legacy.answer_yes_no, chatbot.intent_matcher.answer),
+                                                   ("greeting", legacy.greeting_answer, chatbot.intent_matcher.greeting)]:
+        before = time_function(before_function, corpus, number)
+        after = time_function(after_function, corpus, number)
+        print("%-18s %12.2f %12.2f %7.1fx" % (name, before, after, before / after))
+
+
+# Run in a fresh interpreter by bench_coldstart, so nothing is loaded yet
+coldstart_script = """
+import json, sys, time
+start = time.perf_counter()
+import chatbot
+result = {"import": time.perf_counter() - start}
+if sys.argv[1] == "preload":
+    start = time.perf_counter()
+    chatbot.preload()
+    result["preload"] = time.perf_counter() - start
+session = chatbot.DialogueSession()
+session.start()
+session.turn("yes")
+session.turn("yes")
+start = time.perf_counter()
+session.turn("a fever, a dry cough and a sore throat")
+result["first clarification turn"] = time.perf_counter() - start
+session.turn("yes")
+start = time.perf_counter()
+session.turn("my mom and my brother")
+result["second clarification turn"] = time.perf_counter() - start
+print(json.dumps(result))
+"""
+
+
+# bench_coldstart(args): Reports how long a fresh worker takes to start, and the latency of its first
+#                        clarification turn (the first one to need the tagger), with and without preload().
+# Input: The command line arguments (--number is how many fresh interpreters to start for each mode, up to
+#        5; the median is reported).
+# Returns: Nothing, the results are printed.
+def bench_coldstart(args):
+    number = args.number
+    here = os.path.dirname(os.path.abspath(__file__))
+    print("%-28s %12s %12s" % ("coldstart (median ms)", "lazy", "preload"))
+    results = {}
+    for mode in ["lazy", "preload"]:
+        runs = []
+        for k in range(min(number, 5)):
+            process = subprocess.run([sys.executable, "-c", coldstart_script, mode], cwd=here,
+                                     capture_output=True, text=True)
+            if process.returncode != 0:
+                print("%s run failed:\n%s" % (mode, process.stderr.strip()))
+                return
+            runs.append(json.loads(process.stdout))
+        results[mode] = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+    for key in ["import", "preload", "first clarification turn", "second clarification turn"]:
+        row = ["%12.1f" % (results[mode][key] * 1000) if key in results[mode] else "%12s" % "-" for mode in results]
+        print("%-28s %s" % (key, " ".join(row)))
+
+
+# A conversation that goes around most of the retry loops: non-answers, a missing time, and two rejected times.
+# Clarification answers come with their values, so no tagger is needed.
+memory_script = [("maybe", None), ("yes", None), ("hmm", None), ("yes", None),
+                 ("", ["fever", "dry cough", "shortness of breath"]), ("yes", None), ("", ["mom", "uncle"]),
+                 ("no", None), ("nope", None), ("next Friday", None), ("tomorrow at 3pm", None), ("no", None),
+                 ("Monday at 10am", None), ("no", None), ("today at noon", None), ("yes", None)]
+
+
+# session_memory(count, make_dst): Measures how much memory live sessions take after the memory_script conversation.
+# Input: How many sessions to keep alive, and a function making the dialogue state tracker each session uses.
+# Returns: The average number of bytes per session.
+def session_memory(count, make_dst):
+    random.seed(0)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    sessions = []
+    for k in range(count):
+        session = chatbot.DialogueSession()
+        session.dst = make_dst()
+        session.start()
+        for utterance, values in memory_script:
+            session.respond(chatbot.nlu(session.dst, utterance, values))
+        sessions.append(session)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / count
+
+
+# bench_memory(args): Compares the memory each live session takes with the original defaultdict tracker
+#                     and with the fixed-layout DialogueState.
+# Input: The command line arguments (10 * --number sessions are kept alive).
+# Returns: Nothing, the results are printed.
+def bench_memory(args):
+    number = args.number
+    count = number * 10
+    before = session_memory(count, lambda: defaultdict(list))
+    after = session_memory(count, chatbot.new_dst)
+    print("%-18s %12s %12s %8s" % ("memory", "before (B)", "after (B)", "saving"))
+    print("%-18s %12.0f %12.0f %7.0f%%" % ("per session", before, after, (1 - after / before) * 100))
+
+
+# What the synthetic patients in bench_stages say
+synthetic_symptoms = ["fever", "dry cough", "shortness of breath", "sore throat", "a bad headache", "loss of taste",
+                      "constant fatigue", "chills", "muscle aches", "runny nose", "mild nausea", "diarrhea",
+                      "congestion", "sneezing", "severe chest pain", "loss of smell", "body aches", "vomiting",
+                      "dizziness", "a rash"]
+synthetic_people = ["my mom", "my dad", "my sister", "my brother", "my grandmother", "my uncle", "my wife",
+                    "my coworker", "my neighbor", "a friend from school", "the mailman", "my roommate"]
+synthetic_days = ["today", "tonight", "tomorrow", "Monday", "this Tuesday", "next Wednesday", "next Thursday",
+                  "the following Friday", "Saturday"]
+synthetic_times = ["3pm", "10:30 am", "noon", "9 in the morning", "4:15 PM", "afternoon", "11am", "midnight"]
+synthetic_non_answers = ["hmm", "what?", "I'm not really sure", "can you say that again"]
+
+
+# listed(items): Lists items the way a patient would say them.
+# Input: A list of strings.
+# Returns: The items separated by commas (with "and" before the last one), or by "and" if there are two.
+def listed(items):
+    if len(items) == 1:
+        return items[0]
+    elif len(items) == 2:
+        return items[0] + " and " + items[1]
+    return ", ".join(items[:-1]) + ", and " + items[-1]
+
+
+# synthetic_reply(branch, generator, list_length): Makes up what a patient says next.
+# Input: The question the patient is answering (the last entry of the dialogue state history), a random
+#        generator, and how many things to list if the patient is asked to clarify.
+# Returns: A string containing the patient's input.
+def synthetic_reply(branch, generator, list_length):
+    if generator.random() < 0.05:
+        return generator.choice(synthetic_non_answers)
+    if branch == "greetings":
+        return generator.choice(["yes", "yes please", "sure", "yeah I do"])
+    elif branch == "confirm_appointment":
+        return generator.choice(["yes", "yes", "sure", "no"])
+    elif branch in ("clarify_symptoms", "clarify_other_issues"):
+        return listed(generator.sample(synthetic_symptoms, list_length))
+    elif branch in ("clarify_family_history", "clarify_outside_contact"):
+        return listed(generator.sample(synthetic_people, min(list_length, len(synthetic_people))))
+    elif branch in ("create_appointment", "create_appointment_again"):
+        day = generator.choice(synthetic_days)
+        at = generator.choice(synthetic_times)
+        if generator.random() < 0.5:
+            return day + " at " + at
+        return "at " + at + " " + day
+    return generator.choice(["yes", "yeah", "no", "nope"])
+
+
+# nlu_stage(branch, user_input): The name the nlu latency of a turn is recorded under.
+# Input: The question the user is answering, and the user's input.
+# Returns: A string naming the NLU branch (clarifications are grouped by how many things were listed).
+def nlu_stage(branch, user_input):
+    if branch in chatbot.clarification_pos:
+        count = len(chatbot.split_listed_values(user_input))
+        for low, high in [(1, 1), (2, 4), (5, 9), (10, 20)]:
+            if count <= high:
+                return "nlu clarification %d-%d items" % (low, high)
+        return "nlu clarification 21+ items"
+    elif branch in ("create_appointment", "create_appointment_again"):
+        return "nlu date/time"
+    elif branch == "greetings":
+        return "nlu greeting"
+    return "nlu yes/no"
+
+
+# stage_order(stage): Sort key that lists the stages in pipeline order, and the clarification sizes from small to big.
+# Input: The name of a stage.
+# Returns: A tuple to sort by.
+def stage_order(stage):
+    numbers = [int(number) for number in re.findall(r"\d+", stage)]
+    return (["nlu", "update_dst", "dialogue_policy", "nlg", "turn"].index(stage.split()[0]), numbers, stage)
+
+
+# percentile(ordered, p): Nearest-rank percentile of a sorted list.
+# Input: A sorted, non-empty list of numbers, and the percentile (0-100).
+# Returns: The value at that percentile.
+def percentile(ordered, p):
+    return ordered[max(0, min(len(ordered) - 1, -(-len(ordered) * p // 100) - 1))]
+
+
+# bench_stages(args): Drives synthetic conversations through the turn pipeline and reports the latency of each
+#                     stage (nlu by branch, update_dst, dialogue_policy, nlg, and the book appointment render,
+#                     split by whether its summary was cached) and of the whole turn.
+# Input: The command line arguments (--number is how many conversations to run, --seed picks them, and
+#        --json is where to save the results so runs can be compared).
+# Returns: Nothing, the results are printed (and saved).
+def bench_stages(args):
+    chatbot.preload()
+    generator = random.Random(args.seed)
+    random.seed(args.seed)
+    samples = defaultdict(list)
+    clock = time.perf_counter_ns
+    booking = chatbot.booking_summary_cache
+    booking.clear()
+    # how many of the conversations' bookings were rendered from scratch ([False]) and from the cache ([True])
+    rendered = [0, 0]
+    for conversation in range(args.number):
+        # clarification lists grow from 1 to 20 items over the conversations
+        list_length = conversation % 20 + 1
+        session = chatbot.DialogueSession(conversation)
+        session.start()
+        while not session.finished:
+            branch = session.dst["dialogue_state_history"][-1]
+            user_input = synthetic_reply(branch, generator, list_length)
+            dst = session.dst
+
+            # the same steps as DialogueSession.turn, timed one by one
+            start = clock()
+            slots_and_values = chatbot.nlu(dst, user_input)
+            understood = clock()
+            chatbot.update_dst(dst, slots_and_values)
+            updated = clock()
+            session.state, slot_values, session.policy_step, updates = chatbot.next_state(dst, session.policy_step)
+            chatbot.update_dst(dst, updates)
+            hits = booking.hits
+            decided = clock()
+            chatbot.nlg(dst, session.state, slot_values)
+            done = clock()
+
+            samples[nlu_stage(branch, user_input)].append(understood - start)
+            samples["update_dst"].append(updated - understood)
+            samples["dialogue_policy"].append(decided - updated)
+            if session.state == "book_appointment" and len(slot_values) == 1:
+                samples["nlg book_appointment (1 slots)"].append(done - decided)
+            elif session.state == "book_appointment":
+                cached = booking.hits > hits
+                rendered[cached] += 1
+                stage = "nlg book_appointment (%d slots" % len(slot_values)
+                samples[stage + (", cached)" if cached else ")")].append(done - decided)
+                if not cached:
+                    # the same booking again, as the next patient listing the same things would get it (without
+                    # changing which templates the rest of the conversations pick)
+                    picks = random.getstate()
+                    again = clock()
+                    chatbot.nlg(chatbot.new_dst(), session.state, slot_values)
+                    samples[stage + ", cached)"].append(clock() - again)
+                    random.setstate(picks)
+            else:
+                samples["nlg"].append(done - decided)
+            samples["turn"].append(done - start)
+
+    results = {}
+    print("%-40s %8s %10s %10s %10s" % ("stage (us)", "count", "p50", "p95", "p99"))
+    for stage in sorted(samples, key=stage_order):
+        ordered = sorted(samples[stage])
+        results[stage] = {"count": len(ordered), "mean_us": sum(ordered) / len(ordered) / 1000}
+        for p in (50, 95, 99):
+            results[stage]["p%d_us" % p] = percentile(ordered, p) / 1000
+        print("%-40s %8d %10.1f %10.1f %10.1f" % (stage, len(ordered), results[stage]["p50_us"],
+                                                  results[stage]["p95_us"], results[stage]["p99_us"]))
+    print("nlu cache: %(hits)d hits, %(misses)d misses" % chatbot.listed_values_cache.info())
+    print("nlu lexicon: %(hits)d answers matched, %(misses)d tagged (%(hit_rate).0f%% hit rate)"
+          % lexicon_info())
+    booking_cache = {"hits": rendered[True], "misses": rendered[False],
+                     "hit_rate": rendered[True] / max(sum(rendered), 1) * 100}
+    print("booking summary cache: %(hits)d hits, %(misses)d misses (%(hit_rate).0f%% hit rate)" % booking_cache)
+
+    if args.json:
+        report = {"benchmark": "stages", "conversations": args.number, "seed": args.seed,
+                  "python": sys.version.split()[0], "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "nlu_cache": chatbot.listed_values_cache.info(), "nlu_lexicon": lexicon_info(),
+                  "booking_cache": booking_cache, "stages": results}
+        with open(args.json, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        print("saved to " + args.json)
+
+
+# lexicon_info(): The hits and misses of all the clarification lexicons together.
+# Input: Nothing
+# Returns: A dictionary with the hits, misses and hit rate (as a percentage).
+def lexicon_info():
+    hits = sum(known.info()["hits"] for known in chatbot.listed_value_lexicons.values())
+    misses = sum(known.info()["misses"] for known in chatbot.listed_value_lexicons.values())
+    return {"hits": hits, "misses": misses, "hit_rate": hits / max(hits + misses, 1) * 100}
+
+
+# bench_lexicon(args): Compares extracting clarification answers with the tagger alone and with the lexicon
+#                      fast path in front of it (the cache is turned off, so every answer is extracted), and checks
+#                      that the lexicon gives the same values the tagger would for every answer it matches.
+# Input: The command line arguments (10 * --number answers, --seed picks them).
+# Returns: Nothing, the results are printed.
+def bench_lexicon(args):
+    chatbot.preload()
+    generator = random.Random(args.seed)
+    branches = sorted(chatbot.clarification_pos)
+    answers = []
+    for k in range(args.number * 10):
+        branch = generator.choice(branches)
+        answers.append((synthetic_reply(branch, generator, generator.randint(1, 6)), chatbot.clarification_pos[branch]))
+
+    size = chatbot.listed_values_cache.maxsize
+    lexicons = chatbot.listed_value_lexicons
+    chatbot.listed_values_cache.resize(0)
+    try:
+        chatbot.listed_value_lexicons = {}
+        before = time_function(lambda answer: chatbot.extract_listed_values([answer]), answers, 1)
+        chatbot.listed_value_lexicons = lexicons
+        after = time_function(lambda answer: chatbot.extract_listed_values([answer]), answers, 1)
+    finally:
+        chatbot.listed_value_lexicons = lexicons
+        chatbot.listed_values_cache.resize(size)
+    print("%-18s %12s %12s %8s" % ("clarification", "tagger (us)", "lexicon (us)", "speedup"))
+    print("%-18s %12.2f %12.2f %7.1fx" % ("per answer", before, after, before / after))
+    print("nlu lexicon: %(hits)d answers matched, %(misses)d tagged (%(hit_rate).0f%% hit rate)" % lexicon_info())
+
+    matched = 0
+    different = []
+    for input, validpos in sorted(set(answers), key=lambda answer: answer[0]):
+        found = lexicons[validpos].match(chatbot.split_listed_values(input))
+        if found is not None:
+            matched += 1
+            tagged = chatbot.tag_listed_values([(input, validpos)])[0]
+            if found != tagged:
+                different.append((input, found, tagged))
+    print("the lexicon agrees with the tagger on %d of the %d different answers it matched"
+          % (matched - len(different), matched))
+    for input, found, tagged in different[:10]:
+        print("  %r: lexicon %r, tagger %r" % (input, found, tagged))
+
+
+# bench_calendar(args): Measures the appointment calendar with 100,000 existing bookings: looking up a slot,
+#                       reserving and releasing one, and finding the nearest free slot, plus a check that
+#                       sessions racing for the same time never get the same slot.
+# Input: The command line arguments (1000 * --number lookups are timed, --seed picks the bookings).
+# Returns: Nothing, the results are printed.
+def bench_calendar(args):
+    generator = random.Random(args.seed)
+    # a busy office: ten minute slots from 8am to 8pm every day, for five years (about 131,000 slots)
+    calendar = appointments.AppointmentCalendar(slot_minutes=10, opening=datetime.time(8, 0),
+                                                closing=datetime.time(20, 0), open_days=range(7))
+    first_day = datetime.datetime(2026, 1, 1, 8, 0)
+    slots = 365 * 5 * calendar.slots_per_day
+    bookings = 100000
+
+    # the time slot number k of the five years starts at
+    def slot_time(k):
+        day, slot = divmod(k, calendar.slots_per_day)
+        return first_day + datetime.timedelta(days=day, minutes=slot * calendar.slot_minutes)
+
+    start = time.perf_counter()
+    for k in generator.sample(range(slots), bookings):
+        calendar.reserve(slot_time(k), "booking %d" % k)
+    fill = (time.perf_counter() - start) / bookings * 1e6
+
+    times = [slot_time(generator.randrange(slots)) + datetime.timedelta(minutes=generator.randrange(10))
+             for k in range(args.number * 1000)]
+    lookup = time_function(calendar.is_free, times, 1)
+    nearest = time_function(calendar.nearest_free, times, 1)
+
+    # reserve_and_release(when): Holds the nearest free slot for a moment, the way a session confirming does.
+    def reserve_and_release(when):
+        calendar.release(calendar.reserve_nearest(when, "bench"), "bench")
+    hold = time_function(reserve_and_release, times, 1)
+
+    print("%-18s %12s" % ("calendar", "per call (us)"))
+    print("%-18s %12.2f" % ("reserve", fill))
+    print("%-18s %12.2f" % ("is_free", lookup))
+    print("%-18s %12.2f" % ("nearest_free", nearest))
+    print("%-18s %12.2f" % ("hold + release", hold))
+
+    # every thread asks for the same handful of times, so they are all competing for the same slots
+    wanted = times[:50]
+    held = defaultdict(list)
+
+    def patient(name):
+        for when in wanted:
+            start_time = calendar.reserve_nearest(when, name)
+            if start_time is not None:
+                held[start_time].append(name)
+
+    threads = [threading.Thread(target=patient, args=("patient %d" % k,)) for k in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    doubled = sum(1 for names in held.values() if len(names) > 1)
+    print("%d bookings, %d racing reservations, %d double bookings" % (len(calendar), 8 * len(wanted), doubled))
+
+
+# What the patients in bench_journal say (no clarifications, so the tagger doesn't drown out the journal)
+journal_script = ["yes", "no", "no", "no", "no", "friday at 3pm", "hmm", "no", "tomorrow at 10am", "yes"]
+
+
+# journal_turns(registry, count, generator): Runs count conversations through a registry, leaving most of them
+#                                            unfinished, the way a crash would.
+# Input: The chatbot.SessionRegistry, how many conversations to run, and the random.Random that picks how far
+#        each one gets.
+# Returns: The number of turns that were run.
+def journal_turns(registry, count, generator):
+    now = selfcheck.date_time_now
+    turns = 0
+    for k in range(count):
+        session = registry.create()
+        session.clock = lambda: now
+        session_id = session.session_id
+        session.start()
+        for user_input in journal_script[:generator.randint(1, len(journal_script))]:
+            registry.turn(session_id, user_input)
+            turns += 1
+    return turns
+
+
+# bench_journal(args): Measures what the append-only journal costs per turn, and how long it takes to rebuild
+#                      the unfinished conversations from the journal alone and from a snapshot.
+# Input: The command line arguments (50 * --number conversations are run, --seed picks how far each gets).
+# Returns: Nothing, the results are printed.
+def bench_journal(args):
+    count = args.number * 50
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "journal")
+        start = time.perf_counter()
+        turns = journal_turns(chatbot.SessionRegistry(), count, random.Random(args.seed))
+        before = (time.perf_counter() - start) / turns * 1e6
+
+        # no snapshots along the way, so recovery has to replay every turn
+        writer = journal.Journal(path, snapshot_every=10 ** 9)
+        start = time.perf_counter()
+        registry = chatbot.SessionRegistry(journal=writer)
+        journal_turns(registry, count, random.Random(args.seed))
+        writer.sync()
+        after = (time.perf_counter() - start) / turns * 1e6
+        size = os.path.getsize(path)
+
+        start = time.perf_counter()
+        live = len(journal.Journal(path).recover())
+        replayed = time.perf_counter() - start
+
+        writer.compact()
+        writer.close()
+        start = time.perf_counter()
+        journal.Journal(path).recover()
+        restored = time.perf_counter() - start
+
+    print("%-18s %12s %12s %8s" % ("journal", "before (us)", "after (us)", "overhead"))
+    print("%-18s %12.2f %12.2f %7.0f%%" % ("per turn", before, after, (after / before - 1) * 100))
+    print("%d turns (%.0f turns/s journaled), %.1f bytes per turn, %d conversations left unfinished"
+          % (turns, turns / (after * turns / 1e6), size / turns, live))
+    print("%-18s %12.1f" % ("recovery (ms)", replayed * 1e3))
+    print("%-18s %12.1f" % ("from snapshot (ms)", restored * 1e3))
+
+
+# bench_pool(args): Measures how clarification tagging scales with the NLU worker pool, used the way the server
+#                   uses it: many conversations at once, each sending one answer at a time.
+# Input: The command line arguments (20 * --number answers are tagged, --seed picks them).
+# Returns: Nothing, the results are printed.
+def bench_pool(args):
+    import nlu_pool
+    generator = random.Random(args.seed)
+    branches = sorted(chatbot.clarification_pos)
+    answers = []
+    for k in range(args.number * 20):
+        branch = generator.choice(branches)
+        answers.append([(synthetic_reply(branch, generator, generator.randint(1, 6)), chatbot.clarification_pos[branch])])
+
+    chatbot.preload()
+    chatbot.listed_values_cache.clear()
+    start = time.perf_counter()
+    for answer in answers:
+        chatbot.extract_listed_values(answer)
+    before = len(answers) / (time.perf_counter() - start)
+    print("%-18s %12s %8s" % ("nlu pool", "answers/s", "speedup"))
+    print("%-18s %12.1f %7.1fx" % ("in-process", before, 1.0))
+
+    for workers in (1, 2, 4, 8):
+        with nlu_pool.NLUPool(workers) as pool, \
+                concurrent.futures.ThreadPoolExecutor(workers * 4) as connections:
+            # let every worker finish loading the tagger before the clock starts
+            pool.tag([answer[0] for answer in answers[:workers * pool.chunk_size]])
+            chatbot.listed_values_cache.clear()
+            start = time.perf_counter()
+            list(connections.map(pool.extract, answers))
+            after = len(answers) / (time.perf_counter() - start)
+        print("%-18s %12.1f %7.1fx" % ("%d worker%s" % (workers, "s" if workers > 1 else ""), after, after / before))
+    print("(%d cores)" % os.cpu_count())
+
+
+# bench_classifier(args): Compares the n-gram answer classifier with the regex intent matcher: how often each
+#                         labels yes/no answers right (trained on 80% of intent_corpus.tsv, tested on the rest,
+#                         over a few different splits), how often the two together do at each confidence threshold
+#                         (the classifier's label where it is at least that confident, the matcher's otherwise, the
+#                         way nlu_batch uses it) and how many of the matcher's labels that changes, and how long
+#                         each takes per answer for batches of pending answers of different sizes.
+# Input: The command line arguments (--number is how many rounds to time, --seed picks the splits).
+# Returns: Nothing, the results are printed.
+def bench_classifier(args):
+    import intent_classifier
+    if intent_classifier.numpy is None:
+        print("classifier: NumPy isn't installed, the regex matcher is all there is")
+        return
+    examples = intent_classifier.read_corpus()
+    generator = random.Random(args.seed)
+    splits = 5
+    thresholds = (0.5, 0.6, 0.7, 0.8, 0.9, 0.95)
+    right = {"regex": 0, "classifier": 0}
+    combined = dict.fromkeys(thresholds, 0)
+    changed = dict.fromkeys(thresholds, 0)
+    tested = 0
+    for k in range(splits):
+        shuffled = list(examples)
+        generator.shuffle(shuffled)
+        test = shuffled[::5]
+        train = [example for n, example in enumerate(shuffled) if n % 5]
+        classifier = intent_classifier.IntentClassifier(train)
+        answers = [answer for label, answer in test]
+        matched = intent_classifier.regex_classify_batch(answers)[0]
+        found, confidences = classifier.classify_batch(answers)
+        for name, labelled in [("regex", matched), ("classifier", found)]:
+            right[name] += sum(label == expected for label, (expected, answer) in zip(labelled, test))
+        for threshold in thresholds:
+            for label, confidence, match, (expected, answer) in zip(found, confidences, matched, test):
+                label = label if confidence >= threshold else match
+                combined[threshold] += label == expected
+                changed[threshold] += label != match
+        tested += len(test)
+    print("%-18s %12s %12s" % ("held-out accuracy", "regex", "classifier"))
+    print("%-18s %11.1f%% %11.1f%%" % ("%d answers" % tested, right["regex"] / tested * 100,
+                                       right["classifier"] / tested * 100))
+    print("%-18s %12s %12s" % ("confidence", "accuracy", "changed"))
+    for threshold in thresholds:
+        print("%-18s %11.1f%% %11.1f%%" % (">= %g" % threshold, combined[threshold] / tested * 100,
+                                           changed[threshold] / tested * 100))
+
+    classifier = intent_classifier.load()
+    pool = [answer for label, answer in examples]
+    print("%-18s %12s %12s %8s" % ("batch", "regex (us)", "model (us)", "speedup"))
+    for size in (64, 512, 4096):
+        batch = [pool[n % len(pool)] for n in range(size)]
+        rounds = max(1, args.number * 64 // size)
+        timings = {}
+        for name, function in [("regex", intent_classifier.regex_classify_batch),
+                               ("classifier", classifier.classify_batch)]:
+            start = time.perf_counter()
+            for k in range(rounds):
+                function(batch)
+            timings[name] = (time.perf_counter() - start) / rounds / size * 1e6
+        print("%-18s %12.2f %12.2f %7.1fx" % ("%d answers" % size, timings["regex"], timings["classifier"],
+                                              timings["regex"] / timings["classifier"]))
+
+
+# bench_export(args): Measures the export of finished conversations: what adding one costs the turn loop, how
+#                     many the background thread writes per second, how much disk each takes, and how long the
+#                     memory-mapped reader takes to open and to find the top symptoms of the last week.
+# Input: The command line arguments (1000 * --number conversations are exported, --seed picks them).
+# Returns: Nothing, the results are printed.
+def bench_export(args):
+    import export
+    generator = random.Random(args.seed)
+    random.seed(args.seed)
+    # a few hundred real finished conversations (clarification answers come with their values, so no tagger is
+    # needed), exported over and over (each time with its own session id, like real traffic) with finishing
+    # times spread over the last month
+    sessions = []
+    for k in range(500):
+        session = chatbot.DialogueSession(k)
+        session.start()
+        for utterance, values in [("yes", None), ("yes", None), ("", generator.sample(synthetic_symptoms, generator.randint(1, 6))),
+                                  ("yes", None), ("", ["mom", "uncle"]), ("no", None),
+                                  (generator.choice(["no", "yes"]), None), ("", ["asthma"]),
+                                  ("friday at 3pm", None), ("yes", None)]:
+            if session.finished:
+                break
+            session.respond(chatbot.nlu(session.dst, utterance, values))
+        sessions.append(session)
+    count = args.number * 1000
+    now = time.time()
+    finished = [now - generator.random() * 30 * 86400 for k in range(count)]
+    exported = []
+    for k in range(count):
+        session = copy.copy(sessions[k % len(sessions)])
+        session.session_id = k
+        exported.append(session)
+
+    with tempfile.TemporaryDirectory() as directory:
+        exporter = export.Exporter(directory)
+        start = time.perf_counter()
+        for k in range(count):
+            exporter.add(exported[k], finished[k])
+        added = time.perf_counter() - start
+        exporter.flush()
+        written = time.perf_counter() - start
+        exporter.close()
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        strings = export.read_manifest(directory)["strings"]
+
+        if export.numpy is None:
+            print("export: NumPy isn't installed, so the export can't be read back")
+            return
+        start = time.perf_counter()
+        reader = export.ExportReader(directory)
+        opened = time.perf_counter() - start
+        rounds = 20
+        start = time.perf_counter()
+        for k in range(rounds):
+            top = reader.top_symptoms(since=now - 7 * 86400)
+        query = (time.perf_counter() - start) / rounds
+        del reader
+
+    print("%-26s %12s" % ("export", ""))
+    print("%-26s %12.2f" % ("add (us per conversation)", added / count * 1e6))
+    print("%-26s %12.0f" % ("written (per second)", count / written))
+    print("%-26s %12.1f" % ("bytes per conversation", size / count))
+    print("%-26s %12d" % ("dictionary strings", strings))
+    print("%-26s %12.2f" % ("open reader (ms)", opened * 1e3))
+    print("%-26s %12.2f" % ("top symptoms, week (ms)", query * 1e3))
+    print("over %d conversations; top symptoms: %s" % (count, ", ".join("%s (%d)" % pair for pair in top[:3])))
+
+
+benchmarks = {
+    "nlg": bench_nlg,
+    "intents": bench_intents,
+    "coldstart": bench_coldstart,
+    "memory": bench_memory,
+    "stages": bench_stages,
+    "times": bench_times,
+    "calendar": bench_calendar,
+    "journal": bench_journal,
+    "pool": bench_pool,
+    "lexicon": bench_lexicon,
+    "classifier": bench_classifier,
+    "export": bench_export,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chatbot's pipeline stages.")
+    parser.add_argument("benchmarks", nargs="*", help="benchmarks to run: " + ", ".join(benchmarks) + " (default: all)")
+    parser.add_argument("--number", type=int, default=200, help="rounds per benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the synthetic conversations")
+    parser.add_argument("--json", help="save the stage latencies to this JSON file")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in benchmarks:
+            parser.error("unknown benchmark " + repr(name))
+    for name in args.benchmarks or list(benchmarks):
+        benchmarks[name](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,233 @@
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+import argparse
+import atexit
+import datetime
 import random
 import re
-import nltk
-from nltk.corpus import wordnet as wn
+import itertools
+import os
+import sys
+import threading
+import time
 
-dst = defaultdict(list)
+import appointments
+import lexicon
+import timeparse
 
-# update_dst(input): Updates the dialogue state tracker
-# Input: A list ([]) of (slot, value) pairs.  Slots should be strings; values can be whatever is
-#        most appropriate for the corresponding slot.  Defaults to an empty list.
+# nltk is only imported the first time something actually needs to be tagged (or when preload() is called),
+# since importing it is most of the chatbot's startup time
+nltk = None
+
+
+# load_nltk(): Imports nltk the first time it is needed.
+# Input: Nothing
+# Returns: The nltk module.
+def load_nltk():
+    global nltk
+    if nltk is None:
+        import nltk as module
+        nltk = module
+    return nltk
+
+
+# preload(): Loads the tokenizer and the POS tagger ahead of time, so the first user who lists his/her
+#            symptoms doesn't have to wait for them.  Servers should call this before taking any traffic.
+# Input: Nothing
+# Returns: A dictionary with how long each part took to load, in seconds.
+def preload():
+    timings = {}
+    start = time.perf_counter()
+    load_nltk()
+    timings["import"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    words = nltk.word_tokenize("Warming up the tokenizer.")
+    timings["tokenizer"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    nltk.pos_tag_sents([words])
+    timings["tagger"] = time.perf_counter() - start
+    return timings
+
+
+# Every dialogue state and user intent that gets stored in a history, numbered so a history can store
+# small integer codes instead of strings.  Names that aren't listed here get a code the first time they show up.
+history_names = [
+    "greetings", "early_exit", "symptoms", "family_history", "outside_contact", "other_issues",
+    "clarify_symptoms", "clarify_family_history", "clarify_outside_contact", "clarify_other_issues",
+    "create_appointment", "create_appointment_again", "confirm", "confirm_appointment", "book_appointment",
+    "unknown_not_yes_no", "unknown_question", "unknown_time", "unknown_day", "unknown_generic",
+    "unknown_not_specific", "respond_symptoms", "respond_family_history", "respond_outside_contact",
+    "respond_other_issues", "respond_date_and_time", "goodbye", "no_openings",
+]
+history_codes = {name: code for code, name in enumerate(history_names)}
+history_codes_lock = threading.Lock()
+
+
+# history_code(name): Looks up the code of a dialogue state or user intent, giving it one if it doesn't have one.
+# Input: The name of the state or intent.
+# Returns: Its integer code.
+def history_code(name):
+    code = history_codes.get(name)
+    if code is None:
+        with history_codes_lock:
+            code = history_codes.get(name)
+            if code is None:
+                code = len(history_names)
+                if code > 255:
+                    raise ValueError("too many different history entries to store " + repr(name))
+                history_names.append(name)
+                history_codes[name] = code
+    return code
+
+
+# History: A bounded history of dialogue states or user intents.  Only the most recent entries are kept (in a
+# ring buffer of codes), but every entry that was ever added is remembered, so "in" still answers whether
+# something happened at any point in the conversation.
+class History:
+    __slots__ = ("codes", "end", "count", "seen")
+
+    # how many of the most recent entries are kept
+    capacity = 8
+
+    def __init__(self):
+        self.codes = bytearray(self.capacity)
+        self.end = 0
+        self.count = 0
+        # bit n is set once the entry with code n was added
+        self.seen = 0
+
+    def append(self, name):
+        code = history_code(name)
+        self.codes[self.end] = code
+        self.end = (self.end + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+        self.seen |= 1 << code
+
+    # history[-1] is the most recent entry, history[-2] the one before it, and so on
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError("history index out of range")
+        return history_names[self.codes[(self.end - self.count + index) % self.capacity]]
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for k in range(self.count):
+            yield self[k]
+
+    def __contains__(self, name):
+        code = history_codes.get(name)
+        return code is not None and bool(self.seen >> code & 1)
+
+    def __repr__(self):
+        return "History(" + repr(list(self)) + ")"
+
+
+# The slots a dialogue state has room for
+dst_slots = ("symptoms", "family_history", "outside_contact", "other_issues", "confirm", "date_and_time",
+             "clarify_symptoms", "clarify_family_history", "clarify_outside_contact", "clarify_other_issues")
+dst_histories = ("user_intent_history", "dialogue_state_history")
+
+
+# DialogueState: The dialogue state tracker of one conversation.  It is used like a dictionary of slot -> value,
+# but has a fixed field for each known slot (slots nobody filled in take up no room), and keeps its histories
+# bounded.  Any other slot names go in a small dictionary that is only made if one is used.
+class DialogueState:
+    __slots__ = dst_slots + dst_histories + ("extra", "journal", "session_id")
+
+    def __init__(self):
+        self.user_intent_history = History()
+        self.dialogue_state_history = History()
+        self.extra = None
+        # the journal.Journal every update is written to (see journal.Journal.attach), and the id it's under
+        self.journal = None
+        self.session_id = None
+
+    def __contains__(self, slot):
+        if slot in dst_histories:
+            return len(getattr(self, slot)) > 0
+        elif slot in dst_slots:
+            return hasattr(self, slot)
+        return self.extra is not None and slot in self.extra
+
+    def __getitem__(self, slot):
+        if slot in dst_slots or slot in dst_histories:
+            try:
+                return getattr(self, slot)
+            except AttributeError:
+                raise KeyError(slot) from None
+        elif self.extra is not None and slot in self.extra:
+            return self.extra[slot]
+        raise KeyError(slot)
+
+    def __setitem__(self, slot, value):
+        if slot in dst_histories:
+            raise KeyError("the " + slot + " can only be appended to")
+        elif slot in dst_slots:
+            setattr(self, slot, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[slot] = value
+
+    # keys(): The slots that are filled in (histories count once they have something in them).
+    # Input: Nothing
+    # Returns: A list of slot names.
+    def keys(self):
+        filled = [slot for slot in dst_histories + dst_slots if slot in self]
+        if self.extra is not None:
+            filled.extend(self.extra)
+        return filled
+
+    def __len__(self):
+        return len(self.keys())
+
+    # as_dict(): A plain dictionary copy of the dialogue state, with the histories as lists.
+    # Input: Nothing
+    # Returns: A dictionary of slot -> value.
+    def as_dict(self):
+        copy = {}
+        for slot in self.keys():
+            copy[slot] = list(self[slot]) if slot in dst_histories else self[slot]
+        return copy
+
+
+# new_dst(): Creates an empty dialogue state tracker for a single conversation.
+# Input: Nothing
+# Returns: A fresh dialogue state tracker.  Every conversation gets its own tracker, which is then
+#          passed explicitly through nlu -> update_dst -> dialogue_policy -> nlg.
+def new_dst():
+    return DialogueState()
+
+
+# update_dst(dst, input): Updates the dialogue state tracker, and writes the update to the conversation's
+#                         journal if it has one.
+# Input: The dialogue state tracker of the conversation being updated, and a list ([]) of (slot, value)
+#        pairs.  Slots should be strings; values can be whatever is most appropriate for the corresponding
+#        slot.  Defaults to an empty list.
+# Returns: Nothing
+def update_dst(dst, input=[]):
+    journal = getattr(dst, "journal", None)
+    if journal is None or len(input) == 0:
+        apply_updates(dst, input)
+        return
+    # the journal's lock is held across both, so a snapshot can't land in between
+    with journal.lock:
+        apply_updates(dst, input)
+        journal.record(dst.session_id, input)
+
+
+# apply_updates(dst, input): Stores (slot, value) pairs in the dialogue state tracker.  This is update_dst
+#                            without the journal, which is also what replays the journal on recovery.
+# Input: The same as update_dst.
 # Returns: Nothing
-def update_dst(input=[]):
+def apply_updates(dst, input):
     questions = ["symptoms", "family_history", "outside_contact", "other_issues", "no"]
-    global dst
     for i, j in input:
         # if there's a "user_intent_history" or "dialogue_state_history" slot in the input, add to the respective slot in dst
         if i == "user_intent_history" or i == "dialogue_state_history":
@@ -26,318 +241,665 @@ def update_dst(input=[]):
             dst[i] = j
     return
 
-# get_dst(slot): Retrieves the stored value for the specified slot, or the full dialogue state at the
-#                current time if no argument is provided.
-# Input: A string value corresponding to a slot name.
+# get_dst(dst, slot): Retrieves the stored value for the specified slot, or the full dialogue state at the
+#                     current time if no argument is provided.
+# Input: The dialogue state tracker of the conversation, and a string value corresponding to a slot name.
 # Returns: A dictionary representation of the full dialogue state (if no slot name is provided), or the
 #          value corresponding to the specified slot.
-def get_dst(slot=""):
+def get_dst(dst, slot=""):
     # if no argument was given (or a blank one was given)
     if slot == "":
-        return dict(dst)
+        return dst.as_dict()
     # this is for if the slot doesn't exist with the given input
-    elif len(dst[slot]) <= 0:
+    elif slot not in dst or len(dst[slot]) <= 0:
         return "slot doesn't exist"
     # return the value(s) in the given slot
     else:
         return dst[slot]
 
 
-# dialogue_policy(dst): Selects the next dialogue state to be uttered by the chatbot.
-# Input: A dictionary representation of a full dialogue state.
-# Returns: A string value corresponding to a dialogue state, and a list of (slot, value) pairs necessary
-#          for generating an utterance for that dialogue state (or an empty list of no (slot, value) pairs
-#          are needed).
-def dialogue_policy(dst):
-    # if the user gave an empty dictionary (or one without a user_intent_history), we give a greeting
-    #try:
-    unknowns = ["unknown_not_yes_no", "unknown_question", "unknown_time", "unknown_day", "unknown_generic", "unknown_not_specific"]
+# The states the user is asked to repeat his/her response in
+unknowns = frozenset(["unknown_not_yes_no", "unknown_question", "unknown_time", "unknown_day", "unknown_generic", "unknown_not_specific"])
+
+# The questions asked before booking, in order.  Each one is followed by its clarification, which is only
+# asked if the user answered "yes" to it
+prebooking_questions = [
+    ("symptoms", "clarify_symptoms"),
+    ("family_history", "clarify_family_history"),
+    ("outside_contact", "clarify_outside_contact"),
+    ("other_issues", "clarify_other_issues"),
+]
+
+# The policy table: one (state, slot, only_if_yes) step for each thing we have to ask before we can confirm
+# the appointment.  A step is asked while its slot isn't filled (and, for clarifications, only if the question
+# slot only_if_yes was answered "yes").  Once a step is done it stays done, since its slot is never emptied
+# again, so the policy can pick up from the step it stopped at last turn instead of starting over.
+policy_steps = []
+for question, clarification in prebooking_questions:
+    policy_steps.append((question, question, None))
+    policy_steps.append((clarification, clarification, question))
+# end of prebooking questions, onto actual booking of the apppointment
+policy_steps.append(("create_appointment", "date_and_time", None))
+policy_steps = tuple(policy_steps)
+
+# The clarifications that get passed on to the book appointment template, in the order it expects them
+booking_slots = tuple(clarification for question, clarification in prebooking_questions)
+
+
+# next_state(dst, step): Selects the next dialogue state, picking up from where the policy table was left
+#                        at last turn.  Nothing in dst is copied or changed.
+# Input: The dialogue state tracker of the conversation, and the policy table step the conversation was at
+#        (0 for a new conversation).
+# Returns: A string value corresponding to a dialogue state, a list of (slot, value) pairs necessary for
+#          generating an utterance for that state, the policy table step the conversation is at now, and a
+#          list of (slot, value) pairs the caller has to store with update_dst before moving on.
+def next_state(dst, step=0):
+    # if the dialogue state is still empty, we give a greeting
     if len(dst) <= 0:
-        return "greetings", []
-    elif "early_exit" in dst["user_intent_history"]:
-        return "early_exit", []
-    elif dst["user_intent_history"][-1] in unknowns:
+        return "greetings", [], step, []
+    history = dst["user_intent_history"]
+    if "early_exit" in history:
+        return "early_exit", [], step, []
+    elif history[-1] in unknowns:
         # if we end up here, most likely we're getting the user to repeat his/her response
-        return dst["user_intent_history"][-1], []
-    elif "symptoms" not in dst:
-        return "symptoms", []
-    # we should clarify if the user said "yes" or we can move on to the next question on "no"
-    elif dst["symptoms"] == "yes" and "clarify_symptoms" not in dst:
-        return "clarify_symptoms", []
-    # these next ones follow the same pattern as above to ask a question, and if the user answers "yes" to clarify
-    elif "family_history" not in dst:
-        return "family_history", []
-    elif dst["family_history"] == "yes" and "clarify_family_history" not in dst:
-        return "clarify_family_history", []
-    elif "outside_contact" not in dst:
-        return "outside_contact", []
-    elif dst["outside_contact"] == "yes" and "clarify_outside_contact" not in dst:
-        return "clarify_outside_contact", []
-    elif "other_issues" not in dst:
-        return "other_issues", []
-    elif dst["other_issues"] == "yes" and "clarify_other_issues" not in dst:
-        return "clarify_other_issues", []
-    # end of prebooking questions, onto actual booking of the apppointment
-    # this also loops back to here if the user said no confirming this appointment
-    elif "date_and_time" not in dst:
-        # reset confirm slot to an empty string in case the user said "no" to confirming the appointment
-        update_dst([("confirm", "")])
-        return "create_appointment", []
-    elif dst["confirm"] == "no":
-        update_dst([("confirm", "")])
-        return "create_appointment_again", []
-    # confirm the given date and time
-    # since we set dst["confirm"] = [] in "date_and_time", we know it exists,
-    # but it's to check if the user gave an answer to the most recent time given
-    elif dst["confirm"] == "":
-        return "confirm", [("date_and_time", dst["date_and_time"])]
+        return history[-1], [], step, []
+
+    while step < len(policy_steps):
+        state, slot, only_if_yes = policy_steps[step]
+        if slot not in dst and (only_if_yes is None or dst[only_if_yes] == "yes"):
+            if state == "create_appointment":
+                # reset confirm slot to an empty string, so we know the next answer is about this time
+                return state, [], step, [("confirm", "")]
+            return state, [], step, []
+        step += 1
+
+    # this loops back to here if the user said no confirming this appointment
+    confirm = dst["confirm"]
+    if confirm == "no":
+        return "create_appointment_again", [], step, [("confirm", "")]
+    # confirm the given date and time, if the user didn't answer about the most recent time given yet
+    elif confirm == "":
+        return "confirm", [("date_and_time", dst["date_and_time"])], step, []
     # end, book the appointment with the stated time
-    elif dst["confirm"] == "yes":
+    elif confirm == "yes":
         toreturn = [("date_and_time", dst["date_and_time"])]
-        if "clarify_symptoms" in dst["dialogue_state_history"]:
-            toreturn.append(("clarify_symptoms", dst["clarify_symptoms"]))
-        if "clarify_family_history" in dst["dialogue_state_history"]:
-            toreturn.append(("clarify_family_history", dst["clarify_family_history"]))
-        if "clarify_outside_contact" in dst["dialogue_state_history"]:
-            toreturn.append(("clarify_outside_contact", dst["clarify_outside_contact"]))
-        if "clarify_other_issues" in dst["dialogue_state_history"]:
-            toreturn.append(("clarify_other_issues", dst["clarify_other_issues"]))
-        return "book_appointment", toreturn
+        for slot in booking_slots:
+            if slot in dst["dialogue_state_history"]:
+                toreturn.append((slot, dst[slot]))
+        return "book_appointment", toreturn, step, []
     else:
         # if we end up here, we should set it to just terminate, something wrong happened
-        return "unknown_question", []
+        return "unknown_question", [], step, []
 
 
-# nlg(state, slots=[]): Generates a surface realization for the specified dialogue act.
-# Input: A string indicating a valid state, and optionally a list of (slot, value) tuples.
-# Returns: A string representing a sentence generated for the specified state, optionally
-#          including the specified slot values if they are needed by the template.
-def nlg(state, slots=[]):
-    templates = defaultdict(list)
+# dialogue_policy(dst, tracker): Selects the next dialogue state to be uttered by the chatbot.
+# Input: A dictionary representation of a full dialogue state, and the dialogue state tracker it was taken
+#        from (the confirm slot gets reset there when we (re)ask for a time).  If no tracker is given, dst
+#        itself is updated.
+# Returns: A string value corresponding to a dialogue state, and a list of (slot, value) pairs necessary
+#          for generating an utterance for that dialogue state (or an empty list of no (slot, value) pairs
+#          are needed).
+def dialogue_policy(dst, tracker=None):
+    if tracker is None:
+        tracker = dst
+    state, slots, step, updates = next_state(dst)
+    update_dst(tracker, updates)
+    return state, slots
+
+
+# The templates for every state.  These are built once when the module is loaded, and then compiled
+# below into literal/placeholder segments so nlg can fill them in with a single join.
+templates = defaultdict(list)
+
+templates["greetings"].append("Hello, this is Dr. Peng's office. Did you need to schedule an appointment?")
+templates["greetings"].append("Dr. Peng's office. Would you like to book an appointment?")
+
+templates["unknown_not_yes_no"].append("Sorry, I didn't get that. Could you give me a more definite answer?")
+templates["unknown_not_yes_no"].append("I didn't understand your answer. Could you answer my question more clearly?")
 
-    templates["greetings"].append("Hello, this is Dr. Peng's office. Did you need to schedule an appointment?")
-    templates["greetings"].append("Dr. Peng's office. Would you like to book an appointment?")
+# not sure if this will be needed, but since I have them in my nlu, I'll include them
+templates["unknown_question"].append("Something went wrong. I'll have to cut it here.")
+templates["unknown_question"].append(
+    "Sorry, I will need to end here as something unexpected happened.")
 
-    templates["unknown_not_yes_no"].append("Sorry, I didn't get that. Could you give me a more definite answer?")
-    templates["unknown_not_yes_no"].append("I didn't understand your answer. Could you answer my question more clearly?")
+templates["unknown_time"].append("Your time didn't add up. Could you please repeat the day and time?")
+templates["unknown_time"].append(
+    "Your time doesn't make sense. Say your date and time again, but make sure you said it right.")
 
-    # not sure if this will be needed, but since I have them in my nlu, I'll include them
-    templates["unknown_question"].append("Something went wrong. I'll have to cut it here.")
-    templates["unknown_question"].append(
-        "Sorry, I will need to end here as something unexpected happened.")
+templates["unknown_day"].append("I don't understand your timing. Could you give a time I could understand?")
+templates["unknown_day"].append(
+    "I didn't catch the date, maybe because it wasn't clear. Could you restate that?")
 
-    templates["unknown_time"].append("Your time didn't add up. Could you please repeat the day and time?")
-    templates["unknown_time"].append(
-        "Your time doesn't make sense. Say your date and time again, but make sure you said it right.")
+templates["unknown_generic"].append("Could you repeat that? I couldn't quite get that")
+templates["unknown_generic"].append("I don't understand. Could you possibly clarify?")
 
-    templates["unknown_day"].append("I don't understand your timing. Could you give a time I could understand?")
-    templates["unknown_day"].append(
-        "I didn't catch the date, maybe because it wasn't clear. Could you restate that?")
+templates["unknown_not_specific"].append("I don't think what you listed is valid. Could you list them again?")
+templates["unknown_not_specific"].append("I didn't understand what you listed. Could you possibly clarify?")
 
-    templates["unknown_generic"].append("Could you repeat that? I couldn't quite get that")
-    templates["unknown_generic"].append("I don't understand. Could you possibly clarify?")
+# for my dst, I'm not going to add to the dst if we hit one of the unknowns where we ask the user to repeat his/her response
+dontaddtodst = ["unknown_not_yes_no", "unknown_question", "unknown_time", "unknown_day", "unknown_generic", "unknown_not_specific"]
 
-    templates["unknown_not_specific"].append("I don't think what you listed is valid. Could you list them again?")
-    templates["unknown_not_specific"].append("I didn't understand what you listed. Could you possibly clarify?")
+templates["early_exit"].append("Ok well have a nice day!")
+templates["early_exit"].append("Oh ok well do come back if you actually change your mind")
 
-    # for my dst, I'm not going to add to the dst if we hit one of the unknowns where we ask the user to repeat his/her response
-    dontaddtodst = ["unknown_not_yes_no", "unknown_question", "unknown_time", "unknown_day", "unknown_generic", "unknown_not_specific"]
+templates["symptoms"].append("Ok. Let me ask you a few questions first. Do you have any symptoms of covid?")
+templates["symptoms"].append("Alright. The doctor will need some information first. Do you have any symptoms of covid?")
 
-    templates["early_exit"].append("Ok well have a nice day!")
-    templates["early_exit"].append("Oh ok well do come back if you actually change your mind")
+templates["clarify_symptoms"].append("Could you describe your symptoms?")
+templates["clarify_symptoms"].append("Could you list them out for me, please?")
 
-    templates["symptoms"].append("Ok. Let me ask you a few questions first. Do you have any symptoms of covid?")
-    templates["symptoms"].append("Alright. The doctor will need some information first. Do you have any symptoms of covid?")
+templates["family_history"].append("Any family members you know that have the virus?")
+templates["family_history"].append("Do you know anyone in your family with the virus?")
 
-    templates["clarify_symptoms"].append("Could you describe your symptoms?")
-    templates["clarify_symptoms"].append("Could you list them out for me, please?")
+templates["clarify_family_history"].append("Who do you know has it?")
+templates["clarify_family_history"].append("Could you list their names and/or relationship to you?")
 
-    templates["family_history"].append("Any family members you know that have the virus?")
-    templates["family_history"].append("Do you know anyone in your family with the virus?")
+templates["outside_contact"].append("Have you been in contact with anyone outside your family who might have the virus?")
+templates["outside_contact"].append("Do you think you came into contact with someone outside who has the virus?")
 
-    templates["clarify_family_history"].append("Who do you know has it?")
-    templates["clarify_family_history"].append("Could you list their names and/or relationship to you?")
+templates["clarify_outside_contact"].append("Who did you meet?")
+templates["clarify_outside_contact"].append("Could you describe who it might've been?")
 
-    templates["outside_contact"].append("Have you been in contact with anyone outside your family who might have the virus?")
-    templates["outside_contact"].append("Do you think you came into contact with someone outside who has the virus?")
+templates["other_issues"].append("And finally, any other health issues the doctor needs to be aware of?")
+templates["other_issues"].append("Lastly, do you have any other health concerns that should be known?")
 
-    templates["clarify_outside_contact"].append("Who did you meet?")
-    templates["clarify_outside_contact"].append("Could you describe who it might've been?")
+templates["clarify_other_issues"].append("What does the doctor need to know?")
+templates["clarify_other_issues"].append("What should I tell the doctor?")
 
-    templates["other_issues"].append("And finally, any other health issues the doctor needs to be aware of?")
-    templates["other_issues"].append("Lastly, do you have any other health concerns that should be known?")
+templates["create_appointment"].append("Ok. Now what time did you want to book the appointment?")
+templates["create_appointment"].append("Alright that's all the questions I have for now. What time did you want to see the doctor?")
 
-    templates["clarify_other_issues"].append("What does the doctor need to know?")
-    templates["clarify_other_issues"].append("What should I tell the doctor?")
+templates["create_appointment_again"].append("Alright, well then what time did you want to book the appointment?")
+templates["create_appointment_again"].append(
+    "Ok, what time did you mean to set the appointment at?")
 
-    templates["create_appointment"].append("Ok. Now what time did you want to book the appointment?")
-    templates["create_appointment"].append("Alright that's all the questions I have for now. What time did you want to see the doctor?")
+templates["confirm"].append("So <date_time>. Is that ok?")
+templates["confirm"].append("I can set you up for <date_time>. That's what you wanted, correct?")
 
-    templates["create_appointment_again"].append("Alright, well then what time did you want to book the appointment?")
-    templates["create_appointment_again"].append(
-        "Ok, what time did you mean to set the appointment at?")
+# for when the time the user asked for is already booked or the office is closed then (only for sessions that
+# have a calendar), and we offer the closest free time instead.  The user answers these the same way as confirm
+templates["suggest_time"].append("That time isn't available, but I could do <date_time>. Would that work?")
+templates["suggest_time"].append("Sorry, the doctor can't see you then. How about <date_time> instead?")
 
-    templates["confirm"].append("So <date_time>. Is that ok?")
-    templates["confirm"].append("I can set you up for <date_time>. That's what you wanted, correct?")
+# for when there's nothing free anywhere near the time the user asked for
+templates["no_openings"].append("Sorry, there's nothing open around then. What other time would work for you?")
+templates["no_openings"].append("The doctor is booked up around that time. Could you pick another time?")
 
-    # Adjustment to the "book appointment" that'll needed to be accounted for in update_dst:
-    # originally, it only took the date and time for the (slot, value) input
-    # now it takes the clarification statements as well when the user answers yes and elaborates
-    # This template will be for if the user gave no symptoms or health issues
-    templates["book_appointment"].append("Alright I'll set up the appointment for <date_time> and remind you when the time comes.")
-    # These templates will be for if the user gave one of the 2
-    templates["book_appointment"].append(
-        "Alright I will set an appointment up for <date_time>, and will let the doctor know that you have <symptoms>.")
-    templates["book_appointment"].append(
-        "Alright I will set an appointment up for <date_time>, and will let the doctor know about your <other_issues>.")
-    # This will be for if there's information of both
-    templates["book_appointment"].append(
-        "Alright I will set an appointment up for <date_time>, and will let the doctor know that you have <symptoms> "
-        "as well as <other_issues>.")
+# Adjustment to the "book appointment" that'll needed to be accounted for in update_dst:
+# originally, it only took the date and time for the (slot, value) input
+# now it takes the clarification statements as well when the user answers yes and elaborates
+# This template will be for if the user gave no symptoms or health issues
+templates["book_appointment"].append("Alright I'll set up the appointment for <date_time> and remind you when the time comes.")
+# These templates will be for if the user gave one of the 2
+templates["book_appointment"].append(
+    "Alright I will set an appointment up for <date_time>, and will let the doctor know that you have <symptoms>.")
+templates["book_appointment"].append(
+    "Alright I will set an appointment up for <date_time>, and will let the doctor know about your <other_issues>.")
+# This will be for if there's information of both
+templates["book_appointment"].append(
+    "Alright I will set an appointment up for <date_time>, and will let the doctor know that you have <symptoms> "
+    "as well as <other_issues>.")
 
-    # These templates would be concatenated to one of the above to avoid having to make additional templates for all cases
-    # for family history only
-    templates["book_appointment"].append(" I also informed the doctor about your <family_member>.")
-    # for outside contacts only
-    templates["book_appointment"].append(" I also informed the doctor about your contacts with <outside_contact>.")
-    # for both
-    templates["book_appointment"].append(" I also informed the doctor about your <family_member> and <outside_contact>.")
+# These templates would be concatenated to one of the above to avoid having to make additional templates for all cases
+# for family history only
+templates["book_appointment"].append(" I also informed the doctor about your <family_member>.")
+# for outside contacts only
+templates["book_appointment"].append(" I also informed the doctor about your contacts with <outside_contact>.")
+# for both
+templates["book_appointment"].append(" I also informed the doctor about your <family_member> and <outside_contact>.")
 
+
+placeholder_pattern = re.compile(r"<(\w+)>")
+
+
+# compile_template(template): Splits a template into its literal text and its <placeholder>s.
+# Input: A template string, for example "So <date_time>. Is that ok?".
+# Returns: A tuple alternating between literal text (even positions) and placeholder names (odd positions),
+#          for example ("So ", "date_time", ". Is that ok?").
+def compile_template(template):
+    segments = []
+    start = 0
+    for match in placeholder_pattern.finditer(template):
+        segments.append(template[start:match.start()])
+        segments.append(match.group(1))
+        start = match.end()
+    segments.append(template[start:])
+    return tuple(segments)
+
+
+# render_template(segments, values): Fills in a compiled template in one pass.
+# Input: A compiled template (from compile_template), and a dictionary of placeholder name -> value.
+# Returns: The filled in string.  Placeholders without a value are left as they are.
+def render_template(segments, values):
+    parts = list(segments)
+    for k in range(1, len(parts), 2):
+        name = parts[k]
+        if name in values:
+            parts[k] = str(values[name])
+        else:
+            parts[k] = "<" + name + ">"
+    return "".join(parts)
+
+
+compiled_templates = {}
+for template_state, template_list in templates.items():
+    compiled_templates[template_state] = [compile_template(k) for k in template_list]
+
+
+# join_values(value): Turns a list of clarification answers into a natural list, such as "a, b, and c".
+# Input: A list of strings.
+# Returns: A string with the items separated by commas (or just a space if there are 2), and "and" in front of
+#          the last one.  An item equal to the last one gets the "and" too, as it always has.
+def join_values(value):
+    # if there's only one thing in the list, just put it in the string
+    if len(value) == 1:
+        return value[0]
+    if len(value) == 0:
+        return ""
+    last = value[-1]
+    # if there's only 2 items in the list, wouldn't make sense to put a comma
+    separator = " " if len(value) == 2 else ", "
+    # the pieces are joined once at the end, instead of growing a string one item at a time
+    return "".join(["and " + k if k == last else k + separator for k in value])
+
+
+# fill_template(segments, values): Fills in some of the placeholders of a compiled template.
+# Input: A compiled template (from compile_template), and a dictionary of placeholder name -> value.
+# Returns: A compiled template with the placeholders that have a value merged into the literal text around them.
+def fill_template(segments, values):
+    filled = [segments[0]]
+    for k in range(1, len(segments), 2):
+        name = segments[k]
+        if name in values:
+            filled[-1] = "".join([filled[-1], str(values[name]), segments[k + 1]])
+        else:
+            filled.append(name)
+            filled.append(segments[k + 1])
+    return tuple(filled)
+
+
+# nlg(dst, state, slots=[]): Generates a surface realization for the specified dialogue act.
+# Input: The dialogue state tracker of the conversation, a string indicating a valid state, and optionally a
+#        list of (slot, value) tuples.
+# Returns: A string representing a sentence generated for the specified state, optionally
+#          including the specified slot values if they are needed by the template.
+def nlg(dst, state, slots=[]):
     i = random.randint(0, 1)
     output = ""
-    replacetime = ""
-    additionaltemplate = ""
     if len(slots) > 0:
         if len(slots) == 1:
             # the only templates that have only one slot needed to be replaced are ones with date and time
             # the first template in create_appointment is the only template there that only uses one slot
+            values = {"date_time": slots[0][1]}
             if state == "book_appointment":
-                update_dst([("dialogue_state_history", "book_appointment")])
-                output = templates[state][0].replace("<date_time>", str(slots[0][1]))
+                update_dst(dst, [("dialogue_state_history", "book_appointment")])
+                output = render_template(compiled_templates[state][0], values)
             else:
-                update_dst([("dialogue_state_history", "confirm_appointment")])
-                output = templates[state][i].replace("<date_time>", str(slots[0][1]))
+                update_dst(dst, [("dialogue_state_history", "confirm_appointment")])
+                output = render_template(compiled_templates[state][i], values)
         # we're using a book appointment template since it's the only one that uses more than 1 slot
         # so now we have to find out which template we use
         else:
-            update_dst([("dialogue_state_history", "book_appointment")])
-            needatemplate = True
-            templateuse = 0
-            basetemplateuse = 0
-            templatereplacing = ""
-            templatevalue = ""
-            basetemplatereplacing = ""
-            basetemplatevalue = ""
-            if len(slots) == 5: # if we have 5 slots, we know which template we need, otherwise we have to figure out which one to use
-                output = templates[state][3]
-                needatemplate = False
-            for slot, value in slots:
-                # same deal as above if we only had one slot needed to be replaced
-                if slot == "date_and_time":
-                    # since we're selecting the template dependent on how many slots were given,
-                    # we should store the value if we don't have a template yet
-                    if needatemplate:
-                        replacetime = value
-                    else:
-                        output = output.replace("<date_time>", value)
-                # symptoms and issues are used in the core template
-                # originally I only had these 2 in the template, but decided to also include the clarification
-                # of family history and outside contact as we'll get to below
-                elif slot == "clarify_symptoms" or slot == "clarify_other_issues":
-                    replacing = ""
-                    # if there's only one thing in the list, just put it in the string
-                    if len(value) == 1:
-                        replacing = value[0]
-                    else:
-                        for k in value:
-                            # if it is the last item in the list, it would be natural to say "and" and not put a comma after the symptom
-                            if k == value[-1]:
-                                replacing += "and " + k
-                            # if there's only 2 items in the list, wouldn't make sense to put a comma
-                            elif len(value) == 2:
-                                replacing = k + " "
-                            # put a comma after the item
-                            else:
-                                replacing += k + ", "
-                    # placeholder for finding which template to use, and update once we find that template
-                    if needatemplate:
-                        basetemplateuse += 1
-                        if basetemplateuse == 2:
-                            output = templates[state][3].replace(basetemplatereplacing, basetemplatevalue)
-                            # these are information that we will update once we find that template
-                            if slot == "clarify_symptoms":
-                                output = output.replace("<symptoms>", replacing)
-                            elif slot == "clarify_other_issues":
-                                output = output.replace("<other_issues>", replacing)
-                            needatemplate = False
-                        elif basetemplateuse <= 1:
-                            if slot == "clarify_symptoms":
-                                basetemplatereplacing = "<symptoms>"
-                            elif slot == "clarify_other_issues":
-                                basetemplatereplacing = "<other_issues>"
-                            basetemplatevalue = replacing
-                    else:   # a template already exists, build onto that existing template
-                        if slot == "clarify_symptoms":
-                            output = output.replace("<symptoms>", replacing)
-                        elif slot == "clarify_other_issues":
-                            output = output.replace("<other_issues>", replacing)
-                elif slot == "clarify_family_history" or slot == "clarify_outside_contact":
-                    replacing = ""
-                    if len(value) == 1:
-                        replacing = value[0]
-                    else:
-                        for k in value:
-                            # if it is the last item in the list, it would be natural to say "and" and not put a comma after the symptom
-                            if k == value[-1]:
-                                replacing += "and " + k
-                            # if there's only 2 items in the list, wouldn't make sense to put a comma
-                            elif len(value) == 2:
-                                replacing = k + " "
-                            # put a comma after the item
-                            else:
-                                replacing += k + ", "
-                    # essentially the same as above for symptoms and other issues
-                    templateuse += 1
-                    if templateuse == 2:
-                        additionaltemplate = templates[state][6].replace(templatereplacing, templatevalue)
-                        if slot == "clarify_family_history":
-                            additionaltemplate = additionaltemplate.replace("<family_member>", replacing)
-                        elif slot == "clarify_outside_contact":
-                            additionaltemplate = additionaltemplate.replace("<outside_contact>", replacing)
-                    elif templateuse <= 1:
-                        if slot == "clarify_family_history":
-                            templatereplacing = "<family_member>"
-                        elif slot == "clarify_outside_contact":
-                            templatereplacing = "<outside_contact>"
-                        templatevalue = replacing
-            # if we need a book appointment template, we grab one based on how many of the clarification slots are used
-            if needatemplate:
-                if basetemplatereplacing == "<symptoms>":
-                    output = templates[state][1].replace(basetemplatereplacing, basetemplatevalue)
-                elif basetemplatereplacing == "<other_issues>":
-                    output = templates[state][2].replace(basetemplatereplacing, basetemplatevalue)
-                output = output.replace("<date_time>", replacetime)
-            # build on the main template (as I stated before, this was added after I originally wanted to only include
-            # symptoms and other issues in the book appointment statement
-            if templateuse == 1:
-                if templatereplacing == "<family_member>":
-                    additionaltemplate = templates[state][4].replace(templatereplacing, templatevalue)
-                elif templatereplacing == "<outside_contact>":
-                    additionaltemplate = templates[state][5].replace(templatereplacing, templatevalue)
+            update_dst(dst, [("dialogue_state_history", "book_appointment")])
+            output = render_booking(state, dict(slots), len(slots))
     else:
         # we can just pick a random template for anything that doesn't have inputs
-        output = templates[state][i]
+        output = render_template(compiled_templates[state][i], {})
         if state not in dontaddtodst:
-            update_dst([("dialogue_state_history", state)])
+            update_dst(dst, [("dialogue_state_history", state)])
+    return "Chatbot: " + output
+
+
+# render_booking(state, slots, count): Builds the booking summary out of the book appointment templates.
+#                                      Everything but the time is cached (see booking_summary), since patients
+#                                      list the same things over and over.
+# Input: The state being uttered, a dictionary of slot -> value, and how many slots were given.
+# Returns: The filled in booking summary.
+def render_booking(state, slots, count):
+    listed = tuple(tuple(slots[slot]) if slot in slots else None for slot in booking_slots)
+    key = (state, count == 5, listed)
+    summary = booking_summary_cache.get(key)
+    if summary is None:
+        summary = booking_summary(state, count == 5, listed)
+        if booking_summary_cache.maxsize > 0:
+            booking_summary_cache.put(key, summary)
+    return render_template(summary, {"date_time": slots.get("date_and_time", "")})
+
+
+# booking_summary(state, full, listed): Picks the book appointment templates for the clarifications that were
+#                                       given and fills them in, leaving only the time.
+# Input: The state being uttered, whether all 5 slots were given, and the values of each of the booking_slots
+#        (None for the ones that weren't given).
+# Returns: A compiled template of the whole summary, with only the <date_time> placeholder left in.
+def booking_summary(state, full, listed):
+    booking = compiled_templates[state]
+    values = {}
+    # symptoms and issues are used in the core template, family history and outside contact go in
+    # the template that gets concatenated onto it
+    for name, value in zip(("symptoms", "family_member", "outside_contact", "other_issues"), listed):
+        if value is not None:
+            values[name] = join_values(value)
+
+    # if we have 5 slots, we know which template we need, otherwise we pick one based on which of the
+    # clarification slots are used (with neither symptoms nor other issues, there is no core sentence)
+    core = ("",)
+    if full or ("symptoms" in values and "other_issues" in values):
+        core = booking[3]
+    elif "symptoms" in values:
+        core = booking[1]
+    elif "other_issues" in values:
+        core = booking[2]
+
     # append to base template
-    if len(additionaltemplate) > 0:
-        output += additionaltemplate
+    extra = ("",)
+    if "family_member" in values and "outside_contact" in values:
+        extra = booking[6]
+    elif "family_member" in values:
+        extra = booking[4]
+    elif "outside_contact" in values:
+        extra = booking[5]
+    return fill_template(core[:-1] + (core[-1] + extra[0],) + extra[1:], values)
+
+
+# The cue words that yes/no answers are recognized by.  Every cue is found in one scan of the input, along
+# with whether it starts and ends on a word boundary, since the answer patterns only check the boundary on
+# some of the cues (for example "no" anywhere counts as an answer, but only a "no" starting a word means no).
+answer_cue_pattern = re.compile(r"(?=(\b)?([Yy]e|[Ss]ure|[Yy]up|[Nn]o|[Nn]ah+|[Oo][Kk]|[Dd]on't)(\b)?)")
+
+# One bit for each way a cue can show up
+cue_ye_word_start = 1
+cue_sure = 2
+cue_yup = 4
+cue_yup_word_end = 8
+cue_no = 16
+cue_no_word_start = 32
+cue_nah = 64
+cue_nah_word_end = 128
+cue_ok = 256
+cue_ok_lowercase_k = 512
+cue_dont = 1024
+cue_dont_word_end = 2048
+
+
+# IntentMatcher: Classifies an utterance as a yes, a no, or neither, using a single scan over the input.
+# One instance (intent_matcher) is shared by the yes/no questions and the greeting.
+class IntentMatcher:
+    # the cues that make the input count as an answer to a yes/no question at all
+    answer_cues = cue_ye_word_start | cue_sure | cue_yup | cue_no | cue_nah | cue_ok | cue_dont_word_end
+    # the cues that make that answer a yes or a no
+    answer_yes_cues = cue_ye_word_start | cue_ok_lowercase_k | cue_sure | cue_yup_word_end
+    answer_no_cues = cue_no_word_start | cue_nah | cue_dont_word_end
+    # the cues for answering the greeting
+    greeting_yes_cues = cue_ye_word_start | cue_ok | cue_sure | cue_yup_word_end
+    greeting_no_cues = cue_no_word_start | cue_dont | cue_nah_word_end
+
+    # scan(input): Finds every cue in the input.
+    # Input: A string containing the user's input.
+    # Returns: An integer with the bit of every cue that was found set.
+    def scan(self, input):
+        found = 0
+        for match in answer_cue_pattern.finditer(input):
+            word_start = match.group(1) is not None
+            word_end = match.group(3) is not None
+            first = match.group(2)[0]
+            if first == "Y" or first == "y":
+                if match.group(2)[1] == "e":
+                    if word_start:
+                        found |= cue_ye_word_start
+                else:
+                    found |= cue_yup
+                    if word_end:
+                        found |= cue_yup_word_end
+            elif first == "S" or first == "s":
+                found |= cue_sure
+            elif first == "N" or first == "n":
+                if match.group(2)[1] == "o":
+                    found |= cue_no
+                    if word_start:
+                        found |= cue_no_word_start
+                else:
+                    found |= cue_nah
+                    if word_end:
+                        found |= cue_nah_word_end
+            elif first == "O" or first == "o":
+                found |= cue_ok
+                if match.group(2)[1] == "k":
+                    found |= cue_ok_lowercase_k
+            else:
+                found |= cue_dont
+                if word_end:
+                    found |= cue_dont_word_end
+        return found
+
+    # answer(input): Classifies the answer to one of the yes/no questions.
+    # Input: A string containing the user's input.
+    # Returns: "yes" or "no", "ambiguous" if the input sounds like an answer but isn't clearly either
+    #          (such as "OK" or "I know"), or "none" if it doesn't sound like an answer at all.
+    def answer(self, input):
+        found = self.scan(input)
+        if not found & self.answer_cues:
+            return "none"
+        # a "no" anywhere wins over a "yes"
+        elif found & self.answer_no_cues:
+            return "no"
+        elif found & self.answer_yes_cues:
+            return "yes"
+        else:
+            return "ambiguous"
+
+    # greeting(input): Classifies the answer to the greeting (whether the user wants an appointment).
+    # Input: A string containing the user's input.
+    # Returns: "yes" or "no", "ambiguous" if the input says both, or "none" if it says neither.
+    def greeting(self, input):
+        found = self.scan(input)
+        said_yes = found & self.greeting_yes_cues
+        said_no = found & self.greeting_no_cues
+        if said_yes and said_no:
+            return "ambiguous"
+        elif said_yes:
+            return "yes"
+        elif said_no:
+            return "no"
+        else:
+            return "none"
+
+
+intent_matcher = IntentMatcher()
+
+
+# The POS tags of the words we keep from a clarification answer, based on what is being clarified.
+# For our symptoms and other issues, we also want to include adjectives and prepositions like "of" in
+# "shortness of breath", and certain words have weird POS tagging (for example, "coughing" is VBG, while
+# "sneezing" is NN).  For family history or outside contact, our only acceptable POS tags are names (nouns).
+symptom_pos = frozenset(["NN", "NNS", "IN", "JJ", "JJR", "JJS", "VBG"])
+name_pos = frozenset(["NN", "NNS", "NNP"])
+clarification_pos = {
+    "clarify_symptoms": symptom_pos,
+    "clarify_other_issues": symptom_pos,
+    "clarify_family_history": name_pos,
+    "clarify_outside_contact": name_pos,
+}
+
+# The known terms for each kind of clarification (keyed by its POS tags), which answers are checked against
+# before they are tagged
+listed_value_lexicons = {
+    symptom_pos: lexicon.Lexicon(lexicon.symptom_terms, modifiers=lexicon.modifiers),
+    name_pos: lexicon.Lexicon(lexicon.relation_terms, lexicon.fillers | lexicon.modifiers),
+}
 
-    output = output.replace("<date_time>", replacetime)
-    return "Chatbot: " + output
+
+# split_listed_values(input): Splits a clarification answer into the things the user listed.
+# Input: A string containing the user's input.
+# Returns: A list of strings, one for each thing that was listed.
+def split_listed_values(input):
+    # the user should've given a list of answers or something related, so we assume the user
+    # separated those answers with commas
+    if "," in input:
+        return input.split(",")
+    # if the user listed only 2 items, most likely those 2 items are separated by "and"
+    elif "and" in input:
+        return input.split(" and ")
+    # most likely, the user only listed one thing
+    else:
+        return [input]
+
+
+# LRUCache: A bounded, thread-safe cache that evicts the least recently used entry once it is full, and
+# counts its hits and misses.
+class LRUCache:
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # get(key): Looks up a cached value, counting a hit or a miss.
+    # Input: The key to look up.
+    # Returns: The cached value, or None if the key isn't cached.
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    # put(key, value): Caches a value, evicting the least recently used entries if the cache is full.
+    # Input: The key and the value (which can't be None).
+    # Returns: Nothing
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    # resize(maxsize): Changes how many entries the cache can hold, evicting entries if needed.
+    # Input: The new maximum number of entries (0 turns the cache off).
+    # Returns: Nothing
+    def resize(self, maxsize):
+        with self.lock:
+            self.maxsize = maxsize
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    # clear(): Drops every entry and resets the hit and miss counters.
+    # Input: Nothing
+    # Returns: Nothing
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    # info(): Reports how well the cache is doing.
+    # Input: Nothing
+    # Returns: A dictionary with the hits, misses, current size and maximum size of the cache.
+    def info(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries), "maxsize": self.maxsize}
+
+
+# Patients give very repetitive answers ("fever and cough", "my mom"), so the values extracted from a
+# clarification answer are cached on the (normalized) answer and the POS tags being kept
+listed_values_cache = LRUCache(4096)
+
+# The booking summaries (without the time) of the combinations of clarifications patients have given, keyed on
+# the state, whether all 5 slots were given, and the values of each clarification (see render_booking)
+booking_summary_cache = LRUCache(1024)
 
 
-def nlu(input=""):
+# normalize_answer(input): Normalizes a clarification answer into its cache key.  The answer is split the same
+#                           way it is for tagging first, so two answers only share a key if they split into the
+#                           same things (the whitespace inside one of those doesn't change how it gets tagged).
+# Input: A string containing the user's input.
+# Returns: A tuple with each listed thing, with surrounding whitespace removed and any runs of whitespace
+#          collapsed to one space.
+def normalize_answer(input):
+    return tuple(" ".join(piece.split()) for piece in split_listed_values(input))
+
+
+# tag_listed_values(answers): POS tags clarification answers and extracts their listed values, all in a single
+#                             batch and without looking at the cache.  This is the part of extract_listed_values
+#                             that nlu_pool.NLUPool runs in its worker processes.
+# Input: A list of (input, validpos) pairs, where validpos is the set of POS tags to keep for that input.
+# Returns: A list with the extracted values (a list of strings) for each of the answers, in the same order.
+def tag_listed_values(answers):
+    load_nltk()
+    pieces = []
+    for input, validpos in answers:
+        for piece in split_listed_values(input):
+            pieces.append(nltk.word_tokenize(piece))
+    tagged = iter(nltk.pos_tag_sents(pieces))
+
+    extracted = []
+    for input, validpos in answers:
+        listofvalues = []
+        for piece in split_listed_values(input):
+            # only get the words that match the POS tag based on what's being clarified
+            toadd = " ".join([word for word, tag in next(tagged) if tag in validpos])
+            if len(toadd) > 0:
+                listofvalues.append(toadd)
+        extracted.append(listofvalues)
+    return extracted
+
+
+# extract_listed_values(answers, tag): Extracts the listed values out of any number of clarification answers.
+#                                      Answers that aren't cached are matched against the known terms first
+#                                      (see listed_value_lexicons), and the rest get tagged together in a single
+#                                      batch.
+# Input: A list of (input, validpos) pairs, where validpos is the set of POS tags to keep for that input, and
+#        optionally the function that does the tagging (tag_listed_values, unless it should happen elsewhere).
+# Returns: A list with the extracted values (a list of strings) for each of the answers, in the same order.
+def extract_listed_values(answers, tag=tag_listed_values):
+    extracted = []
+    # the answers that aren't cached, with where they go in extracted (the same answer is only tagged once), and
+    # the first of the user's inputs with that key, which is what gets matched or tagged
+    missing = {}
+    inputs = {}
+    for input, validpos in answers:
+        key = (normalize_answer(input), validpos)
+        listofvalues = listed_values_cache.get(key)
+        if listofvalues is None:
+            missing.setdefault(key, []).append(len(extracted))
+            inputs.setdefault(key, input)
+        extracted.append(listofvalues)
+
+    if len(missing) > 0:
+        found = []
+        untagged = []
+        for key in missing:
+            known = listed_value_lexicons.get(key[1])
+            listofvalues = None if known is None else known.match(split_listed_values(inputs[key]))
+            if listofvalues is None:
+                untagged.append(key)
+            else:
+                found.append((key, listofvalues))
+        if len(untagged) > 0:
+            found.extend(zip(untagged, tag([(inputs[key], key[1]) for key in untagged])))
+
+        for key, listofvalues in found:
+            if listed_values_cache.maxsize > 0:
+                listed_values_cache.put(key, listofvalues)
+            for k in missing[key]:
+                extracted[k] = listofvalues
+
+    # hand out copies, so nothing that gets stored in a dialogue state can change what's cached
+    return [list(listofvalues) for listofvalues in extracted]
+
+
+# nlu(dst, input): Extracts the user's intent and any slot values from the user's input.
+# Input: The dialogue state tracker of the conversation (used to know which question is being answered),
+#        a string containing the user's input, optionally the values already extracted from the input
+#        if it is a clarification answer that was tagged in a batch (see nlu_batch), optionally the
+#        datetime that days like "tomorrow" are relative to (defaults to now), and optionally what the input
+#        was already classified as if it answers a yes/no question or the greeting ("yes", "no" or "none";
+#        by default intent_matcher decides).
+# Returns: A list of (slot, value) pairs to be stored with update_dst.
+def nlu(dst, input="", listofvalues=None, now=None, answer=None):
     slots_and_values = []
 
     # List of questions where the user responds with a yes or no
@@ -347,21 +909,16 @@ def nlu(input=""):
     clarifications = ["clarify_symptoms", "clarify_family_history", "clarify_other_issues", "clarify_outside_contact"]
 
     user_intent = ""
-    # these 4 are specifically for the date and time part
-    indexofday = 0
-    lastindexofday = 1
-    lastindexoftime = 3
-    indexoftime = 2
 
     slotuse = "unknown"
     if "dialogue_state_history" in dst:
         # if we only asked the question, but didn't ask the user to clarify his/her response
         if dst["dialogue_state_history"][-1] in questions:
-            # Check to see if the input contains a valid size.
-            pattern = re.compile(r"\b([Yy]e.*)|([Ss]ure)|([Yy]up)|([Nn]o.*)|([Nn]a(h)+)|([Oo][Kk].*)|([Dd]on't)\b")
-            match = re.search(pattern, input)
+            # Check to see if the input sounds like an answer to the question.
+            if answer is None:
+                answer = intent_matcher.answer(input)
             user_intent = "answer_yes_no"
-            if match:
+            if answer != "none":
                 # Find out which question the user was responding to
                 if dst["dialogue_state_history"][-1] == "symptoms":
                     slotuse = "symptoms"
@@ -387,101 +944,27 @@ def nlu(input=""):
         # if the user answered yes to any of those questions (except for confirming the appointment), we wanted
         # the user to go into detail about it
         elif dst["dialogue_state_history"][-1] in clarifications:
-            # we only extract certain words from the input that meet the POS criteria based on what question is being answered
-            validpos = []
-            # for our symptoms and other issues, below is our acceptable POS tags
-            # certain words have weird POS tagging. For example, "coughing" is VBG, while "sneezing" is NN
-            # we also want to include adjectives and prepositions like "of" in "shortness of breath"
-            if dst["dialogue_state_history"][-1] == "clarify_symptoms" or dst["dialogue_state_history"][
-                -1] == "clarify_other_issues":
-                validpos = ["NN", "NNS", "IN", "JJ", "JJR", "JJS", "VBG"]
-                slotuse = dst["dialogue_state_history"][-1]
-                slots_and_values.append(("user_intent_history", slotuse))
-            # for talking about family history or outside contact, our only acceptable POS tags are names (nouns)
-            elif dst["dialogue_state_history"][-1] == "clarify_family_history" or dst["dialogue_state_history"][-1] == "clarify_outside_contact":
-                validpos = ["NN", "NNS", "NNP"]
-                slotuse = dst["dialogue_state_history"][-1]
-                slots_and_values.append(("user_intent_history", slotuse))
-            # the user should've given a list of answers or something related, so we assume the user
-            # separated those answers with commas
-            if "," in input:
-                # parse the input into a list were each value is the part after the comma
-                listedvalues = input.split(",")
-                listofvalues = []
-                # and then only get the words that match the POS tag based on what's being clarified
-                for i in listedvalues:
-                    wordsList = nltk.word_tokenize(i)
-                    tagged = nltk.pos_tag(wordsList)
-                    toadd = ""
-                    for t in tagged:
-                        if t[1] in validpos:
-                            if len(toadd) <= 0:
-                                toadd = t[0]
-                            else:
-                                toadd = toadd + " " + t[0]
-                    if len(toadd) > 0:
-                        listofvalues.append(toadd)
-                if len(listedvalues) > 0:
-                    slots_and_values.append((slotuse, listofvalues))
-                else:
-                    slots_and_values.append(("user_intent_history", "unknown_not_specific"))
-            # sometimes a comma isn't needed, for example if the user only listed 1 or 2 items
+            slotuse = dst["dialogue_state_history"][-1]
+            slots_and_values.append(("user_intent_history", slotuse))
+            # we only extract certain words from the input that meet the POS criteria based on what question
+            # is being answered (see clarification_pos).  If the input was already tagged as part of a batch,
+            # we can use those values
+            if listofvalues is None:
+                listofvalues = extract_listed_values([(input, clarification_pos[slotuse])])[0]
+            # a comma separated list always gets stored, even if nothing in it had the right POS tags
+            if len(listofvalues) > 0 or "," in input:
+                slots_and_values.append((slotuse, listofvalues))
             else:
-                # if the user listed only 2 items, most likely those 2 items are separated by "and"
-                if "and" in input:
-                    listedvalues = input.split(" and ")
-                    listofvalues = []
-                    for i in listedvalues:
-                        wordsList = nltk.word_tokenize(i)
-                        tagged = nltk.pos_tag(wordsList)
-                        toadd = ""
-                        for t in tagged:
-                            if t[1] in validpos:
-                                if len(toadd) <= 0:
-                                    toadd = t[0]
-                                else:
-                                    toadd = toadd + " " + t[0]
-                        if len(toadd) > 0:
-                            listofvalues.append(toadd)
-                    if len(listofvalues) > 0:
-                        slots_and_values.append((slotuse, listofvalues))
-                    else:
-                        slots_and_values.append(("user_intent_history", "unknown_not_specific"))
-                else:
-                    # most likely, the user only listed one thing
-                    wordsList = nltk.word_tokenize(input)
-                    tagged = nltk.pos_tag(wordsList)
-                    toadd = ""
-                    for t in tagged:
-                        if t[1] in validpos:
-                            if len(toadd) <= 0:
-                                toadd = t[0]
-                            else:
-                                toadd = toadd + " " + t[0]
-                    if len(toadd) > 0:
-                        slots_and_values.append((slotuse, [toadd]))
-                    else:
-                        slots_and_values.append(("user_intent_history", "unknown_not_specific"))
+                slots_and_values.append(("user_intent_history", "unknown_not_specific"))
         # we asked the user to give us a date and time for the appointment, so we assume we're getting a timeframe
-        elif dst["dialogue_state_history"][-1] == "create_appointment" or dst["dialogue_state_history"][-1] == "create_appointment_again":
-            # make sure the day is correct
-            patternday = re.compile(r"\b([Tt]oday)|([Tt]onight)|([Tt]omorrow)|((([Tt]his|[Nn]ext|[Tt]he following)(\s)+)?([Mm]on|[Tt]ues|[Ww]ednes|[Tt]hurs|[Ff]ri|[Ss]atur|[Ss]un)day)\b")
-            matchday = re.search(patternday, input)
-            if matchday:
-                indexofday = matchday.start()
-                lastindexofday = matchday.end()
-                # then make sure the time is valid
-                patterntime = re.compile(r"\b(((1[0-2])|[0-9])(:[0-5][0-9])?(\s)*([Aa][Mm]|[Pp][Mm]|(in the (morning|afternoon|evening)))|([Aa]fter)?[Nn]oon|[Mm]idnight)\b")
-                matchtime = re.search(patterntime, input)
-                if matchtime:
-                    lastindexoftime = matchtime.end()
-                    indexoftime = matchtime.start()
-                    user_intent = "give_time"
-                    slots_and_values.append(("user_intent_history", "respond_date_and_time"))
-                else:
-                    slots_and_values.append(("user_intent_history", "unknown_time"))
+        elif dst["dialogue_state_history"][-1] in ("create_appointment", "create_appointment_again", "no_openings"):
+            # make sure the day and the time are valid, and work out which datetime they mean
+            status, appointment = timeparse.resolve(input, now if now is not None else datetime.datetime.now())
+            if status == "ok":
+                user_intent = "give_time"
+                slots_and_values.append(("user_intent_history", "respond_date_and_time"))
             else:
-                slots_and_values.append(("user_intent_history", "unknown_day"))
+                slots_and_values.append(("user_intent_history", status))
         elif dst["dialogue_state_history"][-1] == "book_appointment":
             # most likely the user is saying thank you and goodbye or something like that
             slots_and_values.append(("user_intent_history", "goodbye"))
@@ -489,16 +972,14 @@ def nlu(input=""):
             # since the chatbot greeted the user and asked if he/she'd like to book an appointment
             # it's likely that the user is responding to that question
             # (Would be paired with yes/no questions subset, but made this modification in the end)
-            patternyes = re.compile(r"\b([Yy]e.*)|([Oo][Kk].*)|([Ss]ure)|([Yy]up)\b")
-            patternno = re.compile(r"\b([Nn]o.*)|([Dd]on't)|([Nn]a(h)+)\b")
-            matchyes = re.search(patternyes, input)
-            matchno = re.search(patternno, input)
-            if matchyes and matchno:
+            if answer is None:
+                answer = intent_matcher.greeting(input)
+            if answer == "ambiguous":
                 # gave yes and no in the same sentence, so the input isn't understandable
                 slots_and_values.append(("user_intent_history", "unknown_not_yes_no"))
-            elif matchyes:
+            elif answer == "yes":
                 slots_and_values.append(("user_intent_history", "greetings"))
-            elif matchno:
+            elif answer == "no":
                 slots_and_values.append(("user_intent_history", "early_exit"))
             else:
                 # if there isn't, we're not really sure what the user is trying to do
@@ -515,56 +996,563 @@ def nlu(input=""):
     # Then, based on what type of user intent you think the user had, you can determine which slot values
     # to try to extract.
     if user_intent == "answer_yes_no":
-        pattern = re.compile(r"\b([Yy]e.*)|([Oo]k.*)|([Ss]ure)|([Yy]up)\b")
-        answered_yes = re.search(pattern, input)
-
-        pattern = re.compile(r"\b([Nn]o.*)|([Nn]a(h)+)|([Dd]on't)\b")
-        answered_no = re.search(pattern, input)
-
-        if answered_yes and not answered_no:
-            slots_and_values.append((slotuse, "yes"))
-        elif answered_no:
-            slots_and_values.append((slotuse, "no"))
+        if answer == "yes" or answer == "no":
+            slots_and_values.append((slotuse, answer))
     elif user_intent == "give_time":
-        # we only want the parts that contain the date and time
-        # most likely, the user specified the time after the date
-        if indexofday < lastindexoftime:
-            slots_and_values.append(("date_and_time", input[indexofday:lastindexoftime]))
-        else:
-            # there are cases where the user specifies the time first before the day
-            slots_and_values.append(("date_and_time", input[indexoftime:lastindexofday]))
+        # this is the part of the input with the date and time in it, which also knows the datetime it means
+        slots_and_values.append(("date_and_time", appointment))
 
 
     return slots_and_values
 
 
-def main():
-    current_state_tracker = get_dst()
-    next_state, slot_values = dialogue_policy(current_state_tracker)
-    output = nlg(next_state, slot_values)
-    print(output)
+# The states where the user answers yes or no (the yes/no questions and the greeting)
+yes_no_states = frozenset(["symptoms", "family_history", "outside_contact", "other_issues", "confirm_appointment",
+                           "greetings"])
 
-    while next_state != "book_appointment" and next_state != "early_exit" and next_state != "unknown_question":
-        # Accept the user's input.
-        user_input = input("You: ")
+# The classifier that labels the yes/no answers of a batch, or None to use intent_matcher (see
+# enable_answer_classifier), and how confident it has to be for its label to be used instead of the matcher's.
+# It is off by default: its labels aren't always the ones the original patterns gave, so conversations can go
+# differently with it.
+answer_classifier = None
+answer_confidence = 0.8
+
+
+# enable_answer_classifier(confidence): Makes nlu_batch label yes/no answers with intent_classifier's model, all in
+#                                       one go.  Where the model is less confident than the threshold, the answer
+#                                       is left to intent_matcher.  On held-out answers, every threshold from 0.5 up
+#                                       labels at least as many answers right as the matcher alone, and higher ones
+#                                       change fewer of the matcher's labels (python benchmark.py classifier shows
+#                                       both); 0.8 only overrides the matcher where the model is quite sure.
+# Input: Optionally, how confident (0 to 1) the model has to be for its label to be used.
+# Returns: The intent_classifier.IntentClassifier, or None if NumPy isn't installed (intent_matcher is used then).
+def enable_answer_classifier(confidence=0.8):
+    global answer_classifier, answer_confidence
+    import intent_classifier
+    answer_confidence = confidence
+    answer_classifier = intent_classifier.load()
+    return answer_classifier
+
+
+# disable_answer_classifier(): Goes back to labelling every yes/no answer with intent_matcher.
+# Input: Nothing
+# Returns: Nothing
+def disable_answer_classifier():
+    global answer_classifier
+    answer_classifier = None
+
+
+# nlu_batch(requests): Runs nlu for the pending inputs of any number of sessions, POS tagging all of the
+#                      clarification answers among them in one batch (and, with the answer classifier enabled,
+#                      labelling all of the yes/no answers in another).
+# Input: A list of (dst, input, now) triples, where now is the datetime days are relative to (or None for now).
+# Returns: A list with the (slot, value) pairs for each of the inputs, in the same order.
+def nlu_batch(requests):
+    pending = []
+    yes_no = []
+    for k, (dst, input, now) in enumerate(requests):
+        if "dialogue_state_history" in dst:
+            if dst["dialogue_state_history"][-1] in clarification_pos:
+                pending.append((k, input, clarification_pos[dst["dialogue_state_history"][-1]]))
+            elif dst["dialogue_state_history"][-1] in yes_no_states:
+                yes_no.append(k)
+    extracted = extract_listed_values([(input, validpos) for k, input, validpos in pending])
+
+    listed = {}
+    for (k, input, validpos), listofvalues in zip(pending, extracted):
+        listed[k] = listofvalues
+    answers = {}
+    classifier = answer_classifier
+    if classifier is not None and len(yes_no) > 0:
+        found, confidences = classifier.classify_batch([requests[k][1] for k in yes_no])
+        for k, label, confidence in zip(yes_no, found, confidences):
+            # an answer the model isn't sure about is left to intent_matcher
+            if confidence >= answer_confidence:
+                answers[k] = "none" if label == "unclear" else label
+    return [nlu(dst, input, listed.get(k), now, answers.get(k)) for k, (dst, input, now) in enumerate(requests)]
+
+
+# The metrics every turn is recorded in, or None if they are turned off (see enable_metrics)
+metrics = None
+
+
+# enable_metrics(): Starts recording per-turn metrics for every session in this process.
+# Input: Nothing
+# Returns: The metrics.TurnMetrics the turns are recorded in.
+def enable_metrics():
+    global metrics
+    import metrics as metrics_module
+    if metrics is None:
+        metrics = metrics_module.TurnMetrics(list(unknowns) + ["create_appointment_again", "no_openings"])
+    return metrics
+
+
+# disable_metrics(): Stops recording per-turn metrics.
+# Input: Nothing
+# Returns: The metrics.TurnMetrics that were being recorded in, or None if they weren't turned on.
+def disable_metrics():
+    global metrics
+    recorder = metrics
+    metrics = None
+    return recorder
+
+
+# The profiler sampled turns are recorded in, or None if profiling is turned off (see enable_profiling)
+profiler = None
+
+
+# enable_profiling(rate, memory): Starts profiling a sample of the turns of every session in this process.
+# Input: The share of turns to profile (1 for all of them), and whether to trace their allocations too.
+# Returns: The profiling.TurnProfiler the turns are recorded in.
+def enable_profiling(rate=1.0, memory=True):
+    global profiler
+    import profiling
+    if profiler is None:
+        profiler = profiling.TurnProfiler(rate, memory)
+    return profiler
 
+
+# disable_profiling(): Stops profiling turns.
+# Input: Nothing
+# Returns: The profiling.TurnProfiler that was being recorded in, or None if profiling wasn't turned on.
+def disable_profiling():
+    global profiler
+    recorder = profiler
+    profiler = None
+    return recorder
+
+
+# profile_from_environment(): Turns profiling on as CHATBOT_PROFILE asks (with a warning, and every turn profiled,
+#                             if CHATBOT_PROFILE_RATE isn't a number).  Forked processes start with a copy of
+#                             this process's profiler, so they get a new one of their own, and since processes
+#                             started by multiprocessing leave with os._exit (which skips atexit), theirs is
+#                             written by one of multiprocessing's finalizers.
+# Input: Nothing
+# Returns: Nothing
+def profile_from_environment():
+    global profiler
+    import multiprocessing.util
+    profiler = None
+    setting = os.environ.get("CHATBOT_PROFILE_RATE", "1")
+    try:
+        rate = float(setting)
+        if not rate >= 0:
+            raise ValueError(setting)
+    except ValueError:
+        # a typo shouldn't keep the program from starting
+        print("CHATBOT_PROFILE_RATE should be the share of turns to profile, not %r; profiling every turn" % setting,
+              file=sys.stderr)
+        rate = 1.0
+    recorder = enable_profiling(rate)
+    if multiprocessing.parent_process() is None:
+        # (spawned processes get here too, since they import this module before they know their parent, but
+        # they leave with sys.exit, so atexit works for them)
+        atexit.register(write_profile, recorder)
+        multiprocessing.util.register_after_fork(profile_from_environment, lambda function: function())
+    else:
+        multiprocessing.util.Finalize(None, write_profile, args=(recorder,), exitpriority=0)
+
+
+# write_profile(recorder): Writes the profile report to the file CHATBOT_PROFILE names, with the process id after
+#                          the name if this is a worker process.
+# Input: The profiling.TurnProfiler.
+# Returns: Nothing
+def write_profile(recorder):
+    import multiprocessing
+    path = os.environ["CHATBOT_PROFILE"]
+    if multiprocessing.parent_process() is not None:
+        path += "." + str(os.getpid())
+    recorder.write(path)
+
+
+# Setting CHATBOT_PROFILE to a file name turns profiling on in any program that uses the chatbot (the server,
+# replays, ...), and the report is written there when the program exits.  CHATBOT_PROFILE_RATE is the share of
+# turns that are profiled.  Worker processes write their own report, with their process id after the name.
+if os.environ.get("CHATBOT_PROFILE"):
+    profile_from_environment()
+
+
+# nlu_branch(dst): Names the NLU branch the user's next input will go through, for the profiles.
+# Input: The dialogue state tracker of the conversation.
+# Returns: "clarification", "date/time", "yes/no", "greeting", "goodbye", or "start" before the conversation
+#          has started.
+def nlu_branch(dst):
+    if "dialogue_state_history" not in dst:
+        return "start"
+    question = dst["dialogue_state_history"][-1]
+    if question in clarification_pos:
+        return "clarification"
+    elif question in ("create_appointment", "create_appointment_again", "no_openings"):
+        return "date/time"
+    elif question == "greetings":
+        return "greeting"
+    elif question == "book_appointment":
+        return "goodbye"
+    return "yes/no"
+
+
+# States where the conversation is over and the chatbot doesn't expect any more input
+final_states = ["book_appointment", "early_exit", "unknown_question"]
+
+
+# DialogueSession: One conversation with one user.  It owns its own dialogue state tracker, so any number of
+# sessions can live side by side in the same process.  The clock is what days like "tomorrow" are relative to.
+# If the session is given an appointments.AppointmentCalendar (which can be shared by many sessions), the time
+# the user asks for is held in it while they confirm, and booked for good when they do.
+class DialogueSession:
+    def __init__(self, session_id=None, clock=datetime.datetime.now, calendar=None):
+        self.session_id = session_id
+        self.clock = clock
+        self.dst = new_dst()
+        self.state = None
+        self.policy_step = 0
+        self.calendar = calendar
+        # the (appointment time, slot start) the session is holding in the calendar, and the start of the slot
+        # once it is booked
+        self.hold = None
+        self.appointment = None
+
+    # start(): Generates the chatbot's opening utterance.
+    # Input: Nothing
+    # Returns: A string containing the chatbot's first utterance.
+    def start(self):
+        return self.respond([])
+
+    # turn(user_input, listofvalues, started): Runs one full nlu -> update_dst -> dialogue_policy -> nlg turn for
+    #                                          this session (profiling it, if profiling is on, it is sampled, and
+#                                          no other turn is being profiled).
+    # Input: A string containing the user's input, optionally the values already extracted from it if it is a
+    #        clarification answer that was tagged elsewhere (see nlu), and optionally when the turn started (a
+    #        time.perf_counter() value), if metrics are being recorded and the turn started before this call.
+    # Returns: A string containing the chatbot's response.
+    def turn(self, user_input, listofvalues=None, started=None):
+        recorder = profiler
+        if recorder is None or not recorder.sample():
+            return self.run_turn(user_input, listofvalues, started)
+        branch = nlu_branch(self.dst)
+        recording = recorder.start()
+        if recording is None:
+            return self.run_turn(user_input, listofvalues, started)
+        try:
+            output = self.run_turn(user_input, listofvalues, started)
+        finally:
+            recorder.stop(recording, branch, self.state)
+        return output
+
+    # run_turn(user_input, listofvalues, started): Runs the turn itself.
+    # Input: The same as turn.
+    # Returns: A string containing the chatbot's response.
+    def run_turn(self, user_input, listofvalues=None, started=None):
         # Perform natural language understanding on the user's input.
-        slots_and_values = nlu(user_input)
+        if metrics is None:
+            return self.respond(nlu(self.dst, user_input, listofvalues, self.clock()))
+        start = time.perf_counter()
+        slots_and_values = nlu(self.dst, user_input, listofvalues, self.clock())
+        metrics.observe("nlu", time.perf_counter() - start)
+        return self.respond(slots_and_values, start if started is None else started)
 
-        # Store the extracted slots and values in the dialogue state tracker.
-        update_dst(slots_and_values)
+    # respond(slots_and_values, started): Runs the rest of a turn once the user's input has been understood.
+    # Input: The list of (slot, value) pairs nlu extracted from the user's input, and optionally when the turn
+    #        started (a time.perf_counter() value), if metrics are being recorded.
+    # Returns: A string containing the chatbot's response.
+    def respond(self, slots_and_values, started=None):
+        if metrics is not None:
+            return self.respond_measured(slots_and_values, started)
 
-        # Get the full contents of the dialogue state tracker at this time.
-        current_state_tracker = get_dst()
+        # Store the extracted slots and values in the dialogue state tracker.
+        update_dst(self.dst, slots_and_values)
 
         # Determine which state the chatbot should enter next.
-        next_state, slot_values = dialogue_policy(current_state_tracker)
+        self.state, slot_values, self.policy_step, updates = next_state(self.dst, self.policy_step)
+        update_dst(self.dst, updates)
+        if self.calendar is not None:
+            self.state, slot_values = self.schedule(self.state, slot_values)
 
         # Generate a natural language realization for the specified state and slot values.
-        output = nlg(next_state, slot_values)
+        return nlg(self.dst, self.state, slot_values)
+
+    # respond_measured(slots_and_values, started): The same as respond, but times every stage and counts the
+    #                                              intents and states for the metrics.
+    # Input: The list of (slot, value) pairs nlu extracted, and when the turn started (or None).
+    # Returns: A string containing the chatbot's response.
+    def respond_measured(self, slots_and_values, started):
+        recorder = metrics
+        start = time.perf_counter()
+        if started is None:
+            started = start
+        update_dst(self.dst, slots_and_values)
+        updated = time.perf_counter()
+        self.state, slot_values, self.policy_step, updates = next_state(self.dst, self.policy_step)
+        update_dst(self.dst, updates)
+        if self.calendar is not None:
+            self.state, slot_values = self.schedule(self.state, slot_values)
+        decided = time.perf_counter()
+        output = nlg(self.dst, self.state, slot_values)
+        done = time.perf_counter()
+
+        recorder.observe("update_dst", updated - start)
+        recorder.observe("dialogue_policy", decided - updated)
+        recorder.observe("nlg", done - decided)
+        recorder.observe("turn", done - started)
+        recorder.count_turn(slots_and_values, self.state)
+        return output
+
+    # schedule(state, slot_values): Checks the state the policy chose against the calendar.  When the user is
+    #                               about to be asked to confirm a time, the nearest free slot is held for them,
+    #                               and if that isn't the time they asked for, they are offered it instead.
+    # Input: The state the dialogue policy chose, and the (slot, value) pairs for it.
+    # Returns: The state the chatbot should really go into, and the (slot, value) pairs for it.
+    def schedule(self, state, slot_values):
+        if state == "confirm":
+            appointment = self.dst["date_and_time"]
+            when = getattr(appointment, "when", None)
+            # asking again about the same time (or a time we couldn't resolve) doesn't change what is held
+            if when is None or (self.hold is not None and self.hold[0] is appointment):
+                return state, slot_values
+            self.release()
+            start = self.calendar.reserve_nearest(when, self.session_id, not_before=self.clock())
+            if start is None:
+                return "no_openings", []
+            if self.calendar.slot_of(start) == self.calendar.slot_of(when):
+                self.hold = (appointment, start)
+                return state, slot_values
+            # the time they asked for is taken, so offer the one we found (which is what gets confirmed now)
+            suggestion = timeparse.AppointmentTime(appointments.describe(start), start)
+            update_dst(self.dst, [("date_and_time", suggestion)])
+            self.hold = (suggestion, start)
+            return "suggest_time", [("date_and_time", suggestion)]
+        elif state == "create_appointment_again":
+            # they didn't want the time, so someone else can have it
+            self.release()
+        elif state == "book_appointment" and self.hold is None:
+            # the time they confirmed isn't held (it was let go when the process restarted), so it has to be
+            # checked again, and if someone else got it in the meantime, they're offered the nearest one instead
+            appointment = self.dst["date_and_time"]
+            if getattr(appointment, "when", None) is None:
+                return state, slot_values
+            checked, suggested = self.schedule("confirm", [("date_and_time", appointment)])
+            if checked != "confirm":
+                return checked, suggested
+            self.appointment = self.hold[1]
+        elif state == "book_appointment":
+            self.appointment = self.hold[1]
+        return state, slot_values
+
+    # resume(): Picks a conversation back up after it was rebuilt from a journal.  If the user was about to
+    #           confirm a time, it is held for them again, as long as nobody else has taken it since.
+    # Input: Nothing
+    # Returns: Nothing
+    def resume(self):
+        if "dialogue_state_history" in self.dst:
+            self.state = self.dst["dialogue_state_history"][-1]
+        if self.calendar is None or self.state != "confirm_appointment":
+            return
+        appointment = self.dst["date_and_time"]
+        when = getattr(appointment, "when", None)
+        if when is None or when < self.clock():
+            return
+        if self.calendar.reserve(when, self.session_id):
+            self.hold = (appointment, self.calendar.start_of(*self.calendar.slot_of(when)))
+
+    # question(): The question the conversation is waiting on an answer to, for asking it again (when the
+    #             conversation is picked up from a journal).  Nothing is added to the dialogue state.
+    # Input: Nothing
+    # Returns: A string containing the question (without "Chatbot: " in front), or None if the conversation
+    #          hasn't started or is over.
+    def question(self):
+        if self.state is None or self.finished:
+            return None
+        # the confirmation is the only question that is filed under another name
+        question = "confirm" if self.state == "confirm_appointment" else self.state
+        values = {"date_time": self.dst["date_and_time"]} if "date_and_time" in self.dst else {}
+        return render_template(compiled_templates[question][0], values)
+
+    # release(): Lets go of the slot the session is holding, unless it has been booked.
+    # Input: Nothing
+    # Returns: Nothing
+    def release(self):
+        if self.hold is not None and self.appointment is None:
+            self.calendar.release(self.hold[1], self.session_id)
+        self.hold = None
+
+    # close(): Ends the session.  A slot that was held but never booked is freed up.
+    # Input: Nothing
+    # Returns: Nothing
+    def close(self):
+        if self.calendar is not None:
+            self.release()
+
+    # finished: True once the conversation has reached a state that doesn't expect any more input.
+    @property
+    def finished(self):
+        return self.state in final_states
+
+
+# SessionRegistry: Holds all the live sessions of one process, keyed by session id.  Creating, looking up and
+# closing sessions is thread-safe; a single session should only be driven by one caller at a time.  If a calendar
+# is given, every session books its appointment in it.  If a journal.Journal is given, every session is written
+# to it, and the conversations that were still going when the journal was last written to are picked up again,
+# in the order they were last written to (the calendar only lives in memory, so a time a conversation was
+# confirming is held again if it's still free, and checked again when it's confirmed if it isn't; see
+# DialogueSession.resume).  Conversations that were over but hadn't been closed yet are closed right away.  If an
+# export.Exporter is given, every conversation that is over is added to it when it's closed.
+class SessionRegistry:
+    def __init__(self, calendar=None, journal=None, exporter=None):
+        self.calendar = calendar
+        self.journal = journal
+        self.exporter = exporter
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        if journal is not None:
+            recovered = journal.recover()
+            for session_id, dst in recovered.items():
+                session = DialogueSession(session_id, calendar=calendar)
+                session.dst = dst
+                session.resume()
+                self.sessions[session_id] = session
+            journal.open(recovered)
+            for session_id in [session_id for session_id, session in self.sessions.items() if session.finished]:
+                self.close(session_id)
+
+    # create(session_id): Starts a new session.
+    # Input: Optionally, the id to use for the session.  One is generated if none is given.
+    # Returns: The new DialogueSession.
+    def create(self, session_id=None):
+        with self.lock:
+            if session_id is None:
+                session_id = next(self.ids)
+                while session_id in self.sessions:
+                    session_id = next(self.ids)
+            elif session_id in self.sessions:
+                raise KeyError("session " + str(session_id) + " already exists")
+            session = DialogueSession(session_id, calendar=self.calendar)
+            self.sessions[session_id] = session
+        if self.journal is not None:
+            self.journal.attach(session_id, session.dst)
+        return session
+
+    # get(session_id): Looks up a live session.
+    # Input: The id of the session.
+    # Returns: The DialogueSession, or None if there is no live session with that id.
+    def get(self, session_id):
+        return self.sessions.get(session_id)
+
+    # close(session_id): Closes a session and drops it from the registry.
+    # Input: The id of the session.
+    # Returns: The DialogueSession that was closed, or None if there was no such session.
+    def close(self, session_id):
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        if session is not None:
+            session.close()
+            if self.journal is not None:
+                self.journal.detach(session_id)
+            if self.exporter is not None and session.finished:
+                self.exporter.add(session)
+        return session
+
+    # close_all(): Closes every live session, for example the ones recovered from the journal when nobody can get
+    #              back to them (the simulated patients of a load test that was cut off are gone along with it).
+    # Input: Nothing
+    # Returns: The number of sessions that were closed.
+    def close_all(self):
+        with self.lock:
+            session_ids = list(self.sessions)
+        for session_id in session_ids:
+            self.close(session_id)
+        return len(session_ids)
+
+    # turn(session_id, user_input): Runs one turn for the given session, closing it once the conversation is over.
+    # Input: The id of the session and a string containing the user's input.
+    # Returns: A string containing the chatbot's response.
+    def turn(self, session_id, user_input):
+        session = self.sessions[session_id]
+        output = session.turn(user_input)
+        if session.finished:
+            self.close(session_id)
+        return output
+
+    # turn_batch(turns): Runs one turn for each of the given sessions, POS tagging all of their clarification
+    #                    answers together (see nlu_batch).  Finished sessions are closed.
+    # Input: A list of (session_id, user_input) pairs, with each session appearing at most once.
+    # Returns: A list with the chatbot's response for each of the turns, in the same order.
+    def turn_batch(self, turns):
+        sessions = [self.sessions[session_id] for session_id, user_input in turns]
+        recorder = metrics
+        start = time.perf_counter()
+        understood = nlu_batch([(session.dst, user_input, session.clock())
+                                for session, (session_id, user_input) in zip(sessions, turns)])
+        if recorder is not None and len(turns) > 0:
+            # the batch is understood all at once, so every turn in it gets its share of the time
+            share = (time.perf_counter() - start) / len(turns)
+            for k in range(len(turns)):
+                recorder.observe("nlu", share)
+        outputs = []
+        for session, slots_and_values in zip(sessions, understood):
+            outputs.append(session.respond(slots_and_values, start))
+            if session.finished:
+                self.close(session.session_id)
+        return outputs
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self.sessions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Book an appointment with Dr. Peng's office.")
+    parser.add_argument("--preload", action="store_true", help="load the tokenizer and tagger before starting")
+    parser.add_argument("--calendar", action="store_true",
+                        help="check the time asked for against the office's calendar, and suggest another if it's closed")
+    parser.add_argument("--metrics", metavar="FILE", help="record per-turn metrics and write them to FILE on exit")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="profile the turns by dialogue state and NLU branch, and write the report to FILE on exit")
+    parser.add_argument("--profile-rate", type=float, default=1.0, help="share of turns to profile with --profile")
+    parser.add_argument("--export", metavar="DIRECTORY", help="add the finished conversation to the export in DIRECTORY")
+    parser.add_argument("--journal", metavar="FILE",
+                        help="write the conversation to the journal in FILE, and pick up the one that was cut off there")
+    args = parser.parse_args()
+    if args.preload:
+        preload()
+    if args.metrics:
+        atexit.register(enable_metrics().write, args.metrics)
+    if args.profile:
+        atexit.register(enable_profiling(args.profile_rate).write, args.profile)
+
+    calendar = appointments.AppointmentCalendar() if args.calendar else None
+    if args.journal:
+        import journal
+        conversations = journal.Journal(args.journal)
+        registry = SessionRegistry(calendar=calendar, journal=conversations)
+        # the conversation that was cut off last is picked up where it was, by asking its last question again
+        session = registry.get(next(reversed(registry.sessions))) if len(registry) > 0 else None
+        if session is None or session.question() is None:
+            session = registry.create()
+            print(session.start())
+        else:
+            print("Chatbot: Sorry, we got cut off. " + session.question())
+    else:
+        session = DialogueSession(calendar=calendar)
+        print(session.start())
+
+    while not session.finished:
+        # Accept the user's input.
+        user_input = input("You: ")
+
+        # Run the turn and print the chatbot's response to the terminal.
+        print(session.turn(user_input))
+
+    if args.journal:
+        registry.close(session.session_id)
+        conversations.close()
 
-        # Print the output to the terminal.
-        print(output)
+    if args.export:
+        import export
+        with export.Exporter(args.export) as exporter:
+            exporter.add(session)
 
 ################ Do not make any changes below this line ################
 if __name__ == '__main__':
@@ -0,0 +1,474 @@
+# Export of finished conversations, for analysis: the intake answers (the yes/no answers, the lists given when
+# asked to clarify them, and the appointment time) of every conversation that is over, in a columnar format
+# that can be read back with memory maps for quick aggregate queries, like the top symptoms of the week.
+#
+# An export is a directory with one file per column, each a flat array of fixed-size numbers that every batch of
+# conversations is appended to:
+#     finished.q, appointment.q       when the conversation was over, and the appointment it booked (Unix seconds,
+#                                     -1 if none)
+#     state.i                         the state the conversation ended in, as a code into the dictionary
+#     session.text.B,                 the session id, and the appointment time as the user said it, as UTF-8 text
+#     session.ends.q, date_and_time.* one after the other, and where each conversation's text ends (no text for none)
+#     symptoms.b, ...                 the answers to the yes/no questions (1 yes, 0 no, -1 not asked)
+#     clarify_symptoms.values.i,      the listed values of every conversation, one after the other, as codes into
+#     clarify_symptoms.ends.q, ...    the dictionary (in lowercase), and where each conversation's values end
+#     dictionary.txt                  every string the codes stand for, one JSON string per line (code = line)
+#     manifest.json                   how many conversations, strings and column entries are written in full
+# The letter at the end is the array type code (q: 8 bytes, i: 4 bytes, b and B: 1 byte), in the byte order in the
+# manifest.  Only values that repeat a lot (states, symptoms, people) go in the dictionary, so it stays small
+# however many conversations there are; the ones that are (nearly) different every time are stored as text.  The manifest is only replaced once everything it counts is on disk, so a reader (or a writer picking
+# the export up again) ignores whatever a crash left half written after it.
+# Writing happens in a background thread, in big batches, so adding a conversation only puts it on a queue.
+# Reading needs NumPy.
+# Usage: python export.py EXPORT_DIRECTORY [--since DATE] [--until DATE] [--slot SLOT] [--top N]
+import argparse
+import array
+import datetime
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+yes_no_slots = ("symptoms", "family_history", "outside_contact", "other_issues")
+list_slots = ("clarify_symptoms", "clarify_family_history", "clarify_outside_contact", "clarify_other_issues")
+
+# column name -> array type code, for the columns with one number per conversation
+row_columns = {"finished": "q", "appointment": "q", "state": "i"}
+row_columns.update((slot, "b") for slot in yes_no_slots)
+
+# The columns with a piece of text per conversation
+text_columns = ("session", "date_and_time")
+
+# The version of the layout above, which the manifest records
+export_format = 2
+
+# The answers to the yes/no questions, as they are stored
+yes_no_codes = {"yes": 1, "no": 0}
+
+# The NumPy types of the array type codes
+numpy_types = {"q": "i8", "i": "i4", "b": "i1", "B": "u1"}
+
+
+# column_files(): Every column file of an export, with its array type code.
+# Input: Nothing
+# Returns: A dictionary of file name -> type code.
+def column_files():
+    files = {name + "." + code: code for name, code in row_columns.items()}
+    for name in text_columns:
+        files[name + ".text.B"] = "B"
+        files[name + ".ends.q"] = "q"
+    for slot in list_slots:
+        files[slot + ".values.i"] = "i"
+        files[slot + ".ends.q"] = "q"
+    return files
+
+
+# session_row(session, finished): Takes the intake answers out of a finished conversation.
+# Input: A chatbot.DialogueSession, and when it was over (Unix seconds; defaults to now).
+# Returns: A tuple that Exporter can write: (finished, appointment, session id, state, date and time text,
+#          the yes/no answers, the listed values).
+def session_row(session, finished=None):
+    dst = session.dst
+    appointment = session.appointment
+    if appointment is None and "date_and_time" in dst:
+        appointment = getattr(dst["date_and_time"], "when", None)
+    return (time.time() if finished is None else finished,
+            -1 if appointment is None else int(appointment.timestamp()),
+            None if session.session_id is None else str(session.session_id), session.state,
+            str(dst["date_and_time"]) if "date_and_time" in dst else None,
+            tuple(yes_no_codes.get(dst[slot], -1) if slot in dst else -1 for slot in yes_no_slots),
+            tuple(list(dst[slot]) if slot in dst else [] for slot in list_slots))
+
+
+# read_manifest(path): Reads how much of an export is written in full.
+# Input: The directory of the export.
+# Returns: The manifest as a dictionary (an empty one if nothing has been written yet).
+def read_manifest(path):
+    try:
+        with open(os.path.join(path, "manifest.json")) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {"format": export_format, "rows": 0, "strings": 0, "byteorder": sys.byteorder,
+                "lengths": dict.fromkeys(column_files(), 0)}
+
+
+# read_dictionary(path, count): Reads the strings of an export's dictionary.
+# Input: The directory of the export, and how many strings the manifest says are written in full.
+# Returns: A list of the strings, in code order, and how many bytes of the file they take up.
+def read_dictionary(path, count):
+    strings = []
+    length = 0
+    dictionary_path = os.path.join(path, "dictionary.txt")
+    if os.path.exists(dictionary_path):
+        with open(dictionary_path, "rb") as dictionary_file:
+            for line in dictionary_file:
+                if len(strings) == count:
+                    break
+                strings.append(json.loads(line))
+                length += len(line)
+    return strings, length
+
+
+# check_manifest(path, manifest): Makes sure an export has the layout this module reads and writes.
+# Input: The directory of the export, and its manifest.
+# Returns: Nothing (a ValueError is raised if the export was written in another format).
+def check_manifest(path, manifest):
+    if manifest.get("format", 1) != export_format:
+        raise ValueError("the export in %s is in format %d, not %d" % (path, manifest.get("format", 1), export_format))
+
+
+# seconds_of(when): Turns a time given to a query into Unix seconds.
+# Input: A datetime.datetime, a datetime.date (its midnight), or a number of Unix seconds.
+# Returns: The number of seconds.
+def seconds_of(when):
+    if isinstance(when, datetime.datetime):
+        return when.timestamp()
+    elif isinstance(when, datetime.date):
+        return datetime.datetime.combine(when, datetime.time()).timestamp()
+    return when
+
+
+# Exporter: Appends finished conversations to an export (a new one, or one that was written to before).  add()
+# can be called from any thread, and only puts the conversation on a queue; a background thread writes them out
+# every flush_rows conversations, or every flush_interval seconds, whichever comes first.
+class Exporter:
+    def __init__(self, path, flush_rows=8192, flush_interval=1.0):
+        self.path = path
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        os.makedirs(path, exist_ok=True)
+        self.manifest = read_manifest(path)
+        check_manifest(path, self.manifest)
+        if self.manifest["byteorder"] != sys.byteorder:
+            raise ValueError("the export in " + path + " was written on a machine with a different byte order")
+        strings, self.dictionary_length = read_dictionary(path, self.manifest["strings"])
+        self.strings = {string: code for code, string in enumerate(strings)}
+        # whatever comes after what the manifest counts is dropped, so appending carries on right after it
+        self.files = {}
+        self.dictionary = None
+        self.rollback()
+        self.queue = queue.SimpleQueue()
+        # the last error writing a batch, if there was one, and whether the files may still have some of a batch
+        # that couldn't be written after what the manifest counts
+        self.error = None
+        self.damaged = False
+        self.thread = threading.Thread(target=self.run, name="export", daemon=True)
+        self.thread.start()
+
+    # add(session, finished): Queues a finished conversation to be written.  Its answers are only taken out of it
+    #                          by the background thread, which is fine since a conversation that is over doesn't
+    #                          change any more.
+    # Input: A chatbot.DialogueSession, and optionally when it was over (Unix seconds; defaults to now).
+    # Returns: Nothing
+    def add(self, session, finished=None):
+        self.queue.put((session, time.time() if finished is None else finished))
+
+    # flush(): Waits until everything added so far is written.
+    # Input: Nothing
+    # Returns: Nothing (the error is raised if a batch couldn't be written).
+    def flush(self):
+        written = threading.Event()
+        self.queue.put(written)
+        written.wait()
+        if self.error is not None:
+            raise self.error
+
+    # close(): Writes everything added so far, and stops the background thread.
+    # Input: Nothing
+    # Returns: Nothing (the error is raised if a batch couldn't be written).
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        for column_file in self.files.values():
+            column_file.close()
+        self.dictionary.close()
+        if self.error is not None:
+            raise self.error
+
+    # run(): The background thread: collects the queued conversations, and writes them in batches.  Besides the
+    #        conversations, the queue can have a threading.Event on it, which is set once everything before it is
+    #        written, or None, which stops the thread (after writing everything).
+    # Input: Nothing
+    # Returns: Nothing
+    def run(self):
+        pending = []
+        oldest = 0.0
+        while True:
+            # no conversation waits more than flush_interval seconds to be written
+            try:
+                item = self.queue.get(timeout=None if len(pending) == 0
+                                      else max(oldest + self.flush_interval - time.monotonic(), 0))
+            except queue.Empty:
+                item = ()
+            if type(item) is tuple:
+                # a conversation and when it was over (or nothing, if the wait ran out)
+                if len(item) > 0:
+                    if len(pending) == 0:
+                        oldest = time.monotonic()
+                    pending.append(item)
+                if len(pending) < self.flush_rows and time.monotonic() < oldest + self.flush_interval:
+                    continue
+            if len(pending) > 0:
+                try:
+                    self.write(pending)
+                except Exception as error:
+                    # the batch is lost, but the turns go on (and this thread too, or whoever is waiting in flush
+                    # or close would wait forever); flush and close say so
+                    self.error = error
+                    self.forget()
+                pending = []
+            if item is None:
+                return
+            elif isinstance(item, threading.Event):
+                item.set()
+
+    # forget(): Undoes a batch that couldn't be written: the strings it added to the dictionary are dropped, and
+    #           whatever it got into the files is cut off (or, if that fails too, before the next batch is written).
+    # Input: Nothing
+    # Returns: Nothing
+    def forget(self):
+        for string, code in list(self.strings.items()):
+            if code >= self.manifest["strings"]:
+                del self.strings[string]
+        self.damaged = True
+        try:
+            self.rollback()
+        except OSError:
+            pass
+
+    # rollback(): Cuts every file back to what the manifest counts, and reopens it for appending after that.  The
+    #             files are reopened, so nothing a failed write left in their buffers gets written later on.
+    # Input: Nothing
+    # Returns: Nothing
+    def rollback(self):
+        lengths = {name: self.manifest["lengths"][name] * array.array(code).itemsize
+                   for name, code in column_files().items()}
+        lengths["dictionary.txt"] = self.dictionary_length
+        for name, length in lengths.items():
+            previous = self.dictionary if name == "dictionary.txt" else self.files.get(name)
+            if previous is not None:
+                try:
+                    previous.close()
+                except OSError:
+                    pass
+            reopened = open(os.path.join(self.path, name), "ab")
+            reopened.truncate(length)
+            if name == "dictionary.txt":
+                self.dictionary = reopened
+            else:
+                self.files[name] = reopened
+        self.damaged = False
+
+    # code(string): The dictionary code of a string, adding it to the dictionary if it's new.  Only the
+    #               background thread uses this.
+    # Input: A string, or None.
+    # Returns: The code, or -1 for None.
+    def code(self, string):
+        if string is None:
+            return -1
+        found = self.strings.get(string)
+        if found is None:
+            found = self.strings[string] = len(self.strings)
+            self.dictionary.write(json.dumps(string).encode("utf-8") + b"\n")
+        return found
+
+    # write(pending): Appends a batch of conversations to the export, with one write per column.
+    # Input: A list of (chatbot.DialogueSession, when it was over) pairs.
+    # Returns: Nothing
+    def write(self, pending):
+        if self.damaged:
+            self.rollback()
+        rows = [session_row(session, finished) for session, finished in pending]
+        columns = {name: array.array(code) for name, code in column_files().items()}
+        finished = columns["finished.q"]
+        appointment = columns["appointment.q"]
+        state = columns["state.i"]
+        answers = [columns[slot + ".b"] for slot in yes_no_slots]
+        texts = [columns[name + ".text.B"] for name in text_columns]
+        text_ends = [columns[name + ".ends.q"] for name in text_columns]
+        values = [columns[slot + ".values.i"] for slot in list_slots]
+        ends = [columns[slot + ".ends.q"] for slot in list_slots]
+        # the text and values of this batch go after the ones already written
+        text_before = [self.manifest["lengths"][name + ".text.B"] for name in text_columns]
+        before = [self.manifest["lengths"][slot + ".values.i"] for slot in list_slots]
+        for row in rows:
+            finished.append(int(row[0]))
+            appointment.append(row[1])
+            state.append(self.code(row[3]))
+            for k, text in enumerate((row[2], row[4])):
+                if text is not None:
+                    texts[k].frombytes(text.encode("utf-8"))
+                text_ends[k].append(text_before[k] + len(texts[k]))
+            for column, answer in zip(answers, row[5]):
+                column.append(answer)
+            for k, listed in enumerate(row[6]):
+                # the values are counted the same whatever their case
+                values[k].extend([self.code(value.lower()) for value in listed])
+                ends[k].append(before[k] + len(values[k]))
+
+        # the data first, then the manifest that counts it
+        self.dictionary.flush()
+        os.fsync(self.dictionary.fileno())
+        lengths = dict(self.manifest["lengths"])
+        for name, column in columns.items():
+            column.tofile(self.files[name])
+            self.files[name].flush()
+            os.fsync(self.files[name].fileno())
+            lengths[name] += len(column)
+        manifest = {"format": export_format, "rows": self.manifest["rows"] + len(rows), "strings": len(self.strings),
+                    "byteorder": sys.byteorder, "lengths": lengths}
+        temporary = os.path.join(self.path, "manifest.json.tmp")
+        with open(temporary, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.replace(temporary, os.path.join(self.path, "manifest.json"))
+        self.manifest = manifest
+        self.dictionary_length = self.dictionary.tell()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+# ExportReader: An export, memory-mapped as it was when the reader was made (anything written after that needs a
+# new reader).  The columns are NumPy arrays straight over the files, so queries only read what they look at.
+class ExportReader:
+    def __init__(self, path):
+        if numpy is None:
+            raise RuntimeError("reading an export needs NumPy")
+        self.manifest = read_manifest(path)
+        check_manifest(path, self.manifest)
+        self.rows = self.manifest["rows"]
+        self.strings = read_dictionary(path, self.manifest["strings"])[0]
+        order = "<" if self.manifest["byteorder"] == "little" else ">"
+        self.columns = {}
+        for name, code in column_files().items():
+            length = self.manifest["lengths"][name]
+            kind = numpy.dtype(order + numpy_types[code])
+            if length == 0:
+                # an empty file can't be memory-mapped
+                self.columns[name] = numpy.zeros(0, kind)
+            else:
+                self.columns[name] = numpy.memmap(os.path.join(path, name), kind, "r", shape=(length,))
+
+    # column(name): One of the columns with one number per conversation.
+    # Input: The name of the column (see row_columns).
+    # Returns: A NumPy array with an entry for every conversation.
+    def column(self, name):
+        return self.columns[name + "." + row_columns[name]]
+
+    # text(name, k): The text one conversation has in a text column.
+    # Input: One of the text_columns, and the number of the conversation.
+    # Returns: A string, or None if the conversation has none.
+    def text(self, name, k):
+        ends = self.columns[name + ".ends.q"]
+        start = int(ends[k - 1]) if k > 0 else 0
+        if start == int(ends[k]):
+            return None
+        return self.columns[name + ".text.B"][start:int(ends[k])].tobytes().decode("utf-8")
+
+    # select(since, until, by): Picks out the conversations in a span of time.
+    # Input: The start and the end of the span (see seconds_of; either can be None to leave it open), and
+    #        whether it is when the conversations were over ("finished") or their appointments ("appointment").
+    # Returns: A NumPy array of booleans, one for every conversation.
+    def select(self, since=None, until=None, by="finished"):
+        when = self.column(by)
+        selected = numpy.ones(self.rows, dtype=bool)
+        if since is not None:
+            selected &= when >= seconds_of(since)
+        if until is not None:
+            selected &= when < seconds_of(until)
+        return selected
+
+    # listed(slot, selected): The codes of the values listed in some conversations.
+    # Input: One of the list_slots, and optionally which conversations (from select; all of them if None).
+    # Returns: A NumPy array of dictionary codes.
+    def listed(self, slot, selected=None):
+        values = self.columns[slot + ".values.i"]
+        if selected is None:
+            return values
+        ends = self.columns[slot + ".ends.q"]
+        counts = numpy.diff(ends, prepend=ends.dtype.type(0))
+        # every value is kept if its conversation is
+        return values[numpy.repeat(selected, counts)]
+
+    # top_values(slot, since, until, count, by): The values listed most often in a span of time.
+    # Input: One of the list_slots, the span (see select), and how many values to give.
+    # Returns: A list of (value, number of times) pairs, the most common first.
+    def top_values(self, slot, since=None, until=None, count=10, by="finished"):
+        selected = None if since is None and until is None else self.select(since, until, by)
+        tally = numpy.bincount(self.listed(slot, selected), minlength=len(self.strings))
+        top = numpy.argsort(-tally, kind="stable")[:count]
+        return [(self.strings[code], int(tally[code])) for code in top if tally[code] > 0]
+
+    # top_symptoms(since, until, count): The symptoms listed most often by the conversations that were over in a
+    #                                    span of time.
+    # Input: The start and end of the span (see select), and how many symptoms to give.
+    # Returns: A list of (symptom, number of times) pairs, the most common first.
+    def top_symptoms(self, since=None, until=None, count=10):
+        return self.top_values("clarify_symptoms", since, until, count)
+
+    # answers(slot, since, until, by): How a yes/no question was answered in a span of time.
+    # Input: One of the yes_no_slots, and the span (see select).
+    # Returns: A dictionary with the number of "yes", "no" and "not asked" answers.
+    def answers(self, slot, since=None, until=None, by="finished"):
+        tally = numpy.bincount(self.column(slot)[self.select(since, until, by)] + 1, minlength=3)
+        return {"yes": int(tally[2]), "no": int(tally[1]), "not asked": int(tally[0])}
+
+    # row(k): One conversation, the way it was exported.
+    # Input: The number of the conversation (0 is the first one written).
+    # Returns: A dictionary of column -> value.
+    def row(self, k):
+        decoded = {}
+        for name in row_columns:
+            value = int(self.column(name)[k])
+            if name == "state":
+                value = None if value < 0 else self.strings[value]
+            decoded[name] = value
+        for name in text_columns:
+            decoded[name] = self.text(name, k)
+        for slot in list_slots:
+            ends = self.columns[slot + ".ends.q"]
+            start = int(ends[k - 1]) if k > 0 else 0
+            decoded[slot] = [self.strings[code] for code in self.columns[slot + ".values.i"][start:int(ends[k])]]
+        return decoded
+
+    def __len__(self):
+        return self.rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query an export of finished conversations.")
+    parser.add_argument("path", help="the export's directory")
+    parser.add_argument("--since", type=datetime.date.fromisoformat,
+                        help="first day to count (default: the start of this week)")
+    parser.add_argument("--until", type=datetime.date.fromisoformat, help="day to stop counting at (not counted)")
+    parser.add_argument("--slot", default="clarify_symptoms", choices=list_slots, help="which lists to count")
+    parser.add_argument("--top", type=int, default=10, help="how many values to show")
+    args = parser.parse_args()
+
+    since = args.since
+    if since is None:
+        today = datetime.date.today()
+        since = today - datetime.timedelta(days=today.weekday())
+    reader = ExportReader(args.path)
+    selected = reader.select(since, args.until)
+    print("%d of %d conversations finished since %s%s" % (selected.sum(), len(reader), since,
+                                                         "" if args.until is None else " until " + str(args.until)))
+    for value, times in reader.top_values(args.slot, since, args.until, args.top):
+        print("%8d  %s" % (times, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+# A small linear classifier for answers to the chatbot's yes/no questions (and its greeting), for labelling
+# many pending answers at once.  Every answer is turned into hashed character n-gram counts, and a softmax
+# model trained on the labeled answers in intent_corpus.tsv says whether it means yes, no, or neither (unclear),
+# and how sure it is.  All of that happens in a few NumPy operations over the whole batch, instead of a regex
+# search per answer.  NumPy is optional: without it, the answers are labelled by the regex intent matcher.
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import chatbot
+
+labels = ("yes", "no", "unclear")
+
+# The labeled answers the model is trained on
+corpus_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_corpus.tsv")
+
+# How many hashed features there are (2 ** feature_bits), which n-gram sizes are hashed, and how much of an
+# answer is looked at
+feature_bits = 12
+dimensions = 1 << feature_bits
+ngram_sizes = (1, 2, 3, 4)
+max_length = 64
+
+
+# read_corpus(path): Reads the labeled answers.
+# Input: The path of a file with one label<TAB>answer pair per line (lines starting with # are comments).
+# Returns: A list of (label, answer) pairs.
+def read_corpus(path=corpus_path):
+    examples = []
+    with open(path, encoding="utf-8") as corpus:
+        for line in corpus:
+            line = line.rstrip("\n")
+            if len(line) == 0 or line.startswith("#"):
+                continue
+            label, answer = line.split("\t", 1)
+            examples.append((label, answer))
+    return examples
+
+
+# featurize(answers): Hashes the character n-grams of every answer, for the whole batch at once.
+# Input: A list of strings.
+# Returns: A sparse matrix of the n-grams as (row, column, scale) arrays: the answer and the hashed feature of
+#          every n-gram (an n-gram that shows up twice in an answer is there twice), and for every answer,
+#          1 / sqrt(its number of n-grams), which its row is multiplied by so long answers don't outweigh short ones.
+def featurize(answers):
+    count = len(answers)
+    # the answers are padded with a space on each side, so n-grams at the start and end of a word differ from
+    # ones in the middle, and laid end to end in one array of bytes
+    encoded = [(" " + answer.lower() + " ").encode("utf-8")[:max_length] for answer in answers]
+    lengths = numpy.array([len(text) for text in encoded])
+    text = numpy.frombuffer(b"".join(encoded), dtype=numpy.uint8).astype(numpy.uint32)
+    answer_of = numpy.repeat(numpy.arange(count), lengths)
+    end_of = numpy.repeat(numpy.cumsum(lengths), lengths)
+    start_at = numpy.arange(len(text))
+
+    rows = []
+    columns = []
+    hashed = numpy.zeros(len(text), dtype=numpy.uint32)
+    for size in range(1, max(ngram_sizes) + 1):
+        # the hash of the n-gram starting at every position, built from the one a character shorter (the
+        # arithmetic wraps around)
+        hashed = hashed[:len(text) - size + 1] * numpy.uint32(1000003) + text[size - 1:]
+        if size not in ngram_sizes:
+            continue
+        # only the n-grams that lie inside one answer count
+        inside = start_at[:len(hashed)] + size <= end_of[:len(hashed)]
+        rows.append(answer_of[:len(hashed)][inside])
+        mixed = (hashed[inside] ^ numpy.uint32(size)) * numpy.uint32(2654435761)
+        columns.append((mixed >> numpy.uint32(32 - feature_bits)).astype(numpy.intp))
+    rows = numpy.concatenate(rows)
+    scale = 1 / numpy.sqrt(numpy.maximum(numpy.bincount(rows, minlength=count), 1))
+    return rows, numpy.concatenate(columns), scale
+
+
+# IntentClassifier: The trained model.  Training takes a fraction of a second, and happens when it is made.
+class IntentClassifier:
+    def __init__(self, examples=None, iterations=300, learning_rate=4.0, l2=1e-4):
+        if examples is None:
+            examples = read_corpus()
+        # the same answers with a capital letter and with punctuation are just as common
+        answers = []
+        targets = []
+        for label, answer in examples:
+            for variant in (answer, answer.capitalize(), answer + ".", answer + "!"):
+                answers.append(variant)
+                targets.append(labels.index(label))
+        features = featurize(answers)
+        rows, columns, scale = features
+        onehot = numpy.eye(len(labels))[targets]
+
+        # plain full-batch gradient descent on the softmax cross-entropy.  The weights of each label are kept
+        # together (one row per label), so looking up one label's weights for a batch reads a single row
+        self.weights = numpy.zeros((len(labels), dimensions))
+        self.bias = numpy.zeros(len(labels))
+        for k in range(iterations):
+            error = (self.probabilities(features, len(answers)) - onehot) * (scale / len(answers))[:, None]
+            gradient = numpy.stack([numpy.bincount(columns, error[rows, label], minlength=dimensions)
+                                    for label in range(len(labels))])
+            self.weights -= learning_rate * (gradient + l2 * self.weights)
+            self.bias -= learning_rate * error.sum(axis=0) / scale.mean()
+
+    # probabilities(features, count): The model's probability for each label.
+    # Input: A sparse feature matrix made by featurize, and how many answers it has.
+    # Returns: A (count, 3) array of probabilities, in the order of labels.
+    def probabilities(self, features, count):
+        rows, columns, scale = features
+        scores = numpy.stack([numpy.bincount(rows, weights[columns], minlength=count)
+                              for weights in self.weights], axis=1) * scale[:, None] + self.bias
+        scores -= scores.max(axis=1, keepdims=True)
+        exponentials = numpy.exp(scores)
+        return exponentials / exponentials.sum(axis=1, keepdims=True)
+
+    # classify_batch(answers): Labels any number of answers in one go.
+    # Input: A list of strings.
+    # Returns: A list with "yes", "no" or "unclear" for each answer, and a NumPy array with how confident
+    #          the model is in each label (its probability).
+    def classify_batch(self, answers):
+        if len(answers) == 0:
+            return [], numpy.zeros(0)
+        probabilities = self.probabilities(featurize(answers), len(answers))
+        best = probabilities.argmax(axis=1)
+        return [labels[k] for k in best], probabilities[numpy.arange(len(answers)), best]
+
+
+# regex_classify_batch(answers): Labels answers with the regex intent matcher, one at a time.  This is what is
+#                                used when NumPy isn't installed, and what the classifier is measured against.
+# Input: A list of strings.
+# Returns: A list with "yes", "no" or "unclear" for each answer, and a list of confidences (always 1.0).
+def regex_classify_batch(answers):
+    found = []
+    for answer in answers:
+        label = chatbot.intent_matcher.answer(answer)
+        found.append(label if label in ("yes", "no") else "unclear")
+    return found, [1.0] * len(answers)
+
+
+# The classifier everyone shares, trained the first time it is asked for
+shared_classifier = None
+
+
+# load(): The shared classifier.
+# Input: Nothing
+# Returns: The IntentClassifier, or None if NumPy isn't installed.
+def load():
+    global shared_classifier
+    if numpy is None:
+        return None
+    if shared_classifier is None:
+        shared_classifier = IntentClassifier()
+    return shared_classifier
+
+
+# classify_batch(answers): Labels answers with the shared classifier, or with the regex matcher if NumPy isn't
+#                          installed.
+# Input: A list of strings.
+# Returns: A list with "yes", "no" or "unclear" for each answer, and the confidence in each.
+def classify_batch(answers):
+    classifier = load()
+    if classifier is None:
+        return regex_classify_batch(answers)
+    return classifier.classify_batch(answers)
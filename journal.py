@@ -0,0 +1,268 @@
+# Crash-safe persistence for conversations.  Every update_dst call on a tracker that is attached to a journal
+# appends one compact JSON line to an append-only journal file, so if the process dies mid-conversation, the
+# conversations can be rebuilt on restart by replaying it.  Every so often the journal is compacted into a
+# snapshot of every live conversation, and a fresh journal is started after it.
+#
+# Journal lines are JSON arrays:
+#     ["g", 3]                                       the journal's generation (always the first line)
+#     ["u", 17, [["user_intent_history", "greetings"]]]   session 17's update_dst call, with its (slot, value) pairs
+#     ["c", 17]                                      session 17 was closed
+# The snapshot is one JSON object with the generation of the journal that continues from it.  A journal whose
+# generation is older than the snapshot's is already part of the snapshot and is skipped, so a crash between
+# writing a snapshot and starting the next journal loses nothing and doesn't replay anything twice.
+import datetime
+import json
+import os
+import threading
+
+import chatbot
+import timeparse
+
+# Journal lines are written with no spaces, to keep them small
+encode_record = json.JSONEncoder(separators=(",", ":")).encode
+
+
+# encode_value(value): Turns a slot value into something JSON can store.
+# Input: A slot value (a string, a list of strings, or a timeparse.AppointmentTime).
+# Returns: The JSON-ready value.
+def encode_value(value):
+    when = getattr(value, "when", None)
+    if when is not None:
+        return {"text": str(value), "when": when.isoformat()}
+    return value
+
+
+# decode_value(value): Undoes encode_value.
+# Input: A value read from the journal.
+# Returns: The slot value.
+def decode_value(value):
+    if isinstance(value, dict):
+        return timeparse.AppointmentTime(value["text"], datetime.datetime.fromisoformat(value["when"]))
+    return value
+
+
+# encode_state(dst): The whole dialogue state, for a snapshot.
+# Input: A chatbot.DialogueState.
+# Returns: A JSON-ready dictionary.  The histories keep their recent entries and everything they have seen.
+def encode_state(dst):
+    state = {}
+    for slot in dst.keys():
+        if slot in chatbot.dst_histories:
+            history = dst[slot]
+            state[slot] = {"recent": list(history),
+                           "seen": [name for code, name in enumerate(chatbot.history_names) if history.seen >> code & 1]}
+        else:
+            state[slot] = encode_value(dst[slot])
+    return state
+
+
+# decode_state(state): Rebuilds a dialogue state from a snapshot.
+# Input: A dictionary made by encode_state.
+# Returns: A chatbot.DialogueState.
+def decode_state(state):
+    dst = chatbot.new_dst()
+    for slot, value in state.items():
+        if slot in chatbot.dst_histories:
+            history = dst[slot]
+            # entries that fell out of a full history are added first, so the recent ones push them out again
+            # but they are still remembered as seen
+            if len(value["recent"]) >= history.capacity:
+                for name in value["seen"]:
+                    history.append(name)
+            for name in value["recent"]:
+                history.append(name)
+        else:
+            dst[slot] = decode_value(value)
+    return dst
+
+
+# Journal: The journal and snapshot files of one process's conversations.  Writing is thread-safe.
+# Every record is handed to the operating system right away (so a crash of the process loses nothing), and that
+# single write is all a turn pays for.  fsync, which is what survives a crash of the machine, runs in a background
+# thread once every sync_interval seconds if anything was written, and so does the compaction once snapshot_every
+# records have been written (a turn only has to wait for the lock while a snapshot is being taken).
+class Journal:
+    def __init__(self, path, sync_interval=0.05, snapshot_every=100000):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.sync_interval = sync_interval
+        self.snapshot_every = snapshot_every
+        self.lock = threading.RLock()
+        self.file = None
+        self.generation = 0
+        self.records = 0
+        # whether anything was written since the last fsync, and the thread that syncs and compacts the journal
+        # (wakeup gets it going early, when a compaction is due or the journal is closed)
+        self.dirty = False
+        self.flusher = None
+        self.stopping = False
+        self.wakeup = threading.Event()
+        # session id -> dialogue state of every attached conversation, from the least to the most recently
+        # written to, which is what goes into a snapshot
+        self.live = {}
+
+    # recover(): Rebuilds the conversations that were still going when the journal was last written to.
+    # Input: Nothing
+    # Returns: A dictionary of session id -> chatbot.DialogueState, ordered from the conversation that was written
+    #          to the longest ago to the one written to last.  Nothing is attached to the journal yet.
+    def recover(self):
+        sessions = {}
+        generation = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            generation = snapshot["generation"]
+            for session_id, state in snapshot["sessions"]:
+                sessions[session_id] = decode_state(state)
+        if os.path.exists(self.path):
+            with open(self.path) as journal_file:
+                for number, line in enumerate(journal_file):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line may have been cut off by the crash
+                        break
+                    if number == 0:
+                        if record[0] != "g" or record[1] < generation:
+                            break
+                        generation = record[1]
+                    elif record[0] == "u":
+                        # moved to the end, so the conversations stay in the order they were last written to
+                        dst = sessions.pop(record[1], None)
+                        if dst is None:
+                            dst = chatbot.new_dst()
+                        sessions[record[1]] = dst
+                        chatbot.apply_updates(dst, [(slot, decode_value(value)) for slot, value in record[2]])
+                    elif record[0] == "c":
+                        sessions.pop(record[1], None)
+        self.generation = generation
+        return sessions
+
+    # open(sessions): Starts writing, with a snapshot of the given conversations (usually the recovered ones)
+    #                 and a fresh journal after it.  The conversations are attached to the journal.
+    # Input: A dictionary of session id -> chatbot.DialogueState.
+    # Returns: Nothing
+    def open(self, sessions):
+        with self.lock:
+            for session_id, dst in sessions.items():
+                self.attach(session_id, dst)
+            self.compact()
+            if self.flusher is None:
+                self.stopping = False
+                self.flusher = threading.Thread(target=self.flush_loop, name="journal-sync", daemon=True)
+                self.flusher.start()
+
+    # flush_loop(): Syncs whatever was written but not synced yet, every sync_interval seconds, and compacts the
+    #               journal when it is due, until the journal is closed.  This is what runs in the background thread.
+    # Input: Nothing
+    # Returns: Nothing
+    def flush_loop(self):
+        while not self.stopping:
+            self.wakeup.wait(self.sync_interval)
+            self.wakeup.clear()
+            if self.records >= self.snapshot_every:
+                self.compact()
+            self.flush()
+
+    # flush(): Syncs whatever was written but not synced yet.  Only the background thread calls this, and the
+    #          fsync runs without the lock (on a copy of the file descriptor, in case a compaction replaces the file
+    #          in the meantime), so turns can keep writing while it waits on the disk.
+    # Input: Nothing
+    # Returns: Nothing
+    def flush(self):
+        with self.lock:
+            if not self.dirty or self.file is None:
+                return
+            descriptor = os.dup(self.file.fileno())
+            self.dirty = False
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+    # attach(session_id, dst): Makes every update_dst call on a dialogue state get written to the journal.
+    # Input: The id of the conversation, and its chatbot.DialogueState.
+    # Returns: Nothing
+    def attach(self, session_id, dst):
+        with self.lock:
+            dst.journal = self
+            dst.session_id = session_id
+            self.live[session_id] = dst
+
+    # detach(session_id): Records that a conversation is over, so it isn't rebuilt on restart.
+    # Input: The id of the conversation.
+    # Returns: Nothing
+    def detach(self, session_id):
+        with self.lock:
+            dst = self.live.pop(session_id, None)
+            if dst is not None:
+                dst.journal = None
+                self.write(["c", session_id])
+
+    # record(session_id, input): Appends an update_dst call to the journal.  The caller holds the lock, from
+    #                            before it changes the dialogue state until after this returns, so a snapshot
+    #                            never sees a change that then gets journaled again.
+    # Input: The id of the conversation, and the list of (slot, value) pairs given to update_dst.
+    # Returns: Nothing
+    def record(self, session_id, input):
+        self.write(["u", session_id, [(slot, encode_value(value)) for slot, value in input]])
+        self.live[session_id] = self.live.pop(session_id)
+        if self.records == self.snapshot_every:
+            # the background thread takes the snapshot
+            self.wakeup.set()
+
+    # write(record): Writes one line to the journal.  It gets synced to disk by the background thread.
+    # Input: The record, as a list.
+    # Returns: Nothing
+    def write(self, record):
+        # the file is unbuffered, so this is a single write straight to the operating system
+        self.file.write((encode_record(record) + "\n").encode())
+        self.records += 1
+        self.dirty = True
+
+    # compact(): Writes a snapshot of every attached conversation and starts a new journal generation after it.
+    # Input: Nothing
+    # Returns: Nothing
+    def compact(self):
+        with self.lock:
+            self.generation += 1
+            snapshot = {"generation": self.generation,
+                        "sessions": [[session_id, encode_state(dst)] for session_id, dst in self.live.items()]}
+            temporary = self.snapshot_path + ".tmp"
+            with open(temporary, "w") as snapshot_file:
+                json.dump(snapshot, snapshot_file, separators=(",", ":"))
+                snapshot_file.flush()
+                os.fsync(snapshot_file.fileno())
+            os.replace(temporary, self.snapshot_path)
+
+            if self.file is not None:
+                self.file.close()
+            self.file = open(self.path, "wb", buffering=0)
+            self.records = 0
+            self.write(["g", self.generation])
+            os.fsync(self.file.fileno())
+            self.dirty = False
+
+    # sync(): Syncs everything written so far to disk.
+    # Input: Nothing
+    # Returns: Nothing
+    def sync(self):
+        with self.lock:
+            if self.file is not None:
+                os.fsync(self.file.fileno())
+                self.dirty = False
+
+    # close(): Syncs and closes the journal.  The conversations it has are rebuilt by the next recover().
+    # Input: Nothing
+    # Returns: Nothing
+    def close(self):
+        self.stopping = True
+        self.wakeup.set()
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flusher = None
+        with self.lock:
+            self.sync()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,131 @@
+# Vocabulary fast path for clarification answers.  Most people answer "could you describe your symptoms?" or
+# "who do you know has it?" with things from a short list ("a fever and a dry cough", "my mom and my sister"),
+# and for those the whole tokenize + POS tag round is wasted work that also lets noise through ("I", "having").
+# A Lexicon finds the known terms in an answer in one left-to-right scan over its words, walking a word trie for
+# the longest term at each position, keeping the words that say how bad something is ("a severe headache"), and
+# skipping filler words.  If any word is none of those, the answer isn't fully understood and the caller falls
+# back to the tagger.
+import re
+import threading
+
+# Words that can appear around the terms without meaning anything for the answer
+fillers = frozenset([
+    "a", "an", "the", "some", "any", "my", "our", "his", "her", "their", "your", "i", "i've", "i'm", "we", "he",
+    "she", "they", "have", "has", "had", "having", "got", "get", "getting", "been", "am", "is", "are", "was",
+    "were", "feel", "feeling", "felt", "also", "too", "and", "or", "with", "plus", "just", "kind", "sort", "of",
+    "bit", "lot", "really", "very", "pretty", "lately", "recently", "maybe", "probably", "think", "like", "both",
+    "all", "few", "two", "three", "mostly", "only",
+])
+
+# Adjectives that say how bad a symptom is.  The tagger keeps adjectives in symptoms (see chatbot.symptom_pos),
+# so these are kept too, wherever they are, instead of being skipped like fillers.  For people, the tagger drops
+# adjectives, so there they're just fillers.
+modifiers = frozenset([
+    "mild", "slight", "little", "minor", "bad", "worse", "severe", "terrible", "awful", "intense", "extreme",
+    "sharp", "dull", "constant", "persistent", "chronic", "frequent", "occasional", "sudden", "new",
+])
+
+# Symptoms and health conditions, as people say them
+symptom_terms = [
+    "fever", "high fever", "temperature", "cough", "dry cough", "wet cough", "coughing", "shortness of breath",
+    "short of breath", "trouble breathing", "difficulty breathing", "breathing problems", "sore throat",
+    "headache", "headaches", "migraine", "migraines", "loss of taste", "loss of smell", "fatigue", "tiredness",
+    "chills", "muscle aches", "muscle pain", "body aches", "aches", "runny nose", "stuffy nose", "congestion",
+    "nausea", "vomiting", "diarrhea", "sneezing", "chest pain", "chest tightness", "dizziness", "rash",
+    "back pain", "stomach ache", "stomachache", "stomach pain", "joint pain", "asthma", "diabetes",
+    "high blood pressure", "low blood pressure", "hypertension", "heart disease", "heart problems", "allergies",
+    "allergy", "pneumonia", "bronchitis", "copd", "cancer", "obesity", "anxiety", "depression", "insomnia",
+    "pregnancy", "pregnant", "kidney disease", "liver disease", "arthritis", "flu", "cold", "infection",
+    "sinus infection", "ear infection", "pink eye", "conjunctivitis", "weakness", "confusion", "sweating",
+    "night sweats", "weight loss", "loss of appetite",
+]
+
+# Family members and other people someone may have been in contact with.  Terms are only single nouns here, since
+# the tagger drops the adjectives in front of people ("my best friend" is just "friend")
+relation_terms = [
+    "mom", "mother", "dad", "father", "parents", "parent", "sister", "sisters", "brother", "brothers", "siblings",
+    "grandmother", "grandma", "grandfather", "grandpa", "grandparents", "aunt", "uncle", "cousin", "cousins",
+    "wife", "husband", "spouse", "partner", "son", "sons", "daughter", "daughters", "kids", "children", "child",
+    "baby", "niece", "nephew", "girlfriend", "boyfriend", "fiance", "fiancee", "stepmom", "stepdad",
+    "roommate", "roommates", "coworker", "coworkers", "co-worker", "co-workers", "colleague", "colleagues",
+    "boss", "neighbor", "neighbors", "neighbour", "friend", "friends", "classmate", "classmates",
+    "teacher", "doctor", "nurse", "mailman", "babysitter", "nanny", "cashier", "landlord", "in-laws",
+    "mother-in-law", "father-in-law", "family",
+]
+
+# Words are runs of letters and digits (in any alphabet), so "fièvre" or "3" is a word the lexicon doesn't know,
+# which sends the answer to the tagger instead of being skipped over
+word_pattern = re.compile(r"\w+(?:['-]\w+)*")
+
+
+# Lexicon: A word trie of known terms.  Matching is thread-safe, and counts how many answers it fully understood.
+class Lexicon:
+    def __init__(self, terms, fillers=fillers, modifiers=frozenset()):
+        # each node is a dictionary of word -> child node, with the key None marking the end of a term
+        self.root = {}
+        for term in terms:
+            node = self.root
+            for word in term.lower().split():
+                node = node.setdefault(word, {})
+            node[None] = True
+        self.fillers = fillers
+        self.modifiers = modifiers
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # match_piece(piece): Finds the terms in one listed item.
+    # Input: A string with one thing the user listed.
+    # Returns: The terms and modifiers found (in the user's own words, joined by spaces, the same as the tagger's
+    #          output), or None if the item has a word that is none of a term, a modifier or a filler.
+    def match_piece(self, piece):
+        words = word_pattern.findall(piece)
+        lowered = [word.lower() for word in words]
+        found = []
+        k = 0
+        while k < len(words):
+            # the longest term starting here
+            node = self.root
+            end = None
+            j = k
+            while j < len(words) and lowered[j] in node:
+                node = node[lowered[j]]
+                j += 1
+                if None in node:
+                    end = j
+            if end is not None:
+                found.extend(words[k:end])
+                k = end
+            elif lowered[k] in self.modifiers:
+                found.append(words[k])
+                k += 1
+            elif lowered[k] in self.fillers:
+                k += 1
+            else:
+                return None
+        return " ".join(found)
+
+    # match(pieces): Finds the terms in every item of a clarification answer.
+    # Input: The answer, already split into the things that were listed (see chatbot.split_listed_values).
+    # Returns: The list of values (the same as the tagger would give), or None if the answer has to be tagged.
+    def match(self, pieces):
+        listofvalues = []
+        for piece in pieces:
+            value = self.match_piece(piece)
+            if value is None:
+                with self.lock:
+                    self.misses += 1
+                return None
+            if len(value) > 0:
+                listofvalues.append(value)
+        with self.lock:
+            self.hits += 1
+        return listofvalues
+
+    # info(): How many answers were fully understood by the lexicon, and how many had to be tagged.
+    # Input: Nothing
+    # Returns: A dictionary with the hits, misses and hit rate.
+    def info(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
@@ -0,0 +1,459 @@
+# Load generator: simulated patients talking to the chatbot, to see how the dialogue flow holds up with many
+# conversations going on at once.  Every patient takes its own random path through the conversation: some
+# turn down the appointment at the greeting, some give non-answers that have to be asked again, some list up to
+# 20 symptoms, some reject the time they're offered so they have to give another one, and so on.  The patients
+# talk to the engine either in this process (through a chatbot.SessionRegistry) or over a local socket (to a
+# server.ChatServer, either one that is already running or one started in this process).
+# It reports the throughput, a histogram of the turn latencies with its tail percentiles, which states the
+# chatbot went into, and how the memory of the process grew over the run.  With --duration it keeps going for
+# that long (a soak run) instead of stopping after a number of conversations.
+# Usage: python loadgen.py [--conversations N] [--concurrency N] [--duration SECONDS] [--socket] [--port PORT]
+#                          [--calendar] [--journal FILE] [--seed N] [--json results.json] ...
+import argparse
+import asyncio
+import gc
+import json
+import math
+import os
+import random
+import re
+import time
+from collections import defaultdict
+
+import appointments
+import benchmark
+import chatbot
+import server
+
+# What patients say when they turn down the appointment, and when they won't take the time they're offered
+declines = ["no thanks", "nope, I'm good", "no, just checking something", "not really"]
+rejections = ["no", "no, that doesn't work for me", "nope", "no, a different time please"]
+
+# The questions the patient is answering when the chatbot goes into these states (a confirmation is answered
+# like any other yes/no question, and when there's nothing open the patient gives another time)
+answered_as = {"confirm": "confirm_appointment", "suggest_time": "confirm_appointment",
+               "no_openings": "create_appointment_again"}
+
+
+# Patient: One simulated patient.  The probabilities decide which way the conversation goes at each turn.
+class Patient:
+    def __init__(self, generator, decline=0.05, confused=0.05, reject=0.25, max_listed=20):
+        self.generator = generator
+        # how likely the patient is to turn down the appointment at the greeting, to say something that isn't
+        # a yes or a no to a yes/no question, and to reject the time they're asked to confirm
+        self.decline = decline
+        self.confused = confused
+        self.reject = reject
+        # the most symptoms (or people) the patient lists when asked to clarify
+        self.max_listed = max_listed
+        self.question = None
+
+    # reply(state): Makes up what the patient says to the chatbot.
+    # Input: The state the chatbot went into with its last line.  If it's asking the patient to repeat
+    #        themselves, the patient answers the question they were asked before again.
+    # Returns: A string containing the patient's input.
+    def reply(self, state):
+        if state not in chatbot.dontaddtodst:
+            self.question = answered_as.get(state, state)
+        question = self.question
+        generator = self.generator
+        if question == "greetings":
+            if generator.random() < self.decline:
+                return generator.choice(declines)
+            if generator.random() < self.confused:
+                return generator.choice(benchmark.synthetic_non_answers)
+            return benchmark.synthetic_reply(question, generator, 0)
+        elif question == "confirm_appointment":
+            if generator.random() < self.reject:
+                return generator.choice(rejections)
+            return generator.choice(["yes", "yes please", "sure", "that works"])
+        elif question in chatbot.clarification_pos or question in ("create_appointment", "create_appointment_again"):
+            # (synthetic_reply gives a non-answer now and then here too)
+            return benchmark.synthetic_reply(question, generator, generator.randint(1, self.max_listed))
+        if generator.random() < self.confused:
+            return generator.choice(benchmark.synthetic_non_answers)
+        return benchmark.synthetic_reply(question, generator, 0)
+
+
+# state_patterns: For every template variant, a regex that matches what the chatbot says with it, so a patient
+# on the other end of a socket can tell which state the chatbot is in.  The booking summary is matched by its
+# first sentence (the ones about family and contacts get added after it, or make up all of it).
+state_patterns = []
+for template_state, template_list in chatbot.compiled_templates.items():
+    for segments in template_list:
+        pattern = "(?:.*)".join(re.escape(segments[k]) for k in range(0, len(segments), 2))
+        state_patterns.append((template_state, re.compile(pattern + ("" if template_state == "book_appointment"
+                                                                     else "$"), re.DOTALL)))
+
+
+# state_of(output): Works out which state the chatbot is in from what it said.
+# Input: A line the chatbot sent.
+# Returns: The name of the state, or "unknown" if it isn't one of the templates (like the server hanging up).
+def state_of(output):
+    if output.startswith("Chatbot: "):
+        output = output[len("Chatbot: "):]
+    for template_state, pattern in state_patterns:
+        if pattern.match(output):
+            return template_state
+    return "unknown"
+
+
+# LatencyHistogram: Turn latencies, counted in buckets that get wider as the latencies get longer (a few per
+# doubling), so it takes the same memory however long the run is, and percentiles are within a bucket's width.
+class LatencyHistogram:
+    # how many buckets each doubling is split into, and the latency of the first bucket (in seconds)
+    per_doubling = 8
+    smallest = 1e-6
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    # record(seconds): Counts one latency.
+    # Input: The latency, in seconds.
+    # Returns: Nothing
+    def record(self, seconds):
+        self.counts[self.bucket(seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # bucket(seconds): The bucket a latency is counted in.
+    # Input: The latency, in seconds.
+    # Returns: The number of the bucket (0 for anything up to smallest).
+    def bucket(self, seconds):
+        if seconds <= self.smallest:
+            return 0
+        return int(math.log2(seconds / self.smallest) * self.per_doubling) + 1
+
+    # upper(bucket): The longest latency counted in a bucket.
+    # Input: The number of the bucket.
+    # Returns: The latency, in seconds.
+    def upper(self, bucket):
+        return self.smallest * 2 ** (bucket / self.per_doubling)
+
+    # percentile(p): The latency below which p percent of the turns fall (the top of the bucket it's in).
+    # Input: The percentile (0-100).
+    # Returns: The latency, in seconds, or 0 if nothing was recorded.
+    def percentile(self, p):
+        rank = max(1, -(-self.count * p // 100))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.upper(bucket), self.max)
+        return 0.0
+
+    # summary(): The main numbers of the histogram.
+    # Input: Nothing
+    # Returns: A dictionary with the count, mean, max and tail percentiles (in seconds).
+    def summary(self):
+        summary = {"count": self.count, "mean": self.total / max(self.count, 1), "max": self.max}
+        for p in (50, 90, 99, 99.9, 99.99):
+            summary["p%g" % p] = self.percentile(p)
+        return summary
+
+    # render(width): Draws the histogram, one row per doubling of the latency.
+    # Input: How wide the longest bar is, in characters.
+    # Returns: A string with one line per row.
+    def render(self, width=50):
+        rows = defaultdict(int)
+        for bucket, count in self.counts.items():
+            rows[max(bucket - 1, 0) // self.per_doubling] += count
+        if len(rows) == 0:
+            return ""
+        most = max(rows.values())
+        seen = 0
+        lines = []
+        for row in range(min(rows), max(rows) + 1):
+            count = rows.get(row, 0)
+            seen += count
+            lines.append("%10s - %-10s %9d %6.2f%% %6.2f%% %s" % (
+                format_seconds(self.smallest * 2 ** row), format_seconds(self.smallest * 2 ** (row + 1)), count,
+                count / self.count * 100, seen / self.count * 100, "#" * int(round(count / most * width))))
+        return "\n".join(lines)
+
+
+# format_seconds(seconds): Writes a latency with a unit that suits it.
+# Input: The latency, in seconds.
+# Returns: A string, for example "250us" or "1.5ms".
+def format_seconds(seconds):
+    if seconds < 1e-3:
+        return "%.3gus" % (seconds * 1e6)
+    elif seconds < 1:
+        return "%.3gms" % (seconds * 1e3)
+    return "%.3gs" % seconds
+
+
+# resident_memory(): How much memory the process is using right now.
+# Input: Nothing
+# Returns: The resident set size in bytes (the peak so far, where the current one can't be read).
+def resident_memory():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# LoadRun: What is recorded over one run: the turns and conversations, their latencies, the states the chatbot
+# went into, and the memory of the process every sample_every seconds.
+class LoadRun:
+    def __init__(self, conversations, duration=None, sample_every=10.0):
+        # the run is over after this many conversations (or, with a duration, once that many seconds have passed)
+        self.conversations = conversations
+        self.deadline = None if duration is None else time.perf_counter() + duration
+        self.sample_every = sample_every
+        self.started = 0
+        self.finished = 0
+        self.abandoned = 0
+        self.turns = 0
+        self.latencies = LatencyHistogram()
+        self.states = defaultdict(int)
+        self.start = time.perf_counter()
+        self.samples = []
+        self.sample()
+
+    # more(): Whether another conversation should be started.  It counts as started if so.
+    # Input: Nothing
+    # Returns: True or False.
+    def more(self):
+        if self.deadline is not None:
+            if time.perf_counter() >= self.deadline:
+                return False
+        elif self.started >= self.conversations:
+            return False
+        self.started += 1
+        return True
+
+    # turn(state, seconds): Records one of the chatbot's responses.
+    # Input: The state it went into, and how long the turn took (None for the greeting, which isn't timed).
+    # Returns: Nothing
+    def turn(self, state, seconds=None):
+        self.states[state] += 1
+        if seconds is not None:
+            self.turns += 1
+            self.latencies.record(seconds)
+            if time.perf_counter() - self.start >= len(self.samples) * self.sample_every:
+                self.sample()
+
+    # sample(): Records the memory of the process now.
+    # Input: Nothing
+    # Returns: Nothing
+    def sample(self):
+        self.samples.append({"seconds": time.perf_counter() - self.start, "conversations": self.finished,
+                             "turns": self.turns, "rss": resident_memory(), "objects": len(gc.get_objects())})
+
+    # results(): Everything that was recorded.
+    # Input: Nothing
+    # Returns: A dictionary that can be saved as JSON.
+    def results(self):
+        seconds = time.perf_counter() - self.start
+        self.sample()
+        return {"conversations": self.finished, "abandoned": self.abandoned, "turns": self.turns,
+                "seconds": seconds, "turns_per_second": self.turns / seconds,
+                "conversations_per_second": self.finished / seconds, "latency": self.latencies.summary(),
+                "histogram": {"%.9f" % self.latencies.upper(bucket): count
+                              for bucket, count in sorted(self.latencies.counts.items())},
+                "states": dict(self.states), "memory": self.samples}
+
+
+# run_in_process(run, patients, concurrency, registry, max_turns): Has the conversations with the engine in
+#                                                                  this process, taking turns between them.
+# Input: The LoadRun to record in, a function that makes a new Patient, how many conversations to have going at
+#        once, the chatbot.SessionRegistry, and how many turns a patient goes on for before giving up.
+# Returns: Nothing
+def run_in_process(run, patients, concurrency, registry, max_turns):
+    live = []
+    while True:
+        # keep the number of conversations going at once topped up
+        while len(live) < concurrency and run.more():
+            session = registry.create()
+            patient = patients()
+            session.start()
+            run.turn(session.state)
+            live.append([session, patient, 0])
+        if len(live) == 0:
+            break
+        for conversation in list(live):
+            session, patient, turns = conversation
+            user_input = patient.reply(session.state)
+            start = time.perf_counter()
+            registry.turn(session.session_id, user_input)
+            run.turn(session.state, time.perf_counter() - start)
+            conversation[2] = turns = turns + 1
+            if session.finished or turns >= max_turns:
+                if not session.finished:
+                    registry.close(session.session_id)
+                    run.abandoned += 1
+                run.finished += 1
+                live.remove(conversation)
+
+
+# talk(run, patient, host, port, max_turns): Has one conversation with the server over a socket.
+# Input: The LoadRun to record in, the Patient, the server's address and port, and how many turns the patient
+#        goes on for before hanging up.
+# Returns: Nothing
+async def talk(run, patient, host, port, max_turns):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        state = state_of((await reader.readline()).decode("utf-8", "replace").strip())
+        run.turn(state)
+        for turn in range(max_turns):
+            if state in chatbot.final_states:
+                break
+            elif state == "unknown":
+                # the server turned us away (or said something we don't know)
+                run.abandoned += 1
+                break
+            start = time.perf_counter()
+            writer.write(patient.reply(state).encode("utf-8") + b"\n")
+            await writer.drain()
+            output = await reader.readline()
+            if len(output) == 0:
+                break
+            state = state_of(output.decode("utf-8", "replace").strip())
+            run.turn(state, time.perf_counter() - start)
+        else:
+            run.abandoned += 1
+    except ConnectionError:
+        run.abandoned += 1
+    finally:
+        run.finished += 1
+        writer.close()
+
+
+# run_over_socket(run, patients, concurrency, host, port, calendar, max_turns): Has the conversations with a
+#                                                                                server over local sockets.
+# Input: The LoadRun to record in, a function that makes a new Patient, how many conversations to have going at
+#        once, the server's address and port (if the port is None, a server.ChatServer is started in this
+#        process, sharing its event loop with the patients), whether that server books appointments in a
+#        calendar, and how many turns a patient goes on for before hanging up.
+# Returns: Nothing
+async def run_over_socket(run, patients, concurrency, host, port, calendar, max_turns):
+    listener = None
+    if port is None:
+        registry = chatbot.SessionRegistry(calendar=appointments.AppointmentCalendar() if calendar else None)
+        # a patient may be connecting again before the server is done hanging up on its last conversation
+        chat_server = server.ChatServer(registry, max_connections=concurrency * 2)
+        listener = await chat_server.serve(host, 0)
+        port = listener.sockets[0].getsockname()[1]
+
+    async def patient_line():
+        while run.more():
+            await talk(run, patients(), host, port, max_turns)
+
+    try:
+        await asyncio.gather(*[patient_line() for k in range(concurrency)])
+    finally:
+        if listener is not None:
+            while chat_server.connections > 0:
+                await asyncio.sleep(0.01)
+            listener.close()
+            await listener.wait_closed()
+
+
+# report(results, histogram): Prints the results of a run.
+# Input: The dictionary made by LoadRun.results, and the run's LatencyHistogram.
+# Returns: Nothing
+def report(results, histogram):
+    print("%d conversations (%d abandoned), %d turns in %.2fs: %.1f turns/s, %.1f conversations/s"
+          % (results["conversations"], results["abandoned"], results["turns"], results["seconds"],
+             results["turns_per_second"], results["conversations_per_second"]))
+    latency = results["latency"]
+    print("turn latency: mean %s, p50 %s, p90 %s, p99 %s, p99.9 %s, p99.99 %s, max %s"
+          % tuple(format_seconds(latency[key]) for key in ("mean", "p50", "p90", "p99", "p99.9", "p99.99", "max")))
+    print()
+    print("%23s %9s %7s %7s" % ("turn latency", "turns", "share", "total"))
+    print(histogram.render())
+    print()
+    print("%-28s %9s" % ("state", "times"))
+    for state, count in sorted(results["states"].items(), key=lambda item: -item[1]):
+        print("%-28s %9d" % (state, count))
+    print()
+    print("%10s %14s %12s %10s %12s" % ("seconds", "conversations", "turns", "rss (MB)", "objects"))
+    for sample in results["memory"]:
+        print("%10.1f %14d %12d %10.1f %12d" % (sample["seconds"], sample["conversations"], sample["turns"],
+                                               sample["rss"] / 2 ** 20, sample["objects"]))
+    # growth is measured from the first sample after the start, once the first conversations have warmed
+    # everything up (imports, caches, the tagger), to the end of the run
+    samples = results["memory"]
+    if len(samples) >= 3:
+        first = samples[1]
+        last = samples[-1]
+        conversations = max(last["conversations"] - first["conversations"], 1)
+        print("memory growth: %+.1f MB (%+.1f KB per 1000 conversations), %+d objects"
+              % ((last["rss"] - first["rss"]) / 2 ** 20, (last["rss"] - first["rss"]) / 1024 / conversations * 1000,
+                 last["objects"] - first["objects"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Put the chatbot under load with simulated patients.")
+    parser.add_argument("--conversations", type=int, default=2000, help="conversations to have in total")
+    parser.add_argument("--concurrency", type=int, default=500, help="conversations to have going at once")
+    parser.add_argument("--duration", type=float, help="keep going for this many seconds instead (a soak run)")
+    parser.add_argument("--socket", action="store_true", help="talk to the chatbot over local sockets")
+    parser.add_argument("--host", default="127.0.0.1", help="address of the server with --socket")
+    parser.add_argument("--port", type=int,
+                        help="port of a running server with --socket (default: start one in this process)")
+    parser.add_argument("--calendar", action="store_true", help="book the appointments in a shared calendar")
+    parser.add_argument("--export", metavar="DIRECTORY",
+                        help="add finished conversations to the export in DIRECTORY (in-process only)")
+    parser.add_argument("--journal", metavar="FILE",
+                        help="write every conversation to the journal in FILE (in-process only)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the patients")
+    parser.add_argument("--decline", type=float, default=0.05, help="chance a patient turns down the appointment")
+    parser.add_argument("--confused", type=float, default=0.05, help="chance of a non-answer to a yes/no question")
+    parser.add_argument("--reject", type=float, default=0.25, help="chance a patient rejects the time offered")
+    parser.add_argument("--max-listed", type=int, default=20, help="most symptoms or people a patient lists")
+    parser.add_argument("--max-turns", type=int, default=60, help="turns before a patient gives up")
+    parser.add_argument("--sample-every", type=float, default=10.0, help="seconds between memory samples")
+    parser.add_argument("--preload", action="store_true", help="load the tokenizer and tagger before starting")
+    parser.add_argument("--json", help="save the results to this JSON file")
+    args = parser.parse_args()
+
+    if args.preload:
+        chatbot.preload()
+    generator = random.Random(args.seed)
+    # the chatbot picks its template variants with the random module
+    random.seed(args.seed)
+
+    def patients():
+        return Patient(random.Random(generator.getrandbits(64)), args.decline, args.confused, args.reject,
+                       args.max_listed)
+
+    run = LoadRun(args.conversations, args.duration, args.sample_every)
+    if args.socket:
+        asyncio.run(run_over_socket(run, patients, args.concurrency, args.host, args.port, args.calendar,
+                                    args.max_turns))
+    else:
+        exporter = None
+        if args.export:
+            import export
+            exporter = export.Exporter(args.export)
+        conversations = None
+        if args.journal:
+            import journal
+            conversations = journal.Journal(args.journal)
+        registry = chatbot.SessionRegistry(calendar=appointments.AppointmentCalendar() if args.calendar else None,
+                                           journal=conversations, exporter=exporter)
+        # the patients of a run that was cut off are gone, so their conversations are too
+        registry.close_all()
+        run_in_process(run, patients, args.concurrency, registry, args.max_turns)
+        if exporter is not None:
+            exporter.close()
+        if conversations is not None:
+            conversations.close()
+    results = run.results()
+    report(results, run.latencies)
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# Per-turn instrumentation: how long each stage of a turn takes, which intents nlu detects, which states the
+# chatbot goes into, and how often the conversation goes around a retry loop.  Nothing is recorded unless it
+# is turned on with chatbot.enable_metrics().  The metrics are exported in the Prometheus text format, either
+# by render() or by writing them to a file that a scraper (or a person) can read.
+import os
+import threading
+from collections import defaultdict
+
+# The upper bounds of the latency histogram buckets, in seconds
+latency_buckets = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# The stages of a turn, in the order they run
+stages = ("nlu", "update_dst", "dialogue_policy", "nlg", "turn")
+
+
+# TurnMetrics: The counters and latency histograms for every turn of every session in this process.
+# Recording is thread-safe.
+class TurnMetrics:
+    def __init__(self, retry_states=()):
+        # the states that mean the conversation is going around a loop again
+        self.retry_states = frozenset(retry_states)
+        self.lock = threading.Lock()
+        self.buckets = {stage: [0] * (len(latency_buckets) + 1) for stage in stages}
+        self.seconds = dict.fromkeys(stages, 0.0)
+        self.intents = defaultdict(int)
+        self.states = defaultdict(int)
+        self.retries = defaultdict(int)
+
+    # observe(stage, seconds): Records how long one stage of a turn took.
+    # Input: The name of the stage, and how long it took in seconds.
+    # Returns: Nothing
+    def observe(self, stage, seconds):
+        bucket = 0
+        while bucket < len(latency_buckets) and seconds > latency_buckets[bucket]:
+            bucket += 1
+        with self.lock:
+            self.buckets[stage][bucket] += 1
+            self.seconds[stage] += seconds
+
+    # count_turn(slots_and_values, state): Counts the intents nlu detected and the state the chatbot went into.
+    # Input: The (slot, value) pairs nlu extracted, and the state the dialogue policy chose.
+    # Returns: Nothing
+    def count_turn(self, slots_and_values, state):
+        with self.lock:
+            for slot, value in slots_and_values:
+                if slot == "user_intent_history":
+                    self.intents[value] += 1
+            self.states[state] += 1
+            if state in self.retry_states:
+                self.retries[state] += 1
+
+    # render(): The metrics in the Prometheus text exposition format.
+    # Input: Nothing
+    # Returns: A string.
+    def render(self):
+        with self.lock:
+            lines = ["# HELP chatbot_stage_seconds Time spent in each stage of a turn.",
+                     "# TYPE chatbot_stage_seconds histogram"]
+            for stage in stages:
+                total = 0
+                for bound, count in zip(latency_buckets + ("+Inf",), self.buckets[stage]):
+                    total += count
+                    lines.append('chatbot_stage_seconds_bucket{stage="%s",le="%s"} %d' % (stage, bound, total))
+                lines.append('chatbot_stage_seconds_sum{stage="%s"} %.9f' % (stage, self.seconds[stage]))
+                lines.append('chatbot_stage_seconds_count{stage="%s"} %d' % (stage, total))
+            for name, label, help, counts in [
+                    ("chatbot_intents_total", "intent", "User intents detected by nlu.", self.intents),
+                    ("chatbot_states_total", "state", "Dialogue states the chatbot went into.", self.states),
+                    ("chatbot_retry_loops_total", "state", "Times the user was asked again.", self.retries)]:
+                lines.append("# HELP %s %s" % (name, help))
+                lines.append("# TYPE %s counter" % name)
+                for key in sorted(counts):
+                    lines.append('%s{%s="%s"} %d' % (name, label, key, counts[key]))
+        return "\n".join(lines) + "\n"
+
+    # write(path): Writes the metrics to a file, replacing it in one step so a reader never sees half of it.
+    # Input: The path of the file.
+    # Returns: Nothing
+    def write(self, path):
+        temporary = path + ".tmp"
+        with open(temporary, "w") as output:
+            output.write(self.render())
+        os.replace(temporary, path)
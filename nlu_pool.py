@@ -0,0 +1,53 @@
+# A pool of worker processes for the POS tagging of clarification answers.  Tagging is pure-Python CPU work, so
+# in one interpreter it can only ever use one core, however many conversations are going on; the pool spreads
+# it over as many processes as there are cores.  Every worker loads the tokenizer and tagger as soon as it
+# starts, so nobody waits for them on their first answer.  Only the tagging goes to the workers: the cache of
+# answers that were already tagged stays in this process (see chatbot.extract_listed_values), and yes/no and
+# date/time answers never leave it, since they are cheap.
+import multiprocessing
+import os
+
+import chatbot
+
+
+# NLUPool: The worker processes, usable from any number of threads at once.
+class NLUPool:
+    def __init__(self, workers=None, chunk_size=8):
+        self.workers = workers or os.cpu_count()
+        # answers are sent to the workers in chunks of at least this many, so big batches get spread out but
+        # a handful of answers doesn't get split up just to pay for more round trips
+        self.chunk_size = chunk_size
+        self.pool = multiprocessing.Pool(self.workers, initializer=chatbot.preload)
+
+    # tag(answers): Tags clarification answers in the worker processes.
+    # Input: A list of (input, validpos) pairs.
+    # Returns: A list with the extracted values for each of the answers, in the same order.
+    def tag(self, answers):
+        if len(answers) == 0:
+            return []
+        chunks = max(1, min(self.workers, len(answers) // self.chunk_size))
+        size = -(-len(answers) // chunks)
+        extracted = []
+        for values in self.pool.map(chatbot.tag_listed_values,
+                                    [answers[k:k + size] for k in range(0, len(answers), size)]):
+            extracted.extend(values)
+        return extracted
+
+    # extract(answers): The same as chatbot.extract_listed_values, but with the tagging done by the workers.
+    # Input: A list of (input, validpos) pairs.
+    # Returns: A list with the extracted values for each of the answers, in the same order.
+    def extract(self, answers):
+        return chatbot.extract_listed_values(answers, self.tag)
+
+    # close(): Stops the worker processes.
+    # Input: Nothing
+    # Returns: Nothing
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
@@ -0,0 +1,178 @@
+# Per-turn profiling, to find out which part of the conversation a slow turn comes from.  A sample of the turns
+# is run under cProfile (or tracemalloc), and the samples are added up by the dialogue state the chatbot went
+# into (which is what nlg and the policy worked on) and by the NLU branch of the answer (which is what nlu worked
+# on: tagging a clarification, resolving a date and time, a yes/no answer, ...).  The report has the top
+# functions and the allocation sites of each.  Nothing is profiled unless it is turned on with
+# chatbot.enable_profiling() (or by running chatbot.py with --profile, or with CHATBOT_PROFILE set), and only
+# one turn in 1 / rate is, so it can be left on in production with a small rate.
+# Only one turn is profiled at a time (a turn sampled while another one is being profiled just runs), since
+# tracemalloc is global to the process and newer Pythons only let one cProfile run at once.  cProfile only sees the
+# thread the turn runs on (the event loop's, in the server), so the POS tagging that runs in an executor shows up
+# as time spent waiting for it.  tracemalloc sees every thread, so whatever other threads allocate while a turn is
+# traced is counted against that turn.
+import cProfile
+import io
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+
+# TurnProfiler: The profiles of the sampled turns of every session in this process.  Recording is thread-safe.
+class TurnProfiler:
+    def __init__(self, rate=1.0, memory=True, top=15, frames=1):
+        # the share of turns that are profiled, and whether some of them get their allocations traced
+        self.rate = rate
+        self.memory = memory
+        # how many functions and allocation sites each section of the report lists, and how many frames of the
+        # stack an allocation site has (1 is just the line that allocated)
+        self.top = top
+        self.frames = frames
+        # a generator of its own, so sampling doesn't change what the chatbot's templates pick
+        self.random = random.Random()
+        self.lock = threading.Lock()
+        # held while a turn is being profiled
+        self.active = threading.Lock()
+        # (nlu branch, state) -> the added up cProfile stats, the number of turns and their total and slowest time,
+        # the allocation sites ((file, line) -> [bytes, blocks]), the biggest peak of traced memory, and how many
+        # turns were traced
+        self.stats = {}
+        self.turns = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.slowest = defaultdict(float)
+        self.allocations = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+        self.peaks = defaultdict(int)
+        self.traced = defaultdict(int)
+
+    # sample(): Decides whether the next turn is profiled.
+    # Input: Nothing
+    # Returns: True or False.
+    def sample(self):
+        return self.rate >= 1 or self.random.random() < self.rate
+
+    # start(): Starts profiling a turn.  Half of the sampled turns (if memory is on) get their allocations traced
+    #          instead of being run under cProfile, since tracing both at once would mostly trace cProfile's own
+    #          allocations, and slow the turn down for both.
+    # Input: Nothing
+    # Returns: What stop needs to finish the profile, or None if another turn is being profiled (or something
+    #          else has the profiler), in which case the turn shouldn't be.
+    def start(self):
+        if not self.active.acquire(blocking=False):
+            return None
+        tracing = self.memory and self.random.random() < 0.5 and not tracemalloc.is_tracing()
+        profile = None
+        if tracing:
+            tracemalloc.start(self.frames)
+        else:
+            profile = cProfile.Profile()
+        started = time.perf_counter()
+        if profile is not None:
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiling tool is already running
+                self.active.release()
+                return None
+        return profile, started, tracing
+
+    # stop(recording, branch, state): Stops profiling a turn, and adds it to the others with the same NLU branch
+    #                                 and state.
+    # Input: What start returned, the NLU branch of the user's input, and the state the chatbot went into.
+    # Returns: Nothing
+    def stop(self, recording, branch, state):
+        profile, started, tracing = recording
+        try:
+            if profile is not None:
+                profile.disable()
+            seconds = time.perf_counter() - started
+            if tracing:
+                # what the turn allocated and still held when it ended (what it allocated and freed again only
+                # shows up in the peak)
+                snapshot = tracemalloc.take_snapshot().filter_traces([
+                    tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)])
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        finally:
+            self.active.release()
+        sites = snapshot.statistics("lineno") if tracing else None
+        key = (branch, state)
+        with self.lock:
+            if profile is not None:
+                if key in self.stats:
+                    self.stats[key].add(profile)
+                else:
+                    self.stats[key] = pstats.Stats(profile)
+            self.turns[key] += 1
+            self.seconds[key] += seconds
+            self.slowest[key] = max(self.slowest[key], seconds)
+            if sites is not None:
+                self.traced[key] += 1
+                self.peaks[key] = max(self.peaks[key], peak)
+                allocations = self.allocations[key]
+                for site in sites:
+                    frame = site.traceback[0]
+                    allocated = allocations[(frame.filename, frame.lineno)]
+                    allocated[0] += site.size
+                    allocated[1] += site.count
+
+    # render(): The report, with a section for every dialogue state and then one for every NLU branch.
+    # Input: Nothing
+    # Returns: A string.
+    def render(self):
+        with self.lock:
+            lines = ["chatbot profile: %d turns sampled (rate %g)" % (sum(self.turns.values()), self.rate)]
+            for heading, position in [("dialogue state", 1), ("nlu branch", 0)]:
+                groups = defaultdict(list)
+                for key in self.turns:
+                    groups[key[position]].append(key)
+                # the groups that took the most time in total first
+                order = sorted(groups, key=lambda name: -sum(self.seconds[key] for key in groups[name]))
+                lines.append("")
+                lines.append("=" * 20 + " by " + heading + " " + "=" * 20)
+                for name in order:
+                    lines.extend(self.render_group(heading, name, groups[name]))
+        return "\n".join(lines) + "\n"
+
+    # render_group(heading, name, keys): One section of the report.  The lock has to be held.
+    # Input: What the section is grouped by, the name of the state or branch, and the (branch, state) pairs in it.
+    # Returns: A list of lines.
+    def render_group(self, heading, name, keys):
+        turns = sum(self.turns[key] for key in keys)
+        seconds = sum(self.seconds[key] for key in keys)
+        lines = ["", "-- %s %s: %d turns, %.3fms mean, %.3fms slowest (profiled), %.3fs in total"
+                 % (heading, name, turns, seconds / turns * 1e3, max(self.slowest[key] for key in keys) * 1e3,
+                    seconds)]
+        profiled = [self.stats[key] for key in keys if key in self.stats]
+        if len(profiled) > 0:
+            output = io.StringIO()
+            stats = pstats.Stats(stream=output)
+            stats.add(*profiled)
+            stats.strip_dirs().sort_stats("cumulative").print_stats(self.top)
+            # pstats starts with a few lines about the stats as a whole, which only repeat the numbers above
+            lines.extend("   " + line for line in output.getvalue().splitlines()
+                         if line.strip() and "function calls" not in line
+                         and not line.strip().startswith(("Ordered by", "List reduced")))
+        traced = sum(self.traced[key] for key in keys)
+        if traced > 0:
+            sites = defaultdict(lambda: [0, 0])
+            for key in keys:
+                for site, (size, count) in self.allocations[key].items():
+                    sites[site][0] += size
+                    sites[site][1] += count
+            lines.append("   allocations still held at the end of the turn (%d turns traced, peak %.1f KB):"
+                         % (traced, max(self.peaks[key] for key in keys) / 1024))
+            for (filename, lineno), (size, count) in sorted(sites.items(), key=lambda item: -item[1][0])[:self.top]:
+                lines.append("   %10.1f KB %8d blocks  %s:%d" % (size / 1024, count, os.path.basename(filename), lineno))
+        return lines
+
+    # write(path): Writes the report to a file, replacing it in one step so a reader never sees half of it.
+    # Input: The path of the file.
+    # Returns: Nothing
+    def write(self, path):
+        temporary = path + ".tmp"
+        with open(temporary, "w") as output:
+            output.write(self.render())
+        os.replace(temporary, path)
@@ -0,0 +1,135 @@
+# Offline replay of recorded conversations through nlu -> update_dst -> dialogue_policy -> nlg.
+# Transcripts are read from a JSONL file, one conversation per line:
+#     {"id": "abc", "utterances": ["yes", "yes", "a fever and a cough", ...], "seed": 7, "now": "2026-10-14T09:00"}
+# ("id", "seed" and "now" are optional; the seed picks between the template variants and defaults to the id,
+# and "now" is when the conversation took place, which days like "tomorrow" are relative to).
+# Conversations are spread over a process pool, since the POS tagging is CPU-bound, and the results are
+# written to the output JSONL in the same order as the input, one line per conversation.
+# Usage: python replay.py transcripts.jsonl results.jsonl [--workers N] [--chunk-size N]
+import argparse
+from collections import deque
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+import chatbot
+
+
+# replay_conversation(record, default_id): Runs one recorded conversation through a fresh session.
+# Input: The transcript as a dictionary, and the id to use if it doesn't have one.
+# Returns: A dictionary with the conversation's id, every turn, the state it ended in, and how many recorded
+#          utterances were left over after the conversation was already over.
+def replay_conversation(record, default_id):
+    conversation_id = record.get("id", default_id)
+    random.seed(record.get("seed", conversation_id))
+    session = chatbot.DialogueSession(conversation_id)
+    if "now" in record:
+        now = datetime.datetime.fromisoformat(record["now"])
+        session.clock = lambda: now
+    turns = [{"user": None, "bot": session.start(), "state": session.state}]
+    utterances = record.get("utterances", [])
+    used = 0
+    for utterance in utterances:
+        if session.finished:
+            break
+        turns.append({"user": utterance, "bot": session.turn(utterance), "state": session.state})
+        used += 1
+    return {"id": conversation_id, "turns": turns, "final_state": session.state,
+            "unused_utterances": len(utterances) - used}
+
+
+# replay_chunk(lines): Replays a chunk of transcript lines.  This is what runs in the worker processes.
+# Input: A list of (line number, JSONL line) pairs.
+# Returns: A list of (number of turns, JSONL result line) pairs, in the same order.
+def replay_chunk(lines):
+    results = []
+    for number, line in lines:
+        result = replay_conversation(json.loads(line), number)
+        results.append((len(result["turns"]) - 1, json.dumps(result)))
+    return results
+
+
+# start_worker(): Loads the tokenizer and tagger once in each worker, before it gets any conversations.
+# Input: Nothing
+# Returns: Nothing
+def start_worker():
+    chatbot.preload()
+
+
+# read_chunks(transcripts, chunk_size): Streams the transcript file in chunks of conversations.
+# Input: An open transcript file, and how many conversations to put in each chunk.
+# Returns: A generator of lists of (line number, line) pairs.  Blank lines are skipped.
+def read_chunks(transcripts, chunk_size):
+    lines = ((number, line) for number, line in enumerate(transcripts, 1) if line.strip())
+    while True:
+        chunk = list(itertools.islice(lines, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+# replay(transcripts, results, workers, chunk_size): Replays every conversation in the transcripts, writing
+#                                                    the results in order as soon as they are ready.
+# Input: An open transcript file, an open file for the results, how many worker processes to use (0 replays
+#        in this process), and how many conversations each worker gets at a time.
+# Returns: A dictionary with how many conversations and turns were replayed, and how long it took.
+def replay(transcripts, results, workers, chunk_size=16):
+    conversations = 0
+    turns = 0
+    start = time.perf_counter()
+
+    # write_chunk(chunk): Writes out a replayed chunk and counts it.
+    def write_chunk(chunk):
+        nonlocal conversations, turns
+        for turn_count, line in chunk:
+            results.write(line + "\n")
+            conversations += 1
+            turns += turn_count
+
+    if workers == 0:
+        start_worker()
+        for chunk in read_chunks(transcripts, chunk_size):
+            write_chunk(replay_chunk(chunk))
+    else:
+        with multiprocessing.Pool(workers, initializer=start_worker) as pool:
+            # only a few chunks per worker are in flight at a time, so huge archives are streamed through
+            # instead of being read into memory all at once
+            pending = deque()
+            for chunk in read_chunks(transcripts, chunk_size):
+                pending.append(pool.apply_async(replay_chunk, (chunk,)))
+                if len(pending) >= workers * 4:
+                    write_chunk(pending.popleft().get())
+            while pending:
+                write_chunk(pending.popleft().get())
+            # let the workers finish on their own (leaving the with block terminates them, so they wouldn't get to
+            # write their profiles, with CHATBOT_PROFILE set)
+            pool.close()
+            pool.join()
+
+    return {"conversations": conversations, "turns": turns, "seconds": time.perf_counter() - start}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded conversations through the chatbot.")
+    parser.add_argument("transcripts", help="JSONL file with one recorded conversation per line")
+    parser.add_argument("results", help="JSONL file to write the replayed conversations to")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="worker processes to use, 0 to replay in this process (default: one per core)")
+    parser.add_argument("--chunk-size", type=int, default=16, help="conversations sent to a worker at a time")
+    args = parser.parse_args()
+
+    with open(args.transcripts) as transcripts, open(args.results, "w") as results:
+        stats = replay(transcripts, results, args.workers, args.chunk_size)
+    seconds = max(stats["seconds"], 1e-9)
+    print("replayed %d conversations (%d turns) in %.2fs: %.1f conversations/s, %.1f turns/s"
+          % (stats["conversations"], stats["turns"], stats["seconds"], stats["conversations"] / seconds,
+             stats["turns"] / seconds), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1050 @@
+# Regression checks for the optimized pipeline stages.  Most checks drive the code in chatbot.py and the
+# reference copy in legacy.py (or the slow path the optimized one stands in for) with the same inputs and report
+# any case where they disagree; the rest check the pieces around the pipeline against what they promise.
+# Usage: python selfcheck.py [check ...]
+import asyncio
+from collections import defaultdict
+import datetime
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import appointments
+import chatbot
+import export
+import journal
+import legacy
+import metrics
+import replay
+import server
+import timeparse
+
+
+# SkipCheck: Raised by a check that can't run here, with the reason.
+class SkipCheck(Exception):
+    pass
+
+
+# same_state(dst, expected): Checks a dialogue state against the dictionary the original chatbot would have
+#                            stored, which kept its histories in full.
+# Input: A chatbot.DialogueState and the original dictionary.
+# Returns: True if they hold the same slots and values.
+def same_state(dst, expected):
+    wanted = {}
+    for slot, value in expected.items():
+        if slot in chatbot.dst_histories:
+            if len(value) == 0:
+                continue
+            value = value[-chatbot.History.capacity:]
+        wanted[slot] = value
+    return dst.as_dict() == wanted
+
+
+# nlg_cases(): All the (state, slots) combinations nlg can be asked to render.
+# Input: Nothing
+# Returns: A list of (state, slots) pairs.
+def nlg_cases():
+    cases = []
+    for state in chatbot.templates:
+        # the calendar states are newer than the original nlg, so there is nothing to compare them to
+        if state not in ("confirm", "book_appointment", "suggest_time", "no_openings"):
+            cases.append((state, []))
+    lists = [["fever"], ["fever", "cough"], ["fever", "cough", "shortness of breath"], ["mom", "mom"], [],
+             ["a", "b", "a"]]
+    clarifications = ["clarify_symptoms", "clarify_family_history", "clarify_outside_contact", "clarify_other_issues"]
+    cases.append(("confirm", [("date_and_time", "tomorrow at 3pm")]))
+    cases.append(("book_appointment", [("date_and_time", "Monday at 10am")]))
+    # every subset of the clarification slots, in the order dialogue_policy gives them
+    for mask in range(1, 16):
+        for value in lists:
+            slots = [("date_and_time", "next Friday at noon")]
+            for k in range(4):
+                if mask & (1 << k):
+                    slots.append((clarifications[k], value))
+            cases.append(("book_appointment", slots))
+    return cases
+
+
+# check_nlg(): nlg has to generate exactly what the original nlg generated, including the random
+#              choice between templates and what gets added to the dialogue state history.
+# Input: Nothing
+# Returns: A list of strings describing any mismatches.
+def check_nlg():
+    failures = []
+    for state, slots in nlg_cases():
+        for seed in range(4):
+            expected_dst = defaultdict(list)
+            random.seed(seed)
+            expected = legacy.nlg(expected_dst, state, slots)
+            actual_dst = chatbot.new_dst()
+            random.seed(seed)
+            actual = chatbot.nlg(actual_dst, state, slots)
+            if actual != expected or not same_state(actual_dst, expected_dst):
+                failures.append("nlg(%r, %r): %r != %r" % (state, slots, actual, expected))
+    return failures
+
+
+# check_booking(): The booking summaries have to come out exactly like the original nlg's, whether the cache is
+#                  off, cold or warm, including for clarifications that only differ in how their values are split
+#                  up, and for the same clarifications at different times.
+# Input: Nothing
+# Returns: A list of strings describing any mismatches.
+def check_booking():
+    failures = []
+    cases = [(state, slots) for state, slots in nlg_cases() if state == "book_appointment" and len(slots) > 1]
+    for when in ["tomorrow at 3pm", "Monday at 10am", "next Friday at noon"]:
+        for values in [["a, b"], ["a", "b"], ["a b"], ["fever", "cough"], ["fever, cough"]]:
+            cases.append(("book_appointment", [("date_and_time", when), ("clarify_symptoms", values),
+                                               ("clarify_outside_contact", values)]))
+    maxsize = chatbot.booking_summary_cache.maxsize
+    try:
+        for setting, size in [("off", 0), ("cold", maxsize), ("warm", maxsize)]:
+            chatbot.booking_summary_cache.resize(size)
+            if setting != "warm":
+                chatbot.booking_summary_cache.clear()
+            for state, slots in cases:
+                for seed in range(2):
+                    random.seed(seed)
+                    expected = legacy.nlg(defaultdict(list), state, slots)
+                    random.seed(seed)
+                    actual = chatbot.nlg(chatbot.new_dst(), state, slots)
+                    if actual != expected:
+                        failures.append("nlg(%r, %r) with the cache %s: %r != %r" % (state, slots, setting, actual,
+                                                                                  expected))
+            info = chatbot.booking_summary_cache.info()
+            if (info["hits"] > 0) != (setting != "off"):
+                failures.append("the booking summary cache had %d hits with the cache %s" % (info["hits"], setting))
+    finally:
+        chatbot.booking_summary_cache.resize(maxsize)
+        chatbot.booking_summary_cache.clear()
+    return failures
+
+
+# Answers people actually give, plus the words that trip up the patterns ("nothing", "know", "yesterday",
+# "unsure", "OK" in capitals, ...).
+yes_no_corpus = [
+    "yes", "Yes", "YES", "yes.", "yes!", "yeah", "Yeah I do", "yep", "yup", "Yup!", "yupp", "yuppers", "sure",
+    "Sure thing", "unsure", "not sure", "ok", "Ok", "OK", "okay", "Okay then", "oK", "no", "No", "NO", "no.",
+    "nope", "Nope!", "nah", "Nahh", "nahhh no", "naht", "nah-uh", "I don't", "don't think so", "I dont",
+    "Don'tcha", "don't!", "nothing", "Nothing really", "I know", "I don't know", "not really", "none",
+    "yesterday", "yes and no", "yes, no", "no, yes", "well... yes", "maybe", "I guess", "hmm", "", " ",
+    "sounds good", "yes please", "of course", "absolutely", "definitely not", "nooo", "Noooo way", "eyes",
+    "bye", "yee", "ye", "Ye", "noted", "Nokia", "nok", "snow", "knot", "banana", "penalty", "Monday",
+    "sure, no", "no sure", "yup no", "yes I don't", "I'm okay", "OKAY", "ok no", "hokey", "Bokeh",
+    "I would like to book an appointment", "no thanks", "not now", "yes\nno", "no\tyes", "yes_no", "no_yes",
+    "yes9", "9yes", "don't_", "nah_", "yup_", "yup9", "n\u00e0h", "\u00e9yes", "caf\u00e9no", "yes\u00e9",
+]
+
+
+# fuzz_yes_no_corpus(count, seed): Random utterances glued together out of cue fragments and the characters
+#                                 that sit around word boundaries.
+# Input: How many utterances to make, and the random seed.
+# Returns: A list of strings.
+def fuzz_yes_no_corpus(count=5000, seed=0):
+    fragments = ["ye", "Ye", "s", "sure", "Sure", "yup", "Yup", "up", "no", "No", "na", "nah", "Nahh", "h",
+                 "ok", "OK", "Ok", "oK", "k", "don't", "Don't", "dont", "'", "t", "x", "a", "e", "_", "9", " ",
+                 " ", ",", ".", "!", "-", "\u00e9"]
+    generator = random.Random(seed)
+    corpus = []
+    for k in range(count):
+        corpus.append("".join(generator.choice(fragments) for j in range(generator.randint(0, 8))))
+    return corpus
+
+
+# check_intents(): The single-pass intent matcher has to classify every utterance exactly like the
+#                  original yes/no and greeting patterns did.
+# Input: Nothing
+# Returns: A list of strings describing any mismatches.
+def check_intents():
+    failures = []
+    for utterance in yes_no_corpus + fuzz_yes_no_corpus():
+        expected = legacy.answer_yes_no(utterance)
+        actual = chatbot.intent_matcher.answer(utterance)
+        if actual != expected:
+            failures.append("answer(%r): %r != %r" % (utterance, actual, expected))
+        expected = legacy.greeting_answer(utterance)
+        actual = chatbot.intent_matcher.greeting(utterance)
+        if actual != expected:
+            failures.append("greeting(%r): %r != %r" % (utterance, actual, expected))
+    return failures
+
+
+# Things a patient might say at any point of the conversation
+policy_utterances = ["yes", "no", "sure", "nope", "OK", "I know", "maybe", "thank you", "", "tomorrow at 3pm",
+                     "next Friday at 10:30 am", "3pm on Monday", "today", "at noon", "yes and no"]
+policy_values = [[], ["fever"], ["fever", "cough"], ["mom", "dad", "uncle bob"]]
+
+
+# check_policy(): The table-driven policy, which picks up from where it was last turn, has to choose exactly
+#                 the same states as the original policy on randomized conversations.
+# Input: Nothing
+# Returns: A list of strings describing any mismatches.
+def check_policy(conversations=3000):
+    failures = []
+    for seed in range(conversations):
+        generator = random.Random(seed)
+        session = chatbot.DialogueSession()
+        expected_dst = defaultdict(list)
+        slots_and_values = []
+        for turn in range(40):
+            # the original pipeline: policy on a copy of the tracker, which it resets the confirm slot in
+            chatbot.update_dst(expected_dst, slots_and_values)
+            expected_state, expected_slots = legacy.dialogue_policy(dict(expected_dst), expected_dst)
+            random.seed(seed * 100 + turn)
+            expected = chatbot.nlg(expected_dst, expected_state, expected_slots)
+
+            random.seed(seed * 100 + turn)
+            actual = session.respond(slots_and_values)
+            if actual != expected or session.state != expected_state or not same_state(session.dst, expected_dst):
+                failures.append("conversation %d, turn %d: %r != %r" % (seed, turn, actual, expected))
+                break
+            if session.finished:
+                break
+
+            # clarification answers come with their values already extracted, so no tagger is needed
+            utterance = generator.choice(policy_utterances)
+            slots_and_values = chatbot.nlu(session.dst, utterance, generator.choice(policy_values))
+    return failures
+
+
+# Clarification answers that the lexicons fully understand, for each kind of thing being clarified, so checks
+# that run them through nlu don't need the tagger
+lexicon_answers = {
+    chatbot.symptom_pos: ["fever", "a fever and a cough", "a bad headache, chills", "shortness of breath",
+                          "cough and a runny nose"],
+    chatbot.name_pos: ["my mom", "my mom and my dad", "my sister, my coworker, the mailman"],
+}
+
+
+# tagger_ready(): Checks whether nltk and the tokenizer and tagger data are installed, for the checks that can't
+#                 run without them.
+# Input: Nothing
+# Returns: True if chatbot.preload works.
+def tagger_ready():
+    try:
+        chatbot.preload()
+    except (ImportError, LookupError):
+        return False
+    return True
+
+
+# (clarification answer, POS tags kept, the values the tagger extracts from it) for answers that the lexicons
+# understand on their own
+lexicon_cases = [
+    ("a fever and a cough", chatbot.symptom_pos, ["fever", "cough"]),
+    ("a bad headache, chills", chatbot.symptom_pos, ["bad headache", "chills"]),
+    ("shortness of breath", chatbot.symptom_pos, ["shortness of breath"]),
+    ("a high fever", chatbot.symptom_pos, ["high fever"]),
+    ("a dry cough and a runny nose", chatbot.symptom_pos, ["dry cough", "runny nose"]),
+    ("I have a severe headache", chatbot.symptom_pos, ["severe headache"]),
+    ("loss of taste, muscle aches, fatigue", chatbot.symptom_pos, ["loss of taste", "muscle aches", "fatigue"]),
+    ("trouble breathing", chatbot.symptom_pos, ["trouble breathing"]),
+    ("my mom", chatbot.name_pos, ["mom"]),
+    ("my mom and my dad", chatbot.name_pos, ["mom", "dad"]),
+    ("my sister, my coworker, the mailman", chatbot.name_pos, ["sister", "coworker", "mailman"]),
+    ("my grandma", chatbot.name_pos, ["grandma"]),
+    ("my in-laws", chatbot.name_pos, ["in-laws"]),
+]
+
+# Answers with something the lexicons don't know, which have to be left to the tagger
+tagger_cases = [
+    ("fi\u00e8vre", chatbot.symptom_pos), ("a fever, 3", chatbot.symptom_pos), ("fever 3", chatbot.symptom_pos),
+    ("fever for 3 days", chatbot.symptom_pos), ("a cough and a fi\u00e8vre", chatbot.symptom_pos),
+    ("my back hurts", chatbot.symptom_pos),
+    ("my mom and 2 cousins", chatbot.name_pos), ("my best friend", chatbot.name_pos),
+    ("my mom's friend", chatbot.name_pos), ("a bad cough", chatbot.name_pos), ("my mom", chatbot.symptom_pos),
+]
+
+
+# check_lexicon(): The lexicons have to extract exactly what the tagger would from the answers they understand,
+#                  and leave every answer with a word they don't know to the tagger.  The tagger's values are
+#                  written down in lexicon_cases, and checked against the tagger itself if its data is installed.
+# Input: Nothing
+# Returns: A list of strings describing any mismatches.
+def check_lexicon():
+    failures = []
+    for answer, validpos, expected in lexicon_cases:
+        actual = chatbot.listed_value_lexicons[validpos].match(chatbot.split_listed_values(answer))
+        if actual != expected:
+            failures.append("match(%r): %r != %r" % (answer, actual, expected))
+    for answer, validpos in tagger_cases:
+        actual = chatbot.listed_value_lexicons[validpos].match(chatbot.split_listed_values(answer))
+        if actual is not None:
+            failures.append("match(%r): %r, instead of leaving it to the tagger" % (answer, actual))
+    if tagger_ready():
+        tagged = chatbot.tag_listed_values([(answer, validpos) for answer, validpos, expected in lexicon_cases])
+        for (answer, validpos, expected), actual in zip(lexicon_cases, tagged):
+            if actual != expected:
+                failures.append("tag_listed_values(%r): %r != %r" % (answer, actual, expected))
+    return failures
+
+
+# check_batch(): Understanding a batch of answers (nlu_batch) has to give exactly what understanding each answer
+#                on its own (nlu) gives, on randomized conversations that are all at different points.
+# Input: Nothing
+# Returns: A list of strings describing any mismatches.
+def check_batch(conversations=200):
+    failures = []
+    generator = random.Random(0)
+    sessions = [chatbot.DialogueSession(clock=lambda: date_time_now) for k in range(conversations)]
+    for session in sessions:
+        session.start()
+    for turn in range(40):
+        sessions = [session for session in sessions if not session.finished]
+        if len(sessions) == 0:
+            break
+        # clarifications are answered with things the lexicons know, and everything else with anything at all
+        utterances = []
+        for session in sessions:
+            question = session.dst["dialogue_state_history"][-1]
+            if question in chatbot.clarification_pos:
+                utterances.append(generator.choice(lexicon_answers[chatbot.clarification_pos[question]]))
+            else:
+                utterances.append(generator.choice(policy_utterances))
+        requests = [(session.dst, utterance, date_time_now) for session, utterance in zip(sessions, utterances)]
+        batch = chatbot.nlu_batch(requests)
+        for session, utterance, slots_and_values in zip(sessions, utterances, batch):
+            expected = chatbot.nlu(session.dst, utterance, None, date_time_now)
+            if slots_and_values != expected:
+                failures.append("nlu_batch(%r) in %r: %r != %r" % (utterance, session.state, slots_and_values,
+                                                                   expected))
+            session.respond(slots_and_values)
+    return failures
+
+
+# FixedClassifier: A stand-in for the answer classifier, which gives every answer the same label with the same
+# confidence.
+class FixedClassifier:
+    def __init__(self, label, confidence):
+        self.label = label
+        self.confidence = confidence
+
+    def classify_batch(self, answers):
+        return [self.label] * len(answers), [self.confidence] * len(answers)
+
+
+# check_classifier(): With the answer classifier on, nlu_batch has to use its label only where it is at least
+#                     answer_confidence sure, and leave every other answer to intent_matcher exactly like nlu does.
+# Input: Nothing
+# Returns: A list of strings describing any mismatches.
+def check_classifier():
+    failures = []
+    greeted = chatbot.DialogueSession()
+    greeted.start()
+    asked = chatbot.DialogueSession()
+    asked.start()
+    asked.respond(chatbot.nlu(asked.dst, "yes"))
+    answers = yes_no_corpus[:40]
+    requests = [(session.dst, answer, date_time_now) for session in (greeted, asked) for answer in answers]
+    matched = [chatbot.nlu(dst, answer, None, now) for dst, answer, now in requests]
+    default = chatbot.answer_confidence
+    try:
+        for confidence in (0.5, 0.8, 0.95):
+            chatbot.enable_answer_classifier(confidence)
+            # a label it isn't sure enough of is ignored, and one it is sure enough of is used
+            chatbot.answer_classifier = FixedClassifier("no", confidence - 0.01)
+            if chatbot.nlu_batch(requests) != matched:
+                failures.append("nlu_batch used labels below answer_confidence=%g" % confidence)
+            chatbot.answer_classifier = FixedClassifier("no", confidence)
+            expected = [chatbot.nlu(dst, answer, None, now, "no") for dst, answer, now in requests]
+            if chatbot.nlu_batch(requests) != expected:
+                failures.append("nlu_batch didn't use labels at answer_confidence=%g" % confidence)
+            chatbot.answer_classifier = FixedClassifier("unclear", 1.0)
+            expected = [chatbot.nlu(dst, answer, None, now, "none") for dst, answer, now in requests]
+            if chatbot.nlu_batch(requests) != expected:
+                failures.append("nlu_batch didn't take \"unclear\" for no answer")
+        # the real model is never more than certain
+        if chatbot.enable_answer_classifier(1.01) is not None and chatbot.nlu_batch(requests) != matched:
+            failures.append("nlu_batch used the model's labels with a threshold it can't reach")
+    finally:
+        chatbot.disable_answer_classifier()
+        chatbot.answer_confidence = default
+    return failures
+
+
+# word_tag(answers): A stand-in for chatbot.tag_listed_values, for checks that are about what happens around the
+#                    tagging rather than the tagging itself.  It keeps every word that isn't "a", "my" or "the".
+# Input: A list of (input, validpos) pairs.
+# Returns: A list with the extracted values (a list of strings) for each of the answers.
+def word_tag(answers):
+    extracted = []
+    for input, validpos in answers:
+        listofvalues = []
+        for piece in chatbot.split_listed_values(input):
+            toadd = " ".join(word for word in piece.split() if word.lower() not in ("a", "my", "the"))
+            if len(toadd) > 0:
+                listofvalues.append(toadd)
+        extracted.append(listofvalues)
+    return extracted
+
+
+# Clarification answers that come in different cases and spacings, known to the lexicons or not
+cache_answers = ["fever and cough", "Fever and Cough", "FEVER AND COUGH", "fever  and cough", " fever and cough ",
+                 "fever\tand cough", "fever,cough", "fever , cough", "Fever,  Cough ", "my Mom", "my  mom",
+                 "a zorp and a blip", "A Zorp and a BLIP", "a zorp  and  a blip", "zorp,blip", " zorp , blip",
+                 "fièvre", "Fièvre ", "fever for 3 days", "fever  for 3 days", "", " ", ",", "and"]
+
+
+# check_cache(): Extracting listed values through the cache has to give what extracting them without it gives,
+#                for every spelling of an answer, the cache has to stay within its size, and it has to hold up
+#                to being used from many threads at once.
+# Input: Nothing
+# Returns: A list of strings describing any mismatches.
+def check_cache():
+    failures = []
+    answers = [(answer, validpos) for answer in cache_answers for validpos in (chatbot.symptom_pos, chatbot.name_pos)]
+    maxsize = chatbot.listed_values_cache.maxsize
+    try:
+        chatbot.listed_values_cache.resize(0)
+        expected = [chatbot.extract_listed_values([answer], word_tag)[0] for answer in answers]
+        chatbot.listed_values_cache.resize(maxsize)
+        chatbot.listed_values_cache.clear()
+        # every answer once on its own (after the other spellings of it are cached), then all of them in a batch
+        for answer, listofvalues in zip(answers, expected):
+            actual = chatbot.extract_listed_values([answer], word_tag)[0]
+            if actual != listofvalues:
+                failures.append("extract_listed_values(%r): %r != %r" % (answer, actual, listofvalues))
+        actual = chatbot.extract_listed_values(answers, word_tag)
+        if actual != expected:
+            failures.append("extract_listed_values(%r): %r != %r" % (answers, actual, expected))
+        if chatbot.listed_values_cache.info()["hits"] == 0:
+            failures.append("extract_listed_values never hit the cache")
+
+        # the least recently used entries go first, and a lookup counts as a use
+        cache = chatbot.LRUCache(3)
+        for key in range(5):
+            cache.put(key, [key])
+            cache.get(2)
+        if sorted(cache.entries) != [2, 3, 4] or cache.info()["size"] != 3:
+            failures.append("LRUCache(3) holds %r after 5 puts" % list(cache.entries))
+        cache.resize(1)
+        if list(cache.entries) != [2]:
+            failures.append("LRUCache resized to 1 holds %r" % list(cache.entries))
+
+        # threads that look up and cache overlapping keys, and extract values through the shared cache
+        cache = chatbot.LRUCache(16)
+        chatbot.listed_values_cache.resize(8)
+        errors = []
+
+        def hammer(seed):
+            generator = random.Random(seed)
+            try:
+                for k in range(2000):
+                    key = generator.randrange(40)
+                    value = cache.get(key)
+                    if value is None:
+                        cache.put(key, [key])
+                    elif value != [key]:
+                        errors.append("LRUCache.get(%r) gave %r" % (key, value))
+                    answer = generator.randrange(len(answers))
+                    if chatbot.extract_listed_values([answers[answer]], word_tag)[0] != expected[answer]:
+                        errors.append("extract_listed_values(%r) changed from a thread" % (answers[answer],))
+            except Exception as error:
+                errors.append("thread failed: %r" % error)
+
+        threads = [threading.Thread(target=hammer, args=(seed,)) for seed in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        failures.extend(sorted(set(errors)))
+        info = cache.info()
+        if info["hits"] + info["misses"] != 8 * 2000 or info["size"] > 16:
+            failures.append("LRUCache counted %r after 16000 lookups from 8 threads" % info)
+        if len(chatbot.listed_values_cache.entries) > 8:
+            failures.append("listed_values_cache grew to %d entries" % len(chatbot.listed_values_cache.entries))
+    finally:
+        chatbot.listed_values_cache.resize(maxsize)
+        chatbot.listed_values_cache.clear()
+    return failures
+
+
+# replay_transcripts(count): Random recorded conversations in replay.py's transcript format.
+# Input: How many conversations to make.
+# Returns: A list of JSONL lines.
+def replay_transcripts(count=60):
+    generator = random.Random(0)
+    answers = policy_utterances + [answer for kind in lexicon_answers.values() for answer in kind]
+    lines = []
+    for k in range(count):
+        record = {"utterances": [generator.choice(answers) for turn in range(generator.randint(0, 25))],
+                  "now": (date_time_now + datetime.timedelta(hours=k)).isoformat()}
+        # some of them take their id (and so their seed) from the line they are on
+        if k % 3 > 0:
+            record["id"] = "conversation-%d" % k
+        if k % 4 == 0:
+            record["seed"] = k
+        lines.append(json.dumps(record) + "\n")
+        # blank lines are skipped, but still count for the line numbers
+        if k % 10 == 0:
+            lines.append("\n")
+    return lines
+
+
+# check_replay(): Replaying conversations over a process pool has to give exactly what replaying them in this
+#                 process gives, in the same order, whatever size the chunks are.  The workers load the tagger, so
+#                 this only runs if its data is installed.
+# Input: Nothing
+# Returns: A list of strings describing any mismatches.
+def check_replay():
+    if not tagger_ready():
+        raise SkipCheck("it needs the nltk tokenizer and tagger data")
+    failures = []
+    lines = replay_transcripts()
+    expected = io.StringIO()
+    replay.replay(lines, expected, 0)
+    expected = expected.getvalue().splitlines()
+    ids = [record.get("id", number) for number, record in
+           ((number, json.loads(line)) for number, line in enumerate(lines, 1) if line.strip())]
+    if [json.loads(line)["id"] for line in expected] != ids:
+        failures.append("replay with no workers wrote the conversations out of order")
+    for workers, chunk_size in ((1, 1), (2, 3), (3, 16)):
+        for attempt in range(2):
+            actual = io.StringIO()
+            stats = replay.replay(lines, actual, workers, chunk_size)
+            actual = actual.getvalue().splitlines()
+            if stats["conversations"] != len(ids):
+                failures.append("replay(workers=%d) replayed %d of %d conversations"
+                                % (workers, stats["conversations"], len(ids)))
+            for line, wanted in zip(actual, expected):
+                if line != wanted:
+                    failures.append("replay(workers=%d, chunk_size=%d): %s != %s" % (workers, chunk_size, line,
+                                                                                      wanted))
+                    break
+    return failures
+
+
+# check_metrics(): Every latency has to be counted in the first histogram bucket it fits under (the bounds are
+#                  inclusive, like Prometheus' "le"), the exported histograms have to add up, and writing the
+#                  metrics out has to replace the file in one step.
+# Input: Nothing
+# Returns: A list of strings describing any mismatches.
+def check_metrics():
+    failures = []
+    recorder = metrics.TurnMetrics(retry_states=["create_appointment_again"])
+    expected = [0] * (len(metrics.latency_buckets) + 1)
+    observed = [0.0, 1e-9]
+    for bound in metrics.latency_buckets:
+        observed += [bound, bound * 1.0001]
+    observed += [2.0, 60.0]
+    for seconds in observed:
+        bucket = 0
+        while bucket < len(metrics.latency_buckets) and metrics.latency_buckets[bucket] < seconds:
+            bucket += 1
+        expected[bucket] += 1
+        recorder.observe("nlu", seconds)
+    if recorder.buckets["nlu"] != expected:
+        failures.append("observe put %r in buckets %r, not %r" % (observed, recorder.buckets["nlu"], expected))
+    recorder.count_turn([("user_intent_history", "respond_symptoms"), ("symptoms", "yes")], "clarify_symptoms")
+    recorder.count_turn([("user_intent_history", "unknown_date")], "create_appointment_again")
+
+    rendered = recorder.render()
+    total = 0
+    wanted = []
+    for bound, count in zip(metrics.latency_buckets + ("+Inf",), expected):
+        total += count
+        wanted.append('chatbot_stage_seconds_bucket{stage="nlu",le="%s"} %d' % (bound, total))
+    wanted += ['chatbot_stage_seconds_count{stage="nlu"} %d' % len(observed),
+               'chatbot_stage_seconds_count{stage="turn"} 0',
+               'chatbot_intents_total{intent="respond_symptoms"} 1',
+               'chatbot_states_total{state="create_appointment_again"} 1',
+               'chatbot_retry_loops_total{state="create_appointment_again"} 1']
+    lines = rendered.splitlines()
+    for line in wanted:
+        if line not in lines:
+            failures.append("render() doesn't have %r" % line)
+    if 'chatbot_retry_loops_total{state="clarify_symptoms"} 1' in lines:
+        failures.append("render() counted clarify_symptoms as a retry")
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "metrics.prom")
+        recorder.write(path)
+        with open(path) as written:
+            if written.read() != rendered:
+                failures.append("write() didn't write what render() gives")
+        if os.listdir(directory) != ["metrics.prom"]:
+            failures.append("write() left %r behind" % os.listdir(directory))
+
+        # a write that fails part of the way through leaves the last complete file in place
+        def broken():
+            raise OSError("disk full")
+        recorder.render = broken
+        try:
+            recorder.write(path)
+            failures.append("write() didn't fail")
+        except OSError:
+            pass
+        with open(path) as written:
+            if written.read() != rendered:
+                failures.append("a failed write() changed the file")
+    finally:
+        shutil.rmtree(directory)
+    return failures
+
+
+# check_calendar(): A slot can only be booked once, only its owner can free it, the nearest free slot is found
+#                   across nights and weekends, and threads racing for the last slot can't both get it.
+# Input: Nothing
+# Returns: A list of strings describing any mismatches.
+def check_calendar():
+    failures = []
+    friday = datetime.datetime(2026, 10, 16)
+    calendar = appointments.AppointmentCalendar()
+    if not calendar.reserve(friday.replace(hour=10), "a"):
+        failures.append("reserve() didn't book a free slot")
+    if calendar.reserve(friday.replace(hour=10, minute=15), "b"):
+        failures.append("reserve() booked a slot that was already held")
+    if calendar.owners != {(friday.date(), 2): "a"}:
+        failures.append("the calendar holds %r" % calendar.owners)
+    if calendar.release(friday.replace(hour=10), "b"):
+        failures.append("release() freed a slot for someone who doesn't hold it")
+    if not calendar.release(friday.replace(hour=10, minute=29), "a") or calendar.days or calendar.owners:
+        failures.append("release() didn't free a held slot")
+    for closed in (friday.replace(hour=17), friday.replace(hour=8, minute=59), friday + datetime.timedelta(days=1)):
+        if calendar.reserve(closed, "c"):
+            failures.append("reserve() booked %s, when the office is closed" % closed)
+
+    # (time asked for, slots booked beforehand as (day of October, hour), not_before, horizon, what's offered)
+    evening = friday.replace(hour=20)
+    cases = [
+        (evening, [], None, 14, friday.replace(hour=16, minute=30)),
+        (friday + datetime.timedelta(days=1, hours=10), [], None, 14, friday.replace(hour=16, minute=30)),
+        (friday + datetime.timedelta(days=1, hours=10), [], friday + datetime.timedelta(days=1), 14,
+         datetime.datetime(2026, 10, 19, 9, 0)),
+        (evening, [(16, 16.5)], None, 14, friday.replace(hour=16)),
+        (evening, [(16, hour) for hour in range(9, 17)], None, 14, datetime.datetime(2026, 10, 15, 16, 30)),
+        (evening, [(day, hour) for day in (15, 16) for hour in range(9, 17)], None, 14,
+         datetime.datetime(2026, 10, 14, 16, 30)),
+        (evening, [(day, hour) for day in (15, 16) for hour in range(9, 17)], friday, 14,
+         datetime.datetime(2026, 10, 19, 9, 0)),
+        (evening, [(day, hour) for day in (15, 16) for hour in range(9, 17)], None, 1, None),
+        (friday.replace(hour=12, minute=10), [(16, 12)], friday.replace(hour=12, minute=1), 14,
+         friday.replace(hour=13)),
+    ]
+    for when, booked, not_before, horizon_days, expected in cases:
+        calendar = appointments.AppointmentCalendar()
+        for day, hour in booked:
+            for minute in ((0, 30) if hour == int(hour) else (30,)):
+                calendar.reserve(datetime.datetime(2026, 10, day, int(hour), minute), "booked")
+        actual = calendar.reserve_nearest(when, "patient", not_before, horizon_days)
+        if actual != expected:
+            failures.append("reserve_nearest(%s, not_before=%s, horizon_days=%d) with %d booked: %s != %s"
+                            % (when, not_before, horizon_days, len(booked), actual, expected))
+        elif actual is not None and calendar.owners.get(calendar.slot_of(actual)) != "patient":
+            failures.append("reserve_nearest(%s) didn't book %s" % (when, actual))
+
+    # an office with a single slot, which a handful of threads all try to get at the same time
+    for attempt in range(100):
+        calendar = appointments.AppointmentCalendar(closing=datetime.time(9, 30))
+        start = threading.Barrier(4)
+        booked = []
+
+        def book(owner):
+            start.wait()
+            if owner % 2:
+                booked.append(calendar.reserve(friday.replace(hour=9), owner) and owner)
+            else:
+                booked.append(calendar.reserve_nearest(friday.replace(hour=9), owner, horizon_days=0) and owner)
+
+        threads = [threading.Thread(target=book, args=(owner,)) for owner in range(1, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        winners = [owner for owner in booked if owner]
+        if len(winners) != 1 or calendar.owners != {(friday.date(), 0): winners[0]}:
+            failures.append("4 threads racing for the last slot: %r booked it, the calendar holds %r"
+                            % (winners, calendar.owners))
+            break
+    return failures
+
+
+# journal_turns(registry, generator, count): Runs a round of random turns through the open conversations of a
+#                                            registry, starting new ones to keep count of them going.
+# Input: A chatbot.SessionRegistry, the random.Random to pick with, and how many conversations to keep going.
+# Returns: Nothing
+def journal_turns(registry, generator, count):
+    while len(registry) < count:
+        session = registry.create()
+        session.clock = lambda: date_time_now
+        session.start()
+    for session_id in list(registry.sessions):
+        session = registry.get(session_id)
+        question = session.dst["dialogue_state_history"][-1]
+        if question in chatbot.clarification_pos:
+            registry.turn(session_id, generator.choice(lexicon_answers[chatbot.clarification_pos[question]]))
+        else:
+            registry.turn(session_id, generator.choice(policy_utterances))
+
+
+# check_journal(): Conversations that get cut off (the files are copied mid-conversation, as a crash would leave
+#                  them) have to be picked up from the journal in the same state, with the same slots, and asking
+#                  the same question, with the one written to last coming last, and conversations that were over
+#                  but not closed yet must not be picked up.
+# Input: Nothing
+# Returns: A list of strings describing any mismatches.
+def check_journal():
+    failures = []
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "journal")
+        crashed = os.path.join(directory, "crashed")
+        writer = journal.Journal(path, sync_interval=0.01, snapshot_every=200)
+        registry = chatbot.SessionRegistry(journal=writer)
+        generator = random.Random(0)
+        for rounds in range(30):
+            journal_turns(registry, generator, 20)
+        # the background thread takes a snapshot once enough has been written, and the journal keeps going after it
+        for wait in range(100):
+            if writer.generation > 1:
+                break
+            time.sleep(0.01)
+        if writer.generation == 1:
+            failures.append("the journal was never compacted")
+        for rounds in range(3):
+            journal_turns(registry, generator, 20)
+        # the one written to last is one of the oldest, which doesn't get anywhere with its answer
+        last = [session_id for session_id, session in registry.sessions.items()
+                if session.dst["dialogue_state_history"][-1] not in chatbot.clarification_pos][0]
+        registry.turn(last, "hmm")
+        # a conversation that got to the end, but was cut off before it was closed
+        over = registry.create()
+        over.clock = lambda: date_time_now
+        for user_input in [None, "no", "no", "no", "no", "tomorrow at 3pm", "yes"]:
+            over.start() if user_input is None else over.turn(user_input)
+        if not over.finished:
+            failures.append("the conversation that should be over is in %r" % over.state)
+
+        with writer.lock:
+            shutil.copy(path, crashed)
+            shutil.copy(path + ".snapshot", crashed + ".snapshot")
+        recovered = chatbot.SessionRegistry(journal=journal.Journal(crashed))
+        expected = {session_id: session for session_id, session in registry.sessions.items() if session is not over}
+        if sorted(recovered.sessions) != sorted(expected):
+            failures.append("recovered %r, not %r" % (sorted(recovered.sessions), sorted(expected)))
+        elif list(recovered.sessions)[-1] != last:
+            failures.append("session %r was written to last, but %r came back last"
+                            % (last, list(recovered.sessions)[-1]))
+        for session_id, session in recovered.sessions.items():
+            # a conversation that was cut off is waiting on an answer to its last question, whatever was said after
+            wanted = expected[session_id]
+            question = wanted.dst["dialogue_state_history"][-1]
+            if session.state != question or session.dst.as_dict() != wanted.dst.as_dict():
+                failures.append("session %r came back in %r with %r, not in %r with %r"
+                                % (session_id, session.state, session.dst.as_dict(), question, wanted.dst.as_dict()))
+                continue
+            if session.question() is None:
+                failures.append("session %r came back in %r, with no question to ask again" % (session_id, question))
+            # and it goes on exactly like it would have
+            session.clock = lambda: date_time_now
+            user_input = policy_utterances[session_id % len(policy_utterances)]
+            if question in chatbot.clarification_pos:
+                user_input = lexicon_answers[chatbot.clarification_pos[question]][0]
+            random.seed(session_id)
+            expected_output = wanted.turn(user_input)
+            random.seed(session_id)
+            actual = session.turn(user_input)
+            if actual != expected_output or session.state != wanted.state:
+                failures.append("session %r went on with %r, not %r" % (session_id, actual, expected_output))
+        recovered.journal.close()
+        writer.close()
+    finally:
+        shutil.rmtree(directory)
+    return failures
+
+
+# server_scenario(failures): Connects clients to a small ChatServer: more than it takes at once, ones that all
+#                            send at the same time, one that sends a line that is too long, and ones that go quiet.
+# Input: The list to add any failures to.
+# Returns: Nothing
+async def server_scenario(failures):
+    registry = chatbot.SessionRegistry()
+    chat = server.ChatServer(registry, max_connections=3, max_pending=1, idle_timeout=0.5, line_limit=64)
+    running = 0
+    most = 0
+    turn = chat.turn
+
+    # every turn takes a while, so that turns from different clients would overlap if they were let through
+    async def slow_turn(session, user_input):
+        nonlocal running, most
+        running += 1
+        most = max(most, running)
+        try:
+            await asyncio.sleep(0.02)
+            return await turn(session, user_input)
+        finally:
+            running -= 1
+
+    chat.turn = slow_turn
+    listener = await chat.serve("127.0.0.1", 0)
+    port = listener.sockets[0].getsockname()[1]
+    async with listener:
+        clients = [await asyncio.open_connection("127.0.0.1", port) for k in range(3)]
+        for reader, writer in clients:
+            if not (await reader.readline()).startswith(b"Chatbot: "):
+                failures.append("a client wasn't greeted")
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        if b"too busy" not in await reader.readline() or await reader.readline() != b"":
+            failures.append("a client past max_connections wasn't turned away")
+        writer.close()
+
+        for reader, writer in clients:
+            writer.write(b"yes\n")
+        replies = await asyncio.gather(*[reader.readline() for reader, writer in clients])
+        if most != 1 or not all(reply.startswith(b"Chatbot: ") for reply in replies):
+            failures.append("%d turns ran at once with max_pending=1, and the replies were %r" % (most, replies))
+
+        reader, writer = clients[0]
+        writer.write(b"a fever" * 20 + b"\n")
+        if b"too long" not in await reader.readline() or await reader.readline() != b"":
+            failures.append("a line past line_limit didn't end the conversation")
+        for reader, writer in clients[1:]:
+            start = time.perf_counter()
+            if b"still there" not in await reader.readline() or await reader.readline() != b"":
+                failures.append("a quiet client wasn't hung up on")
+            elif time.perf_counter() - start > 2:
+                failures.append("a quiet client was hung up on after %.1fs" % (time.perf_counter() - start))
+        for reader, writer in clients:
+            writer.close()
+        await asyncio.sleep(0.05)
+        if chat.connections != 0 or len(registry) != 0:
+            failures.append("%d connections and %d sessions are left" % (chat.connections, len(registry)))
+
+
+# check_server(): The server has to turn clients away past its connection limit, only run max_pending turns at
+#                 once, and hang up on lines that are too long and on clients that stop talking.
+# Input: Nothing
+# Returns: A list of strings describing any mismatches.
+def check_server():
+    failures = []
+    try:
+        asyncio.run(asyncio.wait_for(server_scenario(failures), 10))
+    except asyncio.TimeoutError:
+        failures.append("the server stopped answering")
+    return failures
+
+
+# Conversations for check_export: what the patient says, and the session id
+export_scripts = [
+    (["yes", "yes", "a Fever and a COUGH", "no", "yes", "my Mom, my dad", "no", "tomorrow at 3pm", "yes"], 1),
+    (["yes", "no", "no", "no", "no", "next Friday at 10:30 am", "yes"], "s\u00e9ance-2"),
+    (["no"], None),
+    (["yes", "no", "yes", "my mom", "yes", "the mailman", "yes", "shortness of breath", "Monday at 3pm", "yes"], 4),
+]
+
+
+# check_export(): Conversations written through an Exporter (in batches, and picked up again by a second one) have
+#                 to be read back by an ExportReader exactly as they were, and a batch that can't be written for any
+#                 reason has to be reported by flush and close instead of leaving them waiting.
+# Input: Nothing
+# Returns: A list of strings describing any mismatches.
+def check_export():
+    if export.numpy is None:
+        raise SkipCheck("reading an export needs NumPy")
+    failures = []
+    sessions = []
+    for repeat in range(3):
+        for script, session_id in export_scripts:
+            session = chatbot.DialogueSession(session_id, clock=lambda: date_time_now)
+            session.start()
+            for user_input in script:
+                session.turn(user_input)
+            sessions.append(session)
+    expected = []
+    for k, session in enumerate(sessions):
+        finished, appointment, session_id, state, date_and_time, answers, listed = export.session_row(session, k * 60)
+        row = {"finished": finished, "appointment": appointment, "state": state, "session": session_id,
+               "date_and_time": date_and_time}
+        row.update(zip(export.yes_no_slots, answers))
+        row.update((slot, [value.lower() for value in values]) for slot, values in zip(export.list_slots, listed))
+        expected.append(row)
+
+    directory = tempfile.mkdtemp()
+    try:
+        half = len(sessions) // 2
+        with export.Exporter(directory, flush_rows=4, flush_interval=0.05) as exporter:
+            for k in range(half):
+                exporter.add(sessions[k], k * 60)
+            exporter.flush()
+        with export.Exporter(directory, flush_rows=4, flush_interval=0.05) as exporter:
+            for k in range(half, len(sessions)):
+                exporter.add(sessions[k], k * 60)
+        reader = export.ExportReader(directory)
+        if len(reader) != len(expected):
+            failures.append("read back %d conversations, not %d" % (len(reader), len(expected)))
+        for k, row in enumerate(expected):
+            if k < len(reader) and reader.row(k) != row:
+                failures.append("conversation %d came back as %r, not %r" % (k, reader.row(k), row))
+
+        # something that isn't a conversation can't be written, which flush and close have to say
+        exporter = export.Exporter(directory, flush_interval=0.05)
+        exporter.add("not a conversation", 0)
+        for name, method in [("flush", exporter.flush), ("close", exporter.close)]:
+            raised = []
+
+            def wait():
+                try:
+                    method()
+                except Exception as error:
+                    raised.append(error)
+
+            waiting = threading.Thread(target=wait, daemon=True)
+            waiting.start()
+            waiting.join(5)
+            if waiting.is_alive():
+                failures.append("%s() hung after a batch couldn't be written" % name)
+                break
+            elif len(raised) == 0:
+                failures.append("%s() didn't say a batch couldn't be written" % name)
+        if len(export.ExportReader(directory)) != len(expected):
+            failures.append("the batch that couldn't be written changed the export")
+    finally:
+        shutil.rmtree(directory)
+    return failures
+
+
+# Ways of asking for an appointment, including ones that the day and time patterns don't accept
+date_time_corpus = [
+    "tomorrow at 3pm", "Tomorrow at 3 PM", "today at noon", "tonight at 8pm", "tonight at midnight",
+    "next Tuesday at 3:30pm", "next tuesday at 3:30 pm", "this Friday at 10am", "the following Monday at 9am",
+    "Monday at 10:30am", "3pm on Friday", "at 11 in the morning on Wednesday", "Thursday at 4 in the afternoon",
+    "Saturday at 7 in the evening", "Sunday afternoon", "tomorrow afternoon", "tomorrow at noon", "noon tomorrow",
+    "midnight on Sunday", "Friday", "at 3pm", "tomorrow", "sometime next week", "Monday at 13pm", "Monday at 3",
+    "Monday at 3:75pm", "Monday at 12:00am", "monday at 0am", "next  Wednesday at 5pm", "next\tThursday at 1 pm",
+    "Mondays at 3pm", "Monday at 3pmish", "todays at 3pm", "atoday at 3pm", "ytonight at 9pm", "tomorrowland at 2pm",
+    "Tuesday at 10am or Wednesday at 11am", "10am or 11am on Tuesday", "Friday 9:05 AM", "friday 12 pm", "FRIDAY at 3pm",
+    "I'd like Thursday, maybe around 2 pm", "how about the following sunday at 10:45 am?", "3pm", "afternoon",
+    "Wednesday at afternoon", "tomorrow at midnight please", "Tomorrow at 10 in the morning", "this Monday at 9 am",
+]
+
+# The reference time for date_time_cases: Wednesday, October 14 2026 at 9:00
+date_time_now = datetime.datetime(2026, 10, 14, 9, 0)
+
+# (input, the datetime it should resolve to relative to date_time_now)
+date_time_cases = [
+    ("today at noon", datetime.datetime(2026, 10, 14, 12, 0)),
+    ("tonight at 8pm", datetime.datetime(2026, 10, 14, 20, 0)),
+    ("tonight at midnight", datetime.datetime(2026, 10, 15, 0, 0)),
+    ("tomorrow at 3pm", datetime.datetime(2026, 10, 15, 15, 0)),
+    ("tomorrow afternoon", datetime.datetime(2026, 10, 15, 15, 0)),
+    ("noon tomorrow", datetime.datetime(2026, 10, 15, 12, 0)),
+    ("Tomorrow at 10 in the morning", datetime.datetime(2026, 10, 15, 10, 0)),
+    ("Wednesday at 5pm", datetime.datetime(2026, 10, 14, 17, 0)),
+    ("this Wednesday at 5pm", datetime.datetime(2026, 10, 14, 17, 0)),
+    ("next Wednesday at 5pm", datetime.datetime(2026, 10, 21, 17, 0)),
+    ("the following Wednesday at 5pm", datetime.datetime(2026, 10, 28, 17, 0)),
+    ("next Tuesday at 3:30pm", datetime.datetime(2026, 10, 20, 15, 30)),
+    ("Thursday at 4 in the afternoon", datetime.datetime(2026, 10, 15, 16, 0)),
+    ("the following Thursday at 9am", datetime.datetime(2026, 10, 22, 9, 0)),
+    ("3pm on Friday", datetime.datetime(2026, 10, 16, 15, 0)),
+    ("Saturday at 7 in the evening", datetime.datetime(2026, 10, 17, 19, 0)),
+    ("Sunday afternoon", datetime.datetime(2026, 10, 18, 15, 0)),
+    ("midnight on Sunday", datetime.datetime(2026, 10, 19, 0, 0)),
+    ("Monday at 12:00am", datetime.datetime(2026, 10, 19, 0, 0)),
+    ("Monday at 12 pm", datetime.datetime(2026, 10, 19, 12, 0)),
+    ("Monday at 10:45 AM", datetime.datetime(2026, 10, 19, 10, 45)),
+]
+
+
+# date_time_grid(): Every combination of day and time phrase against every day of the week as the reference,
+#                   with the datetime each one should resolve to worked out by counting days forward.
+# Input: Nothing
+# Returns: A list of (input, now, expected datetime) triples.
+def date_time_grid():
+    names = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+    times = [("%d%s" % (hour, meridiem), hour % 12 + (12 if meridiem == "pm" else 0), 0)
+             for hour in range(1, 13) for meridiem in ("am", "pm")]
+    times += [("%d:%02d %s" % (hour, minute, meridiem.upper()), hour % 12 + (12 if meridiem == "pm" else 0), minute)
+              for hour in (1, 6, 11, 12) for minute in (0, 15, 30, 59) for meridiem in ("am", "pm")]
+    times += [("noon", 12, 0), ("afternoon", 15, 0)]
+    cases = []
+    for offset in range(7):
+        now = datetime.datetime(2026, 10, 12, 14, 30) + datetime.timedelta(days=offset)
+        days = [("today", 0), ("tomorrow", 1)]
+        for target, name in enumerate(names):
+            # count forward to the first day with that name (today counts for "this")
+            ahead = 0
+            while (now.weekday() + ahead) % 7 != target:
+                ahead += 1
+            days.append((name, ahead))
+            days.append(("this " + name.lower(), ahead))
+            days.append(("next " + name, ahead if ahead > 0 else 7))
+            days.append(("the following " + name, (ahead if ahead > 0 else 7) + 7))
+        for day, ahead in days:
+            for text, hour, minute in times:
+                expected = datetime.datetime.combine(now.date() + datetime.timedelta(days=ahead),
+                                                     datetime.time(hour, minute))
+                cases.append((day + " at " + text, now, expected))
+                cases.append((text + " " + day, now, expected))
+    return cases
+
+
+# check_times(): The date/time resolver has to accept and reject exactly what the original day and time
+#                patterns did, keep the same surface text, and resolve to the right datetime.
+# Input: Nothing
+# Returns: A list of strings describing any mismatches.
+def check_times():
+    failures = []
+    generator = random.Random(0)
+    fragments = ["today", "Tonight", "tomorrow", "next ", "this ", "the following ", "Monday", "tues", "Fri",
+                 "day", "1", "2", "12", "13", ":30", ":7", " ", "am", "PM", " in the morning", "after", "noon",
+                 "Midnight", "at ", ",", "x"]
+    fuzzed = ["".join(generator.choice(fragments) for j in range(generator.randint(1, 6))) for k in range(5000)]
+    for utterance in date_time_corpus + fuzzed:
+        expected = legacy.date_and_time(utterance)
+        status, appointment = timeparse.resolve(utterance, date_time_now)
+        actual = (status, None if appointment is None else str(appointment))
+        if actual != expected:
+            failures.append("resolve(%r): %r != %r" % (utterance, actual, expected))
+
+    for utterance, now, expected in [(text, date_time_now, when) for text, when in date_time_cases] + date_time_grid():
+        status, appointment = timeparse.resolve(utterance, now)
+        if appointment is None or appointment.when != expected:
+            failures.append("resolve(%r, %s): %r != %s" % (utterance, now, appointment, expected))
+    return failures
+
+
+checks = {
+    "nlg": check_nlg,
+    "booking": check_booking,
+    "intents": check_intents,
+    "policy": check_policy,
+    "lexicon": check_lexicon,
+    "batch": check_batch,
+    "classifier": check_classifier,
+    "cache": check_cache,
+    "replay": check_replay,
+    "metrics": check_metrics,
+    "calendar": check_calendar,
+    "journal": check_journal,
+    "server": check_server,
+    "export": check_export,
+    "times": check_times,
+}
+
+
+def main():
+    names = sys.argv[1:] or list(checks)
+    failed = 0
+    for name in names:
+        try:
+            failures = checks[name]()
+        except SkipCheck as reason:
+            print("%-10s skipped (%s)" % (name, reason))
+            continue
+        for failure in failures:
+            print("FAIL " + name + ": " + failure)
+        print("%-10s %s" % (name, "ok" if not failures else str(len(failures)) + " failures"))
+        failed += len(failures)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+# Network front end: serves many conversations at once over a line-based TCP protocol.  Every connection is one
+# conversation.  The server sends the greeting as soon as a client connects, then answers every line the client
+# sends with one line, and closes the connection once the conversation is over.
+# The POS tagging for clarification answers is CPU-heavy, so it runs in an executor instead of on the event loop
+# (and with --processes, in a pool of worker processes, so it can use every core); everything else in a turn is
+# quick enough to run on the loop itself.
+# There is no journal here: a client that gets disconnected has no way back to its conversation, so there'd be
+# nothing to pick up after a restart.  Picking conversations back up only works in the command line chatbot
+# (python chatbot.py --journal FILE).
+# Usage: python server.py [--host HOST] [--port PORT] [--preload] [--processes N] [--calendar] [--export DIR]
+#                         [--metrics FILE [--metrics-interval SECONDS]] ...
+#        python server.py --load CONVERSATIONS [--concurrency N] [--host HOST] [--port PORT]
+import argparse
+import asyncio
+import concurrent.futures
+import sys
+import time
+
+import appointments
+import chatbot
+
+
+# ChatServer: Runs the conversations of every connected client through one session registry.
+class ChatServer:
+    def __init__(self, registry, executor=None, max_connections=1000, max_pending=64, idle_timeout=300.0,
+                 line_limit=4096, nlu_pool=None):
+        self.registry = registry
+        # where the POS tagging runs (the event loop's default executor if None); with an nlu_pool.NLUPool, the
+        # executor's threads only wait for the worker processes to do it
+        self.executor = executor
+        self.extract = chatbot.extract_listed_values if nlu_pool is None else nlu_pool.extract
+        self.max_connections = max_connections
+        # how many turns can be in progress at once; connections past that wait (without reading anything more
+        # from their socket) until one finishes, which pushes back on clients sending faster than we can answer
+        self.pending = asyncio.Semaphore(max_pending)
+        # how long a client can go without sending a line, or without reading what we sent, before we hang up
+        self.idle_timeout = idle_timeout
+        self.line_limit = line_limit
+        self.connections = 0
+
+    # handle(reader, writer): Runs one client's conversation, from the greeting until it's over or the client
+    #                         hangs up (or stops responding).
+    # Input: The asyncio streams of the connection.
+    # Returns: Nothing
+    async def handle(self, reader, writer):
+        if self.connections >= self.max_connections:
+            await self.hang_up(writer, "Chatbot: Sorry, we're too busy right now. Please try again later.")
+            return
+        self.connections += 1
+        session = self.registry.create()
+        try:
+            await self.send(writer, session.start())
+            while not session.finished:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    await self.send(writer, "Chatbot: Are you still there? I'll have to cut it here.")
+                    break
+                except ValueError:
+                    # the line was longer than line_limit
+                    await self.send(writer, "Chatbot: Sorry, that was too long for me. I'll have to cut it here.")
+                    break
+                if len(line) == 0:
+                    # the client hung up
+                    break
+                async with self.pending:
+                    output = await self.turn(session, line.decode("utf-8", "replace").strip())
+                await self.send(writer, output)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.connections -= 1
+            self.registry.close(session.session_id)
+            await self.hang_up(writer)
+
+    # turn(session, user_input): Runs one turn, with the POS tagging (if the input needs any) in the executor.
+    # Input: The chatbot.DialogueSession and a string containing the user's input.
+    # Returns: A string containing the chatbot's response.
+    async def turn(self, session, user_input):
+        started = time.perf_counter()
+        dst = session.dst
+        listofvalues = None
+        if "dialogue_state_history" in dst and dst["dialogue_state_history"][-1] in chatbot.clarification_pos:
+            answers = [(user_input, chatbot.clarification_pos[dst["dialogue_state_history"][-1]])]
+            loop = asyncio.get_running_loop()
+            listofvalues = (await loop.run_in_executor(self.executor, self.extract, answers))[0]
+        return session.turn(user_input, listofvalues, started)
+
+    # send(writer, output): Sends one line to the client, waiting (up to the idle timeout) for it to be read if
+    #                       the client is falling behind.
+    # Input: The connection's asyncio.StreamWriter, and the line to send.
+    # Returns: Nothing
+    async def send(self, writer, output):
+        writer.write(output.encode("utf-8") + b"\n")
+        await asyncio.wait_for(writer.drain(), self.idle_timeout)
+
+    # hang_up(writer, output): Closes a connection, optionally sending one last line first.
+    # Input: The connection's asyncio.StreamWriter, and optionally the line to send.
+    # Returns: Nothing
+    async def hang_up(self, writer, output=None):
+        try:
+            if output is not None:
+                await self.send(writer, output)
+            writer.close()
+            await writer.wait_closed()
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+
+    # serve(host, port): Starts listening for clients.
+    # Input: The address and port to listen on.
+    # Returns: The asyncio.Server.
+    async def serve(self, host, port):
+        return await asyncio.start_server(self.handle, host, port, limit=self.line_limit)
+
+
+# write_metrics(recorder, path, interval): Rewrites the metrics file every so often, for as long as the server
+#                                          runs, so a scraper (or a person) always sees recent numbers.
+# Input: The metrics.TurnMetrics being recorded in, the path of the file, and the seconds between writes.
+# Returns: Nothing, it runs until it's cancelled.
+async def write_metrics(recorder, path, interval):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # the file is written in the executor, so a slow disk doesn't hold up the turns
+            await loop.run_in_executor(None, recorder.write, path)
+        except OSError as error:
+            print("couldn't write the metrics to %s: %s" % (path, error), file=sys.stderr)
+
+
+# What every patient of the load client says
+load_script = ["yes", "yes", "a fever and a cough", "no", "no", "yes", "my back hurts", "friday at 3pm", "yes"]
+
+
+# load_conversation(host, port, script, latencies): Has one conversation with the server.
+# Input: The server's address and port, the lines to send, and a list to add each turn's latency to (in seconds).
+# Returns: The number of turns the server answered.
+async def load_conversation(host, port, script, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    turns = 0
+    try:
+        await reader.readline()
+        for line in script:
+            start = time.perf_counter()
+            writer.write(line.encode("utf-8") + b"\n")
+            await writer.drain()
+            reply = await reader.readline()
+            if len(reply) == 0:
+                break
+            latencies.append(time.perf_counter() - start)
+            turns += 1
+    finally:
+        writer.close()
+    return turns
+
+
+# run_load(host, port, conversations, concurrency, script): Has many conversations with the server at once, and
+#                                                          reports how many turns per second it kept up.
+# Input: The server's address and port, how many conversations to have in total, how many to have at once,
+#        and the lines every patient sends.
+# Returns: A dictionary with the number of conversations and turns, the time it took, and the turn latencies.
+async def run_load(host, port, conversations, concurrency, script=load_script):
+    latencies = []
+    limit = asyncio.Semaphore(concurrency)
+
+    async def patient():
+        async with limit:
+            return await load_conversation(host, port, script, latencies)
+
+    start = time.perf_counter()
+    turns = sum(await asyncio.gather(*[patient() for k in range(conversations)]))
+    return {"conversations": conversations, "turns": turns, "seconds": time.perf_counter() - start,
+            "latencies": latencies}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve Dr. Peng's office chatbot over TCP.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (or to connect to with --load)")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on (or to connect to with --load)")
+    parser.add_argument("--preload", action="store_true", help="load the tokenizer and tagger before serving")
+    parser.add_argument("--workers", type=int, default=None, help="threads to run the POS tagging in")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="worker processes to run the POS tagging in (default: none, it runs in the threads)")
+    parser.add_argument("--max-connections", type=int, default=1000, help="clients to serve at once")
+    parser.add_argument("--max-pending", type=int, default=64, help="turns to have in progress at once")
+    parser.add_argument("--idle-timeout", type=float, default=300.0, help="seconds before hanging up on a silent client")
+    parser.add_argument("--calendar", action="store_true", help="book the appointments in a shared calendar")
+    parser.add_argument("--export", metavar="DIRECTORY", help="add finished conversations to the export in DIRECTORY")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="record per-turn metrics, and keep FILE up to date with them (in the Prometheus text format)")
+    parser.add_argument("--metrics-interval", type=float, default=15.0,
+                        help="seconds between rewrites of the --metrics file")
+    parser.add_argument("--load", type=int, metavar="CONVERSATIONS",
+                        help="instead of serving, have this many conversations with a running server")
+    parser.add_argument("--concurrency", type=int, default=100, help="conversations to have at once with --load")
+    args = parser.parse_args()
+
+    if args.load is not None:
+        stats = asyncio.run(run_load(args.host, args.port, args.load, args.concurrency))
+        latencies = sorted(stats["latencies"])
+        if len(latencies) == 0:
+            parser.exit(1, "the server didn't answer\n")
+        print("%d conversations, %d turns in %.2fs: %.1f turns/s, p50 %.2fms, p99 %.2fms"
+              % (stats["conversations"], stats["turns"], stats["seconds"], stats["turns"] / stats["seconds"],
+                 latencies[len(latencies) // 2] * 1e3, latencies[min(len(latencies) * 99 // 100, len(latencies) - 1)] * 1e3))
+        return
+
+    if args.preload:
+        chatbot.preload()
+    pool = None
+    if args.processes > 0:
+        import nlu_pool
+        pool = nlu_pool.NLUPool(args.processes)
+    calendar = appointments.AppointmentCalendar() if args.calendar else None
+    exporter = None
+    if args.export:
+        import export
+        exporter = export.Exporter(args.export)
+    recorder = chatbot.enable_metrics() if args.metrics else None
+    registry = chatbot.SessionRegistry(calendar=calendar, exporter=exporter)
+    executor = concurrent.futures.ThreadPoolExecutor(args.workers)
+
+    async def serve():
+        server = ChatServer(registry, executor, args.max_connections, args.max_pending, args.idle_timeout,
+                            nlu_pool=pool)
+        listener = await server.serve(args.host, args.port)
+        print("serving on %s:%d" % (args.host, args.port), file=sys.stderr)
+        if recorder is not None:
+            writer = asyncio.create_task(write_metrics(recorder, args.metrics, args.metrics_interval))
+        try:
+            async with listener:
+                await listener.serve_forever()
+        finally:
+            if recorder is not None:
+                writer.cancel()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        executor.shutdown()
+        if pool is not None:
+            pool.close()
+        if exporter is not None:
+            exporter.close()
+        if recorder is not None:
+            recorder.write(args.metrics)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# Resolves the day and time a patient asks for ("next Tuesday at 3:30pm", "tomorrow afternoon") into a
+# concrete datetime, relative to a reference clock, in a single pass over the input.
+import datetime
+import re
+
+# One pattern for the day and the time, so one scan finds both.  The word boundaries sit exactly where they
+# did in the original separate day and time patterns, so the same inputs are accepted.  The lookahead up front
+# lets the scan skip any position that can't start a day or a time without trying every alternative there.
+day_and_time_pattern = re.compile(
+    r"(?=[TtNnMmWwFfSsAa0-9])(?:"
+    r"(?P<day>\b(?P<today>[Tt]oday)|(?P<tonight>[Tt]onight)|(?P<tomorrow>[Tt]omorrow)"
+    r"|(?:(?P<modifier>[Tt]his|[Nn]ext|[Tt]he following)\s+)?"
+    r"(?P<weekday>[Mm]on|[Tt]ues|[Ww]ednes|[Tt]hurs|[Ff]ri|[Ss]atur|[Ss]un)day\b)"
+    r"|(?P<time>\b(?:(?P<hour>1[0-2]|[0-9])(?::(?P<minute>[0-5][0-9]))?\s*"
+    r"(?:(?P<am>[Aa][Mm])|(?P<pm>[Pp][Mm])|in the (?P<part>morning|afternoon|evening))"
+    r"|(?P<noon>(?P<after>[Aa]fter)?[Nn]oon)|(?P<midnight>[Mm]idnight))\b))")
+
+weekdays = {"mon": 0, "tues": 1, "wednes": 2, "thurs": 3, "fri": 4, "satur": 5, "sun": 6}
+
+# When "afternoon" on its own is taken to be
+afternoon_hour = 15
+
+
+# AppointmentTime: The day and time a patient asked for.  It is the text the patient used (so it can be put
+# back into the chatbot's sentences as is), with the resolved datetime in its "when" attribute.
+class AppointmentTime(str):
+    def __new__(cls, text, when):
+        appointment = super().__new__(cls, text)
+        appointment.when = when
+        return appointment
+
+    def __repr__(self):
+        return "AppointmentTime(%s, %r)" % (str.__repr__(self), self.when)
+
+    def __reduce__(self):
+        return (AppointmentTime, (str(self), self.when))
+
+
+# resolve_day(match, today): Works out which date the day part of the input means.
+# Input: The day match, and today's date.
+# Returns: A datetime.date.
+def resolve_day(match, today):
+    if match.group("today") or match.group("tonight"):
+        return today
+    elif match.group("tomorrow"):
+        return today + datetime.timedelta(days=1)
+    ahead = (weekdays[match.group("weekday").lower()] - today.weekday()) % 7
+    modifier = match.group("modifier")
+    # "Friday" or "this Friday" is the next Friday from today on (today included), "next Friday" is the
+    # first one after today, and "the following Friday" is the one a week after that
+    if modifier is not None and modifier.lower() != "this":
+        if ahead == 0:
+            ahead = 7
+        if modifier.lower() == "the following":
+            ahead += 7
+    return today + datetime.timedelta(days=ahead)
+
+
+# resolve_time(match): Works out which time of day the time part of the input means.
+# Input: The time match.
+# Returns: A (datetime.time, extra days) pair; midnight counts as the start of the next day.
+def resolve_time(match):
+    if match.group("midnight"):
+        return datetime.time(0, 0), 1
+    elif match.group("noon"):
+        if match.group("after"):
+            return datetime.time(afternoon_hour, 0), 0
+        return datetime.time(12, 0), 0
+    hour = int(match.group("hour")) % 12
+    if match.group("pm") or match.group("part") in ("afternoon", "evening"):
+        hour += 12
+    return datetime.time(hour, int(match.group("minute") or 0)), 0
+
+
+# resolve(input, now): Finds the day and time in the input and resolves them into a datetime.
+# Input: A string containing the user's input, and the reference datetime the day is relative to.
+# Returns: A (status, appointment) pair.  The status is "ok" with an AppointmentTime for the part of the input
+#          from the day to the time (or from the time to the day), or "unknown_day" / "unknown_time" with None
+#          if the input doesn't say which day or which time.
+def resolve(input, now):
+    day = None
+    time = None
+    for match in day_and_time_pattern.finditer(input):
+        if match.group("day") is not None:
+            if day is None:
+                day = match
+        elif time is None:
+            time = match
+        if day is not None and time is not None:
+            break
+    if day is None:
+        return "unknown_day", None
+    elif time is None:
+        return "unknown_time", None
+
+    # we only want the parts that contain the date and time
+    # most likely, the user specified the time after the date
+    if day.start() < time.end():
+        text = input[day.start():time.end()]
+    else:
+        # there are cases where the user specifies the time first before the day
+        text = input[time.start():day.end()]
+    clock, extra_days = resolve_time(time)
+    date = resolve_day(day, now.date()) + datetime.timedelta(days=extra_days)
+    return "ok", AppointmentTime(text, datetime.datetime.combine(date, clock))